@@ -1,13 +1,191 @@
-from django.contrib import admin
-from ShopSphere.models import Category, Page
+from decimal import Decimal
+
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import DecimalField, F, Func, Q, Value
+from django.template.response import TemplateResponse
+from django.utils import timezone
+from ShopSphere.models import Category, Page, Cart, CartItem, Product, Promotion, Task
 from ShopSphere.models import UserProfile
+from . import pricing
+from .caching import bump_generation
+from .forms import ProductBulkUpdateForm
+
+# Changelists of big tables skip the extra COUNT(*) of the whole table and
+# list related objects through a join rather than a query per row.
+
+
+class IndexedSearchMixin:
+    """Changelist search that an index can answer.
+
+    Django turns '=field' and '^field' into case-insensitive LIKEs, which
+    scan the table on SQLite. Here '=field' is an exact match and '^field'
+    a range, field >= term AND field < term + U+10FFFF, on indexed columns,
+    so both are case-sensitive. The whole search term is matched, not each
+    word of it.
+    """
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        condition = Q()
+        for field in self.search_fields:
+            if field.startswith('='):
+                condition |= Q(**{field[1:]: term})
+            elif field.startswith('^'):
+                condition |= Q(**{f'{field[1:]}__gte': term, f'{field[1:]}__lt': term + '\U0010ffff'})
+            else:
+                raise ImproperlyConfigured(f'{type(self).__name__} can only search with = or ^, not {field!r}')
+        return queryset.filter(condition), False
+
+
+class PageAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('title', 'category', 'url', 'views')
+    list_select_related = ('category',)
+    show_full_result_count = False
+    search_fields = ('^title',)
+    raw_id_fields = ('category',)
+    actions = ['reset_views']
 
-class PageAdmin(admin.ModelAdmin):
-    list_display = ('title', 'category', 'url')
+    def reset_views(self, request, queryset):
+        updated = queryset.update(views=0)
+        bump_generation('pages')
+        self.message_user(request, f'Reset the views of {updated} pages.')
+    reset_views.short_description = 'Reset views of selected pages'
 
-class CategoryAdmin(admin.ModelAdmin):
+
+class CategoryAdmin(IndexedSearchMixin, admin.ModelAdmin):
     prepopulated_fields = {'slug':('name',)}
+    list_display = ('name', 'views', 'likes')
+    show_full_result_count = False
+    search_fields = ('^name',)
+    actions = ['reset_counts']
+
+    def reset_counts(self, request, queryset):
+        updated = queryset.update(views=0, likes=0)
+        bump_generation('categories')
+        self.message_user(request, f'Reset the views and likes of {updated} categories.')
+    reset_counts.short_description = 'Reset views and likes of selected categories'
+
+
+class ProductAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('name', 'category', 'price', 'stock')
+    list_select_related = ('category_ref',)
+    show_full_result_count = False
+    search_fields = ('=category', '^name')
+    raw_id_fields = ('category_ref',)
+    readonly_fields = ('image_digest',)
+    actions = ['bulk_update']
+
+    def bulk_update(self, request, queryset):
+        """Change the price and/or stock of every selected product with one UPDATE"""
+        form = ProductBulkUpdateForm(request.POST if 'apply' in request.POST else None)
+        if not form.is_valid():
+            return TemplateResponse(request, 'admin/ShopSphere/product/bulk_update.html', {
+                **self.admin_site.each_context(request),
+                'title': 'Update selected products',
+                'opts': self.model._meta,
+                'form': form,
+                'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+                # The selected ids are passed on as they came, rather than re-read from the table.
+                'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+                'select_across': request.POST.get('select_across', '0'),
+            })
+
+        changes = {}
+        if form.cleaned_data['price_percent'] is not None:
+            factor = 1 + form.cleaned_data['price_percent'] / 100
+            changes['price'] = Func(F('price') * Value(factor), Value(2), function='ROUND',
+                                    output_field=DecimalField(max_digits=10, decimal_places=2))
+        if form.cleaned_data['stock'] is not None:
+            changes['stock'] = form.cleaned_data['stock']
+        updated = queryset.update(**changes)
+        # update() skips the save signals, so evict the cached pages showing these products here:
+        # lists depend on 'products' and every product page on 'products:bulk', which spares
+        # bumping each selected product's own tag.
+        bump_generation('products')
+        bump_generation('products:bulk')
+        if 'price' in changes:
+            bump_generation(pricing.PRICE_TAG)
+        self.message_user(request, f'Updated {updated} products.', messages.SUCCESS)
+    bulk_update.short_description = 'Update price or stock of selected products'
+
+
+class CartItemInline(admin.TabularInline):
+    model = CartItem
+    raw_id_fields = ('product',)
+    extra = 0
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+
+class CartAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('id', 'user', 'created_at')
+    list_select_related = ('user',)
+    show_full_result_count = False
+    search_fields = ('=user__username',)
+    raw_id_fields = ('user',)
+    inlines = [CartItemInline]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        pricing.cart_changed(form.instance)
+
+
+class CartItemAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('id', 'cart', 'product', 'quantity')
+    list_select_related = ('cart', 'product')
+    show_full_result_count = False
+    search_fields = ('=cart__user__username', '^product__name')
+    raw_id_fields = ('cart', 'product')
+
+    # Lines changed here move their carts on to a new pricing version, as cart.py's changes do.
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        pricing.cart_changed(obj.cart)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        pricing.cart_changed(obj.cart)
+
+    def delete_queryset(self, request, queryset):
+        carts = list(Cart.objects.filter(items__in=queryset).distinct())
+        super().delete_queryset(request, queryset)
+        for cart in carts:
+            pricing.cart_changed(cart)
+
+
+class PromotionAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('name', 'kind', 'active', 'starts_at', 'ends_at', 'percent_off')
+    list_select_related = ('category', 'product')
+    list_filter = ('kind', 'active')
+    search_fields = ('^name',)
+    raw_id_fields = ('category', 'product')
+
+
+class TaskAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('name', 'status', 'attempts', 'run_at', 'finished_at', 'seconds')
+    list_filter = ('status', 'name')
+    show_full_result_count = False
+    search_fields = ('^name', '=key')
+    readonly_fields = ('locked_by', 'locked_at', 'created_at', 'finished_at', 'seconds', 'last_error')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        updated = queryset.exclude(status=Task.RUNNING).update(
+            status=Task.QUEUED, attempts=0, run_at=timezone.now(), finished_at=None)
+        self.message_user(request, f'Queued {updated} tasks to run again.')
+    retry.short_description = 'Run selected tasks again'
+
 
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Page, PageAdmin)
 admin.site.register(UserProfile)
+admin.site.register(Product, ProductAdmin)
+admin.site.register(Cart, CartAdmin)
+admin.site.register(CartItem, CartItemAdmin)
+admin.site.register(Promotion, PromotionAdmin)
+admin.site.register(Task, TaskAdmin)
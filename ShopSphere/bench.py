@@ -0,0 +1,296 @@
+"""Benchmark harness for the site's URLs.
+
+seed() tops the database up with a synthetic catalog, users and carts of a
+given size. run() then drives one route with concurrent clients and reports
+throughput, latency percentiles and SQL queries per request; compare()
+checks a set of results against a saved baseline.
+
+Requests go through Django's test Client, so they take the same path through
+the WSGI handler and middleware as a served request, minus the network and
+the server. Each client is a thread with its own database connection.
+Benchmarks write (carts, likes, checkouts), so point them at a database of
+their own, never production.
+"""
+import random
+import statistics
+import threading
+import time
+from contextlib import ExitStack
+from decimal import Decimal
+from itertools import count
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.template.defaultfilters import slugify
+from django.test import Client
+from django.urls import reverse
+
+from . import search
+from .caching import bump_generation
+from .models import Cart, CartItem, Category, Page, Product
+
+PRODUCT_PREFIX = 'Bench product '
+CATEGORY_PREFIX = 'Bench category '
+USER_PREFIX = 'bench-user-'
+PASSWORD = 'bench'
+PRODUCTS_PER_CATEGORY = 500
+PAGES_PER_CATEGORY = 3
+WORDS = ('lamp', 'chair', 'table', 'kettle', 'tent', 'stove', 'lantern', 'rug', 'mirror', 'clock',
+         'blue', 'green', 'oak', 'steel', 'compact', 'folding', 'vintage', 'modern', 'large', 'small')
+
+
+def _bench_count(queryset, field, prefix):
+    return queryset.filter(**{f'{field}__startswith': prefix}).count()
+
+
+def seed(products=10000, users=100, carts=100, batch_size=5000, rng=None):
+    """Top the synthetic data up to the given sizes; returns the number of rows created per model.
+
+    Running it again with the same sizes creates nothing.
+    """
+    rng = rng or random.Random(0)
+    created = dict.fromkeys(['categories', 'pages', 'products', 'users', 'carts'], 0)
+
+    categories = max(1, products // PRODUCTS_PER_CATEGORY)
+    existing = set(Category.objects.filter(name__startswith=CATEGORY_PREFIX).values_list('name', flat=True))
+    # bulk_create skips Category.save(), so the slug is set here.
+    new = [Category(name=name, slug=slugify(name)) for name in
+           (f'{CATEGORY_PREFIX}{i}' for i in range(categories)) if name not in existing]
+    Category.objects.bulk_create(new)
+    created['categories'] = len(new)
+    category_ids = dict(Category.objects.filter(name__startswith=CATEGORY_PREFIX).values_list('name', 'id'))
+
+    if new:
+        new_ids = Category.objects.filter(name__in=[c.name for c in new]).values_list('id', flat=True)
+        pages = [Page(category_id=category_id, title=f'Guide {n}', url=f'https://example.com/{category_id}/{n}')
+                 for category_id in new_ids for n in range(PAGES_PER_CATEGORY)]
+        Page.objects.bulk_create(pages)
+        created['pages'] = len(pages)
+
+    start = _bench_count(Product.objects, 'name', PRODUCT_PREFIX)
+    for offset in range(start, products, batch_size):
+        batch = []
+        for i in range(offset, min(offset + batch_size, products)):
+            category = f'{CATEGORY_PREFIX}{i % categories}'
+            batch.append(Product(name=f'{PRODUCT_PREFIX}{i}', category=category, category_ref_id=category_ids[category],
+                                 description=' '.join(rng.choices(WORDS, k=8)),
+                                 price=Decimal(rng.randrange(100, 100000)) / 100, stock=10 ** 6))
+        with transaction.atomic():
+            Product.objects.bulk_create(batch)
+        created['products'] += len(batch)
+
+    start = _bench_count(User.objects, 'username', USER_PREFIX)
+    if start < users:
+        # Hashing is deliberately slow, so every bench user shares one hash.
+        password = make_password(PASSWORD)
+        for offset in range(start, users, batch_size):
+            User.objects.bulk_create([User(username=f'{USER_PREFIX}{i}', password=password)
+                                      for i in range(offset, min(offset + batch_size, users))])
+        created['users'] = users - start
+
+    carts = min(carts, users)
+    without_cart = (User.objects.filter(username__startswith=USER_PREFIX, cart__isnull=True)
+                    .order_by('id').values_list('id', flat=True))
+    needed = carts - Cart.objects.filter(user__username__startswith=USER_PREFIX).count()
+    if needed > 0:
+        product_ids = list(Product.objects.filter(name__startswith=PRODUCT_PREFIX)
+                           .values_list('id', flat=True)[:10000])
+        user_ids = list(without_cart[:needed])
+        Cart.objects.bulk_create([Cart(user_id=user_id) for user_id in user_ids])
+        items = []
+        for cart_id in Cart.objects.filter(user_id__in=user_ids).values_list('id', flat=True):
+            for product_id in rng.sample(product_ids, min(len(product_ids), rng.randint(1, 4))):
+                items.append(CartItem(cart_id=cart_id, product_id=product_id, quantity=rng.randint(1, 3)))
+        CartItem.objects.bulk_create(items, batch_size=batch_size)
+        created['carts'] = len(user_ids)
+
+    if created['products']:
+        # bulk_create skips the signals that index products one at a time.
+        search.rebuild_index()
+        bump_generation('products')
+    if created['categories']:
+        bump_generation('categories')
+        bump_generation('pages')
+    return created
+
+
+class Sample:
+    """Ids and names to fill route arguments with, picked at random from the database"""
+
+    def __init__(self, rng=None, size=1000):
+        self.rng = rng or random.Random(0)
+        self.product_ids = list(Product.objects.values_list('id', flat=True)[:size])
+        self.slugs = list(Category.objects.values_list('slug', flat=True)[:size])
+        self.page_ids = list(Page.objects.values_list('id', flat=True)[:size])
+        self.users = list(User.objects.filter(username__startswith=USER_PREFIX).order_by('id')[:size])
+
+    def product(self):
+        return self.rng.choice(self.product_ids)
+
+    def slug(self):
+        return self.rng.choice(self.slugs)
+
+    def page(self):
+        return self.rng.choice(self.page_ids)
+
+    def word(self):
+        return self.rng.choice(WORDS)
+
+
+class Route:
+    """How to request one named URL"""
+
+    def __init__(self, name, method='get', login=False, args=None, data=None):
+        self.name = name
+        self.method = method
+        self.login = login
+        self.args = args
+        self.data = data
+
+    def request(self, client, sample, nocache=None):
+        url = reverse(f'ShopSphere:{self.name}', args=self.args(sample) if self.args else None)
+        data = self.data(sample) if self.data else {}
+        if nocache is not None and self.method == 'get':
+            data['nocache'] = nocache
+        return getattr(client, self.method)(url, data)
+
+
+ROUTES = [
+    Route('index'),
+    Route('about'),
+    Route('show_category', args=lambda s: [s.slug()]),
+    Route('like_category', method='post', login=True, args=lambda s: [s.slug()]),
+    Route('goto', args=lambda s: [s.page()]),
+    Route('add_category', login=True),
+    Route('add_page', login=True, args=lambda s: [s.slug()]),
+    Route('register'),
+    Route('login'),
+    Route('recommended', login=True),
+    Route('logout', login=True),
+    Route('metrics', login=True),
+    Route('request_stats', login=True),
+    Route('export_catalog', login=True, args=lambda s: ['categories']),
+    Route('browse', data=lambda s: {'category': s.slug(), 'in_stock': '1'}),
+    Route('search', data=lambda s: {'q': s.word()}),
+    Route('search_suggest', data=lambda s: {'q': s.word()[:3]}),
+    Route('product_detail', args=lambda s: [s.product()]),
+    Route('cart_detail', login=True),
+    Route('add_to_cart', method='post', login=True, args=lambda s: [s.product()]),
+    Route('remove_from_cart', login=True, args=lambda s: [s.product()]),
+    Route('clear_cart', login=True),
+    Route('checkout', method='post', login=True),
+]
+
+
+def bench_host():
+    """A host name the site accepts, for the requests' Host header"""
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.')
+    return 'localhost'
+
+
+def percentile(samples, pct):
+    """The pct-th percentile of samples, by nearest rank"""
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))]
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def run(route, sample, clients=8, requests=200, cold=False):
+    """Request route requests times from clients threads and summarise the timings.
+
+    Latencies are in milliseconds. Queries are those issued by the request's
+    own thread. cold gives each request a unique query string, so it misses
+    the page cache.
+    """
+    if route.login and len(sample.users) < clients:
+        raise ValueError(f'{route.name} needs {clients} bench users, one per client; seed more')
+    latencies, queries, statuses = [], [], []
+    numbers = count()
+    lock = threading.Lock()
+    run_id = time.time_ns()
+
+    def worker(user):
+        client = Client(HTTP_HOST=bench_host())
+        if user is not None:
+            client.force_login(user)
+        counter = _QueryCounter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(counter))
+                while True:
+                    with lock:
+                        n = next(numbers)
+                    if n >= requests:
+                        return
+                    before, started = counter.queries, time.perf_counter()
+                    try:
+                        status = route.request(client, sample, f'{run_id}-{n}' if cold else None).status_code
+                    except Exception:
+                        # The test client re-raises what a server would answer with a 500.
+                        status = 500
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        queries.append(counter.queries - before)
+                        statuses.append(status)
+                    if user is not None and route.name == 'logout':
+                        client.force_login(user)
+        finally:
+            connections.close_all()
+
+    users = sample.users[:clients] if route.login else [None] * clients
+    threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    return {
+        'route': route.name,
+        'requests': len(latencies),
+        'errors': sum(status >= 400 for status in statuses),
+        'rps': round(len(latencies) / wall, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries_per_request': round(statistics.mean(queries), 2),
+    }
+
+
+def compare(baseline, results, tolerance=0.2):
+    """Describe each way results are worse than baseline, both keyed by route.
+
+    Throughput and p95 latency may drift by tolerance (a fraction) before
+    they count; queries per request are deterministic, so any increase does.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f'{name}: {result["rps"]} req/s, was {base["rps"]}')
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {result["p95_ms"]} ms, was {base["p95_ms"]}')
+        if result['queries_per_request'] > base['queries_per_request']:
+            regressions.append(f'{name}: {result["queries_per_request"]} queries per request, '
+                               f'was {base["queries_per_request"]}')
+        if result['errors'] > base['errors']:
+            regressions.append(f'{name}: {result["errors"]} errors, was {base["errors"]}')
+    return regressions
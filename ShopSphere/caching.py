@@ -0,0 +1,142 @@
+"""Generation counters for cache invalidation.
+
+Cached fragments put the current generation of what they depend on in their
+key. Bumping the generation orphans every old entry at once without having to
+find and delete them; they simply age out of the cache.
+"""
+import hashlib
+import re
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+# A module import: cart imports this module through pricing.
+from . import cart
+
+
+def _generation_key(name):
+    return f'ShopSphere:generation:{name}'
+
+
+def _initial_generation():
+    # Seeded from the clock so that a counter which has been evicted never
+    # restarts at a value old entries were keyed with.
+    return int(time.time() * 1000)
+
+
+def get_generation(name):
+    """Return the current generation of name"""
+    key = _generation_key(name)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _initial_generation(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def get_generations(names):
+    """Return the current generations of names, fetched from the cache together"""
+    keys = [_generation_key(name) for name in names]
+    found = cache.get_many(keys)
+    return [found.get(key) or get_generation(name) for name, key in zip(names, keys)]
+
+
+def bump_generation(name):
+    """Move name on to a new generation, invalidating everything keyed on the old one"""
+    key = _generation_key(name)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = _initial_generation()
+        cache.set(key, generation, timeout=None)
+        return generation
+
+
+# Anonymous page cache
+# Whole responses for anonymous GETs are cached under a key made of the URL,
+# the request headers that change the rendered page, and the generations of
+# the tags the page depends on, so bumping e.g. 'product:3' evicts that
+# product's page and nothing else.
+
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 5)
+PAGE_CACHE_HEADERS = ('HTTP_HOST', 'HTTP_ACCEPT_LANGUAGE')
+PAGE_CACHE_OUTCOMES = ('hit', 'miss', 'bypass')
+# A form in a cached page would carry the CSRF token of whoever rendered it,
+# so the token is cached as a placeholder and each visitor is served their own.
+CSRF_FIELD = re.compile(rb'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+CSRF_PLACEHOLDER = b'__csrf_token__'
+
+
+def _count(outcome):
+    key = f'ShopSphere:page_cache:{outcome}'
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+
+
+def page_cache_stats():
+    """Return the hit, miss and bypass counts of the page cache"""
+    keys = {f'ShopSphere:page_cache:{outcome}': outcome for outcome in PAGE_CACHE_OUTCOMES}
+    found = cache.get_many(keys)
+    return {outcome: found.get(key, 0) for key, outcome in keys.items()}
+
+
+def _bypass(request):
+    if request.method not in ('GET', 'HEAD'):
+        return True
+    if request.user.is_authenticated:
+        return True
+    # Anything carrying a cart or a pending message renders per-visitor content.
+    return bool(request.session.get(cart.CART_COUNT_SESSION_KEY)) or bool(get_messages(request))
+
+
+def _page_key(request, tags):
+    parts = [request.get_full_path()]
+    parts += [request.META.get(header, '') for header in PAGE_CACHE_HEADERS]
+    parts += [str(generation) for generation in get_generations(tags)]
+    digest = hashlib.md5('\n'.join(parts).encode()).hexdigest()
+    return f'ShopSphere:page:{digest}'
+
+
+def cache_anonymous_page(*tags):
+    """Cache a view's response for anonymous visitors until one of its tags is bumped.
+
+    Tags are strings, or callables given the view's keyword arguments that
+    return a string, e.g. lambda product_id: f'product:{product_id}'.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if _bypass(request):
+                _count('bypass')
+                return view(request, *args, **kwargs)
+
+            key = _page_key(request, [tag(**kwargs) if callable(tag) else tag for tag in tags])
+            cached = cache.get(key)
+            if cached is not None:
+                _count('hit')
+                content_type, content = cached
+                if CSRF_PLACEHOLDER in content:
+                    content = content.replace(CSRF_PLACEHOLDER, get_token(request).encode())
+                response = HttpResponse(content, content_type=content_type)
+                response['X-Page-Cache'] = 'hit'
+                return response
+
+            _count('miss')
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming and not response.cookies:
+                content = response.content
+                if request.META.get('CSRF_COOKIE_USED'):
+                    content = CSRF_FIELD.sub(rb'\1' + CSRF_PLACEHOLDER + rb'\2', content)
+                cache.set(key, (response['Content-Type'], content), PAGE_CACHE_TIMEOUT)
+            response['X-Page-Cache'] = 'miss'
+            return response
+        return wrapper
+    return decorator
@@ -1,52 +1,182 @@
-class Cart:
-   
-   def __init__(self, request):
-       """Initialize the cart with the session"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from . import inventory, pricing, recommendations
+from .fanout import gather
+from .models import Cart, CartItem, StockReservation
+
+# The session only ever holds these two small values, however full the cart is.
+CART_ID_SESSION_KEY = 'cart_id'
+CART_COUNT_SESSION_KEY = 'cart_items'
+
+
+class CartService:
+   """The visitor's cart, stored in Cart/CartItem rows.
+
+   Logged-in users have a cart tied to their account. Anonymous visitors get
+   an ownerless cart whose id is kept in the session; it is merged into the
+   user's cart when they log in (see merge_anonymous_cart).
+   """
+
+   def __init__(self, request, user=None):
+       """Initialize the cart for the request's user or session"""
+       self.user = user or request.user
        self.session = request.session
-       cart = self.session.get("cart")
-       if not cart:
-           cart = self.session["cart"] = {}  # Create empty cart
-       self.cart = cart
+       self._cart = None
+       self._items = None
+       self._pricing = None
+
+   def _get_cart(self):
+       if self._cart is None:
+           if self.user.is_authenticated:
+               self._cart = Cart.objects.filter(user=self.user).first()
+           else:
+               cart_id = self.session.get(CART_ID_SESSION_KEY)
+               if cart_id:
+                   self._cart = Cart.objects.filter(pk=cart_id, user__isnull=True).first()
+       return self._cart
+
+   def _get_or_create_cart(self):
+       if self._get_cart() is None:
+           if self.user.is_authenticated:
+               self._cart = Cart.objects.get_or_create(user=self.user)[0]
+           else:
+               self._cart = Cart.objects.create()
+               self.session[CART_ID_SESSION_KEY] = self._cart.pk
+       return self._cart
+
+   def _lines(self):
+       # Filtering through the cart's owner saves fetching the Cart row itself.
+       if self.user.is_authenticated:
+           return CartItem.objects.filter(cart__user=self.user)
+       cart_id = self.session.get(CART_ID_SESSION_KEY)
+       if not cart_id:
+           return CartItem.objects.none()
+       return CartItem.objects.filter(cart_id=cart_id, cart__user__isnull=True)
+
+   def _tag(self):
+       # Named without a query: carts are versioned by their owner where they have one.
+       if self.user.is_authenticated:
+           return pricing.cart_tag(user_id=self.user.pk)
+       return pricing.cart_tag(cart_id=self.session.get(CART_ID_SESSION_KEY))
 
    def add(self, product, quantity=1):
-       """Add a product to the cart or update its quantity"""
-       product_id = str(product.id)
-       if product_id in self.cart:
-           self.cart[product_id]["quantity"] += quantity
-       else:
-           self.cart[product_id] = {
-               "id": product_id,
-               "name": product.name,
-               "price": str(product.price),
-               "quantity": quantity,
-           }
+       """Add a product to the cart or update its quantity.
+
+       Raises inventory.OutOfStock, leaving the cart as it was, if the stock
+       can't be reserved.
+       """
+       cart = self._get_or_create_cart()
+       with transaction.atomic():
+           inventory.reserve(cart, product.pk, quantity)
+           if add_item(cart, product.pk, quantity):
+               recommendations.record_line(cart.pk, product.pk)
        self.save()
 
    def remove(self, product):
        """Remove a product from the cart"""
-       product_id = str(product.id)
-       if product_id in self.cart:
-           del self.cart[product_id]
+       cart = self._get_cart()
+       if cart is not None:
+           with transaction.atomic():
+               inventory.release(cart, product.pk)
+               cart.items.filter(product=product).delete()
+           pricing.cart_changed(cart)
            self.save()
 
-   def save(self):
-       """Save cart to session"""
-       self.session.modified = True
-
    def clear(self):
        """Remove all items from the cart"""
-       self.session["cart"] = {}
-       self.session.modified = True
+       cart = self._get_cart()
+       if cart is not None:
+           with transaction.atomic():
+               inventory.release(cart)
+               cart.items.all().delete()
+           pricing.cart_changed(cart)
+           self.save()
+
+   def checkout(self):
+       """Buy everything in the cart; raises inventory.OutOfStock if it can't be covered"""
+       cart = self._get_cart()
+       lines = inventory.checkout(cart) if cart is not None else []
+       self.save()
+       return lines
+
+   def save(self):
+       """Record the new item count in the session"""
+       self._items = None
+       self._pricing = None
+       self.session[CART_COUNT_SESSION_KEY] = self.totals()['items']
+
+   def load(self):
+       """Fetch the lines and the priced cart at the same time; returns the service"""
+       # The session and user are read here, in the request's own thread.
+       lines, tag = self._lines(), self._tag()
+       self._items, self._pricing = gather(lambda: _with_products(lines), lambda: pricing.price_lines(tag, lines))
+       return self
+
+   @property
+   def items(self):
+       """Cart lines with their products, fetched in a single query"""
+       if self._items is None:
+           self._items = _with_products(self._lines())
+       return self._items
 
    def __iter__(self):
        """Iterate over items in the cart"""
-       for item in self.cart.values():
-           yield item
+       return iter(self.items)
+
+   def pricing(self):
+       """The priced cart, cached until the cart or its products' prices change"""
+       if self._pricing is None:
+           self._pricing = pricing.price_lines(self._tag(), self._lines())
+       return self._pricing
+
+   def totals(self):
+       """Total quantity and price of the cart"""
+       return self.pricing().totals()
 
    def total_price(self):
        """Calculate total price"""
-       return sum(float(item["price"]) * item["quantity"] for item in self.cart.values())
-   
+       return self.pricing().total_price
+
    def __len__(self):
        """Count total items in the cart"""
-       return sum(item["quantity"] for item in self.cart.values())
\ No newline at end of file
+       return self.session.get(CART_COUNT_SESSION_KEY, 0)
+
+
+def _with_products(lines):
+   return list(lines.select_related('product').order_by('id'))
+
+
+def add_item(cart, product_id, quantity):
+   """Add quantity of a product to cart, as an in-place update where the line exists.
+
+   Returns True if a new line was created.
+   """
+   lines = CartItem.objects.filter(cart=cart, product_id=product_id)
+   created = False
+   if not lines.update(quantity=F('quantity') + quantity):
+       try:
+           with transaction.atomic():
+               CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity)
+           created = True
+       except IntegrityError:
+           # Another request created the line first.
+           lines.update(quantity=F('quantity') + quantity)
+   cart.refresh_totals()
+   pricing.cart_changed(cart)
+   return created
+
+
+def merge_anonymous_cart(request, user):
+   """Move the lines of the session's anonymous cart into user's cart"""
+   cart_id = request.session.pop(CART_ID_SESSION_KEY, None)
+   anonymous = Cart.objects.filter(pk=cart_id, user__isnull=True).first() if cart_id else None
+   if anonymous is not None:
+       with transaction.atomic():
+           cart = Cart.objects.get_or_create(user=user)[0]
+           for product_id, quantity in anonymous.items.values_list('product_id', 'quantity'):
+               add_item(cart, product_id, quantity)
+           # The stock held for the anonymous cart now belongs to the user's.
+           StockReservation.objects.filter(cart=anonymous).update(cart=cart)
+           anonymous.delete()
+   CartService(request, user).save()
@@ -0,0 +1,122 @@
+"""Buffered view/like counters.
+
+Counting a hit with its own UPDATE makes every request queue up behind the
+write lock on a handful of hot rows. Instead, increments are summed in process
+memory and written at most every COUNTER_FLUSH_INTERVAL seconds, as a single
+UPDATE ... SET views = views + delta per row. The flush runs at the end of the
+first request after the interval has passed, and once more when the process
+exits. An interval of 0 writes every increment straight through.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import F
+from django.dispatch import Signal
+
+logger = logging.getLogger(__name__)
+
+
+# Sent after each flush, once per model and lookup field, with the lookup
+# values of the rows written and the counter fields that changed.
+counters_flushed = Signal(providing_args=['lookup', 'values', 'fields'])
+
+
+def flush_interval():
+    return getattr(settings, 'COUNTER_FLUSH_INTERVAL', 5)
+
+
+class CounterBuffer:
+    """Pending counter increments, keyed by (model, lookup field, lookup value, counter field)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._last_flush = time.monotonic()
+        self._shutdown_hook = False
+
+    def incr(self, model, value, field, amount=1, lookup='pk'):
+        """Add amount to field of the row of model whose lookup field equals value"""
+        with self._lock:
+            self._pending[(model, lookup, value, field)] += amount
+            if not self._shutdown_hook:
+                atexit.register(self.flush_on_shutdown)
+                self._shutdown_hook = True
+        if flush_interval() <= 0:
+            self.flush()
+
+    def pending(self, model, value, field, lookup='pk'):
+        """Increments of a counter that have not been written yet"""
+        with self._lock:
+            return self._pending.get((model, lookup, value, field), 0)
+
+    def flush_if_due(self):
+        if self._pending and time.monotonic() - self._last_flush >= flush_interval():
+            self.flush()
+
+    def flush(self):
+        """Write all pending increments; returns the number of rows updated"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            self._last_flush = time.monotonic()
+
+        rows = defaultdict(dict)
+        for (model, lookup, value, field), delta in pending.items():
+            rows[(model, lookup, value)][field] = delta
+        done = set()
+        try:
+            for key, deltas in rows.items():
+                model, lookup, value = key
+                model.objects.filter(**{lookup: value}).update(
+                    **{field: F(field) + delta for field, delta in deltas.items()})
+                done.add(key)
+        except DatabaseError:
+            # Put back whatever wasn't written so the next flush retries it.
+            with self._lock:
+                for (model, lookup, value, field), delta in pending.items():
+                    if (model, lookup, value) not in done:
+                        self._pending[(model, lookup, value, field)] += delta
+            raise
+
+        flushed = defaultdict(lambda: (set(), set()))
+        for model, lookup, value in done:
+            values, fields = flushed[model, lookup]
+            values.add(value)
+            fields.update(rows[model, lookup, value])
+        for (model, lookup), (values, fields) in flushed.items():
+            for receiver, error in counters_flushed.send_robust(model, lookup=lookup, values=values, fields=fields):
+                if error is not None:
+                    logger.error('Counter flush receiver %r failed', receiver, exc_info=error)
+        return len(done)
+
+    def flush_on_shutdown(self):
+        try:
+            self.flush()
+        except DatabaseError:
+            logger.exception('Could not flush buffered counters at shutdown')
+
+
+buffer = CounterBuffer()
+
+
+def incr(model, value, field, amount=1, lookup='pk'):
+    buffer.incr(model, value, field, amount=amount, lookup=lookup)
+
+
+def counts_hit(model, field, kwarg, lookup='pk'):
+    """Count a hit on the row named by a view's keyword argument.
+
+    Applied outside any page cache, so cached responses are counted too.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            incr(model, kwargs[kwarg], field, lookup=lookup)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
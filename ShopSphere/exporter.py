@@ -0,0 +1,85 @@
+"""Bulk catalog export.
+
+The mirror of importer: products, categories or pages are read with
+values_list(...).iterator(), so rows arrive from the cursor a chunk at a
+time without building model instances, and are encoded as CSV or JSONL,
+optionally gzipped as they go. Only one chunk is ever held in memory,
+however big the table, so the same generator backs both the streaming
+download and the export_catalog command.
+"""
+import csv
+import io
+import json
+import zlib
+
+from .importer import chunked
+from .models import Category, Page, Product
+
+# The columns of each export. Product's match what import_catalog reads.
+EXPORTS = {
+    'products': (Product, ('id', 'category', 'name', 'description', 'price', 'stock', 'image')),
+    'categories': (Category, ('id', 'name', 'slug', 'views', 'likes')),
+    'pages': (Page, ('id', 'category_id', 'title', 'url', 'views')),
+}
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+def export_rows(name, chunk_size=2000):
+    """Yield the rows of the named export as tuples, in primary key order"""
+    model, fields = EXPORTS[name]
+    return model.objects.order_by('pk').values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def _csv_lines(rows, header=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def _jsonl_lines(fields, rows):
+    # str keeps prices exact, where a float would not.
+    return ''.join(json.dumps(dict(zip(fields, row)), default=str) + '\n' for row in rows)
+
+
+def encode(name, fmt='csv', chunk_size=2000):
+    """Yield the named export as bytes, one chunk of rows at a time"""
+    fields = EXPORTS[name][1]
+    header = fields if fmt == 'csv' else None
+    for chunk in chunked(export_rows(name, chunk_size), chunk_size):
+        if fmt == 'csv':
+            text = _csv_lines(chunk, header)
+            header = None
+        else:
+            text = _jsonl_lines(fields, chunk)
+        yield text.encode('utf-8')
+    if header:
+        # An empty table still gets its header row.
+        yield _csv_lines([], header).encode('utf-8')
+
+
+def gzipped(chunks, level=6):
+    """Gzip a stream of bytes as it is read"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(name, fmt='csv', compress=False, chunk_size=2000):
+    """The named export as an iterator of bytes, gzipped if compress"""
+    if name not in EXPORTS:
+        raise ValueError(f'Unknown export {name!r}; choose from {", ".join(EXPORTS)}')
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}; choose from {", ".join(FORMATS)}')
+    chunks = encode(name, fmt, chunk_size)
+    return gzipped(chunks) if compress else chunks
+
+
+def filename(name, fmt='csv', compress=False):
+    return f'{name}.{fmt}' + ('.gz' if compress else '')
@@ -0,0 +1,139 @@
+"""Faceted browsing of the catalog by category, price band and stock.
+
+One grouped query counts the products in every (category, price band,
+in stock) cell of the catalog. That cube has at most
+categories x bands x 2 rows whatever the catalog's size, and it is cached
+under the product and category generations, so it is re-read only after
+the catalog changes. Stock reservations don't bump those (they would
+rebuild it on every add to cart), so the in-stock counts may lag by up to
+CUBE_TIMEOUT seconds. Every facet count is then summed from it in
+Python: each option counts the products matching it and the other facets'
+current selections, so picking a category still shows how many products
+each price band holds within it.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import BooleanField, Case, Count, IntegerField, Value, When
+
+from .caching import get_generation
+from .models import Product
+
+# Cursor parameters of paginate_by_key, dropped whenever the selection changes.
+CURSOR_PARAMS = ('after', 'before')
+# Seconds the cube is kept at most, which bounds how stale its in-stock counts get.
+CUBE_TIMEOUT = 60
+
+
+def price_bounds():
+    return [Decimal(str(bound)) for bound in getattr(settings, 'FACET_PRICE_BOUNDS', (10, 25, 50, 100, 250))]
+
+
+class PriceBand:
+    def __init__(self, index, low, high):
+        self.index = index
+        self.low = low
+        self.high = high
+
+    @property
+    def key(self):
+        return f'{self.low}-{self.high}' if self.high is not None else f'{self.low}-'
+
+    @property
+    def label(self):
+        return f'£{self.low} to £{self.high}' if self.high is not None else f'£{self.low} and over'
+
+    def filter(self, queryset):
+        queryset = queryset.filter(price__gte=self.low)
+        return queryset.filter(price__lt=self.high) if self.high is not None else queryset
+
+
+def price_bands():
+    bounds = price_bounds()
+    lows = [Decimal(0)] + bounds
+    return [PriceBand(i, low, high) for i, (low, high) in enumerate(zip(lows, bounds + [None]))]
+
+
+def _band_case(bands):
+    return Case(*[When(price__lt=band.high, then=Value(band.index)) for band in bands if band.high is not None],
+                default=Value(bands[-1].index), output_field=IntegerField())
+
+
+def cube_key():
+    return f'ShopSphere:facets:{get_generation("products")}:{get_generation("categories")}'
+
+
+def facet_cube():
+    """(category slug, category name, price band index, in stock, count) for every non-empty cell"""
+    key = cube_key()
+    cube = cache.get(key)
+    if cube is None:
+        rows = (Product.objects
+                .annotate(band=_band_case(price_bands()),
+                          in_stock=Case(When(stock__gt=0, then=Value(True)), default=Value(False),
+                                        output_field=BooleanField()))
+                .values_list('category_ref__slug', 'category_ref__name', 'band', 'in_stock')
+                .annotate(count=Count('id'))
+                .order_by())
+        cube = [(slug, name, band, bool(in_stock), count) for slug, name, band, in_stock, count in rows]
+        cache.set(key, cube, CUBE_TIMEOUT)
+    return cube
+
+
+class Selection:
+    """The facet options picked in a request's GET parameters"""
+
+    def __init__(self, params):
+        # params is a QueryDict, normally request.GET.
+        self.params = params
+        bands = {band.key: band for band in price_bands()}
+        self.category = params.get('category') or None
+        self.band = bands.get(params.get('price'))
+        self.in_stock = params.get('in_stock') == '1'
+
+    def filter(self, queryset):
+        if self.category:
+            queryset = queryset.filter(category_ref__slug=self.category)
+        if self.band:
+            queryset = self.band.filter(queryset)
+        if self.in_stock:
+            queryset = queryset.filter(stock__gt=0)
+        return queryset
+
+    def _matches(self, slug, band, in_stock, ignore):
+        return ((ignore == 'category' or not self.category or slug == self.category) and
+                (ignore == 'price' or not self.band or band == self.band.index) and
+                (ignore == 'in_stock' or not self.in_stock or in_stock))
+
+    def toggle(self, name, value):
+        """Query string selecting value for the facet name, or clearing it if already selected"""
+        params = self.params.copy()
+        for param in CURSOR_PARAMS:
+            params.pop(param, None)
+        if params.get(name) == value:
+            params.pop(name)
+        else:
+            params[name] = value
+        return params.urlencode()
+
+    def facets(self):
+        """The options of each facet with their counts under the rest of the selection"""
+        cube = facet_cube()
+        categories, bands, in_stock = {}, {}, 0
+        for slug, name, band, stocked, count in cube:
+            if slug and self._matches(slug, band, stocked, 'category'):
+                categories[slug] = (name, categories.get(slug, (name, 0))[1] + count)
+            if self._matches(slug, band, stocked, 'price'):
+                bands[band] = bands.get(band, 0) + count
+            if stocked and self._matches(slug, band, stocked, 'in_stock'):
+                in_stock += count
+        return {
+            'categories': [{'value': slug, 'label': name, 'count': count, 'selected': slug == self.category,
+                            'query': self.toggle('category', slug)}
+                           for slug, (name, count) in sorted(categories.items(), key=lambda item: item[1][0])],
+            'prices': [{'value': band.key, 'label': band.label, 'count': bands.get(band.index, 0),
+                        'selected': band is self.band, 'query': self.toggle('price', band.key)}
+                       for band in price_bands() if bands.get(band.index)],
+            'in_stock': {'count': in_stock, 'selected': self.in_stock, 'query': self.toggle('in_stock', '1')},
+        }
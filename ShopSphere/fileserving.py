@@ -0,0 +1,177 @@
+"""Serving static and media files.
+
+Replaces django.views.static.serve, which reads each file into the response
+with no validators. Here files are answered with ETag/Last-Modified (and 304
+Not Modified), single byte ranges (206), a precompressed .br or .gz sibling
+when the client accepts it, and FileResponse so a WSGI server with
+wsgi.file_wrapper can sendfile() the body without copying it through Python.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from email.utils import formatdate, parsedate_to_datetime
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+
+# (extension of the precompressed sibling, Content-Encoding), most preferred first.
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+# Hashed names (collectstatic, image derivatives) never change content.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = 'public, max-age=%d' % getattr(settings, 'FILE_SERVING_MAX_AGE', 60 * 60)
+HASHED_NAME_RE = re.compile(r'(\.[0-9a-f]{12}\.[^/]+$)|(^derivatives/)')
+
+
+def _etag(stat):
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def _accepted_encodings(request):
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _byte_range(request, size, etag):
+    """Return (start, end) of the requested range, 'unsatisfiable', or None for the whole file"""
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range.strip() != etag:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        # Multiple or malformed ranges: just send the whole file.
+        return None
+    first, last = match.groups()
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        start, end = max(size - length, 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return 'unsatisfiable'
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+def serve(request, path, document_root):
+    """Serve a file under document_root with validators, ranges and precompressed variants"""
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        fullpath = safe_join(document_root, path)
+    except SuspiciousFileOperation:
+        raise Http404('Outside the document root')
+    if not os.path.isfile(fullpath):
+        raise Http404(f'"{path}" does not exist')
+
+    content_type, original_encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+    served_path, encoding = fullpath, original_encoding
+    ranged = 'HTTP_RANGE' in request.META
+    if original_encoding is None and not ranged:
+        accepted = _accepted_encodings(request)
+        for ext, coding in ENCODINGS:
+            if coding in accepted and os.path.isfile(fullpath + ext):
+                served_path, encoding = fullpath + ext, coding
+                break
+
+    stat = os.stat(served_path)
+    etag = _etag(stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if HASHED_NAME_RE.search(path) else DEFAULT_CACHE_CONTROL,
+        'Vary': 'Accept-Encoding',
+    }
+
+    if _not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+    else:
+        byte_range = _byte_range(request, stat.st_size, etag) if served_path == fullpath else None
+        if byte_range == 'unsatisfiable':
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+        elif byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(_read_range(served_path, start, end - start + 1),
+                                             status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            response = FileResponse(open(served_path, 'rb'), content_type=content_type)
+            response['Content-Length'] = str(stat.st_size)
+            if encoding:
+                response['Content-Encoding'] = encoding
+            elif 'Content-Encoding' in response:
+                del response['Content-Encoding']
+        if encoding is None:
+            headers['Accept-Ranges'] = 'bytes'
+
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+class FileServingMiddleware:
+    """Answer requests under STATIC_URL and MEDIA_URL with serve()
+
+    Static files are served from STATIC_ROOT once collectstatic has run;
+    until then the request falls through to the usual handlers.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.roots = []
+        if getattr(settings, 'STATIC_ROOT', None):
+            self.roots.append((settings.STATIC_URL, settings.STATIC_ROOT))
+        if settings.MEDIA_ROOT:
+            self.roots.append((settings.MEDIA_URL, settings.MEDIA_ROOT))
+
+    def __call__(self, request):
+        if request.method in ('GET', 'HEAD'):
+            for prefix, root in self.roots:
+                if request.path_info.startswith(prefix):
+                    try:
+                        return serve(request, request.path_info[len(prefix):], root)
+                    except Http404:
+                        pass
+        return self.get_response(request)
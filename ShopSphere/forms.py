@@ -64,4 +64,16 @@ class ProductForm(forms.ModelForm):
 
         model = Product
 
-        fields = ['category', 'name', 'description', 'price', 'stock', 'image'] 
\ No newline at end of file
+        fields = ['category', 'name', 'description', 'price', 'stock', 'image'] 
+
+class ProductBulkUpdateForm(forms.Form):
+    """Changes applied to every selected product by the admin's bulk update action"""
+    price_percent = forms.DecimalField(required=False, max_digits=5, decimal_places=2, min_value=-100,
+                                       label='Change prices by (%)', help_text='e.g. -10 for 10% off.')
+    stock = forms.IntegerField(required=False, min_value=0, label='Set stock to')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('price_percent') is None and cleaned_data.get('stock') is None:
+            raise forms.ValidationError('Enter a price change, a stock level or both.')
+        return cleaned_data
@@ -0,0 +1,84 @@
+"""Resized and WebP derivatives of product images.
+
+When a product's image changes, a background task (see tasks) renders it
+at each of IMAGE_WIDTHS as JPEG and, where Pillow supports it, WebP. The
+files are stored under media/derivatives/, named by a hash of the
+original's content, so identical uploads share files and a changed image
+never collides with stale ones. The hash is kept on Product.image_digest
+for the {% product_image %} template tag, which emits a srcset over the
+variants.
+"""
+import hashlib
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, features
+
+from .caching import bump_generation
+from .models import Product
+from .tasks import enqueue, task
+
+IMAGE_WIDTHS = getattr(settings, 'IMAGE_WIDTHS', (160, 320, 640))
+DERIVATIVES_DIR = 'derivatives'
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+
+
+def formats():
+    return ('jpg', 'webp') if features.check('webp') else ('jpg',)
+
+
+def derivative_name(digest, width, ext):
+    return f'{DERIVATIVES_DIR}/{digest}-{width}.{ext}'
+
+
+def _render(original, width, ext):
+    image = original.copy()
+    image.thumbnail((width, width * 4), Image.LANCZOS)
+    out = BytesIO()
+    if ext == 'webp':
+        image.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+    else:
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+@task()
+def generate_derivatives(product_id):
+    """Render any missing variants of a product's image and record its digest"""
+    product = Product.objects.filter(pk=product_id).only('image').first()
+    if product is None or not product.image:
+        return None
+    with default_storage.open(product.image.name, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+
+    original = Image.open(BytesIO(data))
+    original.load()
+    for width in IMAGE_WIDTHS:
+        for ext in formats():
+            name = derivative_name(digest, width, ext)
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(_render(original, width, ext)))
+
+    # update() rather than save() so this doesn't re-trigger the signals; the
+    # product's cached pages are evicted here instead, to pick up the srcset.
+    if Product.objects.filter(pk=product_id, image=product.image.name).update(image_digest=digest):
+        bump_generation(f'product:{product_id}')
+        bump_generation('products')
+    return digest
+
+
+def schedule_derivatives(product_id):
+    """Queue the rendering of a product's image variants, to run once the current transaction commits"""
+    enqueue(generate_derivatives.task_name, product_id)
+
+
+def srcset(product, ext):
+    """srcset attribute value listing a product's variants in one format"""
+    return ', '.join(f'{default_storage.url(derivative_name(product.image_digest, width, ext))} {width}w'
+                     for width in IMAGE_WIDTHS)
@@ -0,0 +1,146 @@
+"""Bulk catalog import.
+
+Rows are streamed from CSV or JSONL and written a chunk at a time with
+bulk_create/bulk_update, upserting on the product's natural key
+(category, name). Only one chunk is ever held in memory.
+"""
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+
+from . import images, search
+from .caching import bump_generation
+from .models import Category, Product, unique_slug
+from .pricing import PRICE_TAG
+
+UPDATE_FIELDS = ['category_ref', 'description', 'price', 'stock', 'image', 'image_digest']
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def read_rows(path, fmt=None, skip=0):
+    """Yield rows of path as dicts, lazily, after skipping the first skip rows"""
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'jsonl':
+            lines = (line for line in f if line.strip())
+            for line in islice(lines, skip, None):
+                yield json.loads(line)
+        else:
+            yield from islice(csv.DictReader(f), skip, None)
+
+
+def chunked(rows, size):
+    """Yield lists of up to size items from rows"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def clean_row(row):
+    """Validate a raw row into the values stored on Product"""
+    name = (row.get('name') or '').strip()
+    if not name:
+        raise InvalidRow('missing name')
+    try:
+        price = Decimal(str(row.get('price'))).quantize(Decimal('0.01'))
+        stock = int(row.get('stock') or 0)
+    except (InvalidOperation, TypeError, ValueError):
+        raise InvalidRow(f'bad price or stock for {name!r}')
+    if stock < 0:
+        raise InvalidRow(f'negative stock for {name!r}')
+    category = (row.get('category') or '').strip()
+    if len(category) > Category.NAME_MAX_LENGTH:
+        raise InvalidRow(f'category longer than {Category.NAME_MAX_LENGTH} characters for {name!r}')
+    return {
+        'category': category,
+        'name': name,
+        'description': row.get('description') or '',
+        'price': price,
+        'stock': stock,
+        'image': row.get('image') or None,
+    }
+
+
+def _category_ids(names):
+    """Map names to Category ids, creating the missing categories; returns (ids, created)"""
+    names = set(filter(None, names))
+    found = dict(Category.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = sorted(names - set(found))
+    if missing:
+        # bulk_create skips Category.save(), so the slug is set here, suffixed
+        # where names slugify alike ('Home & Kitchen', 'Home Kitchen').
+        taken = Category.taken_slugs(missing)
+        new = []
+        for name in missing:
+            new.append(Category(name=name, slug=unique_slug(name, taken, Category.SLUG_MAX_LENGTH)))
+            taken.add(new[-1].slug)
+        Category.objects.bulk_create(new)
+        found.update(Category.objects.filter(name__in=missing).values_list('name', 'id'))
+    return found, len(missing)
+
+
+def _existing(keys):
+    products = Product.objects.filter(category__in={c for c, _ in keys}, name__in={n for _, n in keys})
+    existing = {}
+    for product in products.order_by('id'):
+        existing.setdefault((product.category, product.name), product)
+    return existing
+
+
+def upsert_products(rows, batch_size=None):
+    """Create or update products from cleaned rows, keyed on (category, name).
+
+    Returns (created, updated) counts. Runs in a single transaction; callers
+    pass one chunk at a time.
+    """
+    # The last row wins if a key repeats within the chunk.
+    by_key = {(row['category'], row['name']): row for row in rows}
+    with transaction.atomic():
+        category_ids, new_categories = _category_ids(c for c, _ in by_key)
+        existing = _existing(by_key)
+
+        to_create, to_update = [], []
+        repriced = False
+        for key, row in by_key.items():
+            product = existing.get(key)
+            if product is None:
+                product = Product(category=row['category'], name=row['name'])
+                to_create.append(product)
+            else:
+                to_update.append(product)
+                repriced = repriced or (product.price != row['price'] or
+                                        product.category_ref_id != category_ids.get(row['category']))
+            product.category_ref_id = category_ids.get(row['category'])
+            product.description = row['description']
+            product.price = row['price']
+            product.stock = row['stock']
+            if row['image'] and row['image'] != product.image.name:
+                product.image = row['image']
+                product.image_digest = ''
+
+        Product.objects.bulk_update(to_update, UPDATE_FIELDS, batch_size=batch_size)
+        Product.objects.bulk_create(to_create, batch_size=batch_size)
+
+        # Bulk operations skip the model signals, so do their work here.
+        saved = _existing(by_key).values()
+        search.index_products(saved)
+        for product in saved:
+            if product.image and not product.image_digest:
+                images.schedule_derivatives(product.id)
+    bump_generation('products')
+    if new_categories:
+        bump_generation('categories')
+    for product in to_update:
+        bump_generation(f'product:{product.id}')
+    if repriced:
+        bump_generation(PRICE_TAG)
+    return len(to_create), len(to_update)
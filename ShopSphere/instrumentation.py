@@ -0,0 +1,188 @@
+"""Per-view SQL and timing statistics.
+
+InstrumentationMiddleware profiles a sample of requests (a fraction
+INSTRUMENTATION_SAMPLE_RATE of them): the number of SQL queries and time
+spent in them, template rendering time, response size and total time, added
+up per view. A query run INSTRUMENTATION_DUPLICATE_THRESHOLD times in one
+request is reported as a likely N+1, with the line of views.py that led to
+it. The totals are kept in process memory and exported by /metrics/ (for
+Prometheus) and /stats/ (as JSON, including the duplicated SQL).
+
+With a sample rate of 0 the middleware removes itself at startup and
+nothing is timed; changing the rate takes a restart.
+"""
+import os
+import random
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates
+
+VIEWS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'views.py')
+STAT_FIELDS = ('requests', 'seconds', 'queries', 'sql_seconds', 'template_seconds', 'response_bytes')
+# Caps the distinct duplicated queries remembered, however many a buggy view produces.
+MAX_DUPLICATES = 200
+
+
+def sample_rate():
+    return getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 0)
+
+
+def duplicate_threshold():
+    return getattr(settings, 'INSTRUMENTATION_DUPLICATE_THRESHOLD', 5)
+
+
+_profile = ContextVar('request_profile', default=None)
+
+
+def _view_location():
+    """The line of views.py that led to the current query"""
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename == VIEWS_FILE:
+            return f'{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}'
+    return 'unknown'
+
+
+class RequestProfile:
+    """What one sampled request spent its time on"""
+
+    def __init__(self):
+        # Queries can come from several threads at once (see fanout).
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.shapes = Counter()
+        self.duplicates = {}
+
+    def add_query(self, sql, seconds):
+        with self._lock:
+            self.queries += 1
+            self.sql_seconds += seconds
+            # sql still has its placeholders, so a loop's queries all share one shape.
+            self.shapes[sql] += 1
+            repeated = self.shapes[sql] == duplicate_threshold()
+        if repeated:
+            self.duplicates[sql] = _view_location()
+
+
+def _record_query(execute, sql, params, many, context):
+    profile = _profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, time.perf_counter() - started)
+
+
+def _install(sender=None, connection=None, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+class ViewStats:
+    """Totals over the sampled requests of each view"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = defaultdict(lambda: dict.fromkeys(STAT_FIELDS, 0))
+        self._duplicates = {}
+
+    def record(self, view, profile, seconds, response_bytes):
+        with self._lock:
+            totals = self._views[view]
+            totals['requests'] += 1
+            totals['seconds'] += seconds
+            totals['queries'] += profile.queries
+            totals['sql_seconds'] += profile.sql_seconds
+            totals['template_seconds'] += profile.template_seconds
+            totals['response_bytes'] += response_bytes
+            for sql, location in profile.duplicates.items():
+                key = (view, location, sql)
+                if key in self._duplicates or len(self._duplicates) < MAX_DUPLICATES:
+                    self._duplicates[key] = self._duplicates.get(key, 0) + 1
+
+    def snapshot(self):
+        """The per-view totals, and the duplicated queries with how many requests ran each"""
+        with self._lock:
+            return {
+                'views': {view: dict(totals) for view, totals in self._views.items()},
+                'duplicates': [{'view': view, 'location': location, 'sql': sql, 'requests': n}
+                               for (view, location, sql), n in self._duplicates.items()],
+            }
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+            self._duplicates.clear()
+
+
+stats = ViewStats()
+
+
+def _response_bytes(response):
+    if response.streaming:
+        return int(response.get('Content-Length') or 0)
+    return len(response.content)
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        if sample_rate() <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        connection_created.connect(_install)
+        for connection in connections.all():
+            _install(connection=connection)
+
+    def __call__(self, request):
+        if random.random() >= sample_rate():
+            return self.get_response(request)
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _profile.reset(token)
+        match = request.resolver_match
+        stats.record(match.view_name if match else 'unresolved', profile,
+                     time.perf_counter() - started, _response_bytes(response))
+        return response
+
+
+class TimedTemplate:
+    """A template whose render time is added to the current request's profile"""
+
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        profile = _profile.get()
+        if profile is None:
+            return self.template.render(context, request)
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            profile.template_seconds += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, timing each top-level render for the profiler"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
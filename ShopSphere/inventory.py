@@ -0,0 +1,132 @@
+"""Stock reservations.
+
+Adding to a cart takes the stock straight off Product.stock with a conditional
+UPDATE ... WHERE stock >= n, so two buyers can never both get the last item,
+and records a StockReservation. Reservations expire after
+STOCK_RESERVATION_TTL seconds of cart inactivity and release_expired() puts
+their stock back; checkout() turns them into a permanent sale.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+# A module import: caching imports cart, which imports this module.
+from . import caching, pricing
+from .models import Product, StockReservation
+
+RESERVATION_TTL = timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60))
+
+
+class OutOfStock(Exception):
+    """There is not enough stock of a product to cover a request"""
+
+    def __init__(self, product_id, quantity):
+        super().__init__(f'Not enough stock of product {product_id} for {quantity}')
+        self.product_id = product_id
+        self.quantity = quantity
+
+
+# Bumped by every reservation, so only the few pages that show stock depend on
+# it; 'products' is left alone, or each add to cart would evict every cached
+# catalog page and priced cart.
+STOCK_TAG = 'stock'
+
+
+def _bump_stock(product_id):
+    caching.bump_generation(f'product:{product_id}')
+    caching.bump_generation(STOCK_TAG)
+
+
+def _stock_changed(product_id):
+    """Evict cached pages showing a product's stock, which update() does without the post_save signal"""
+    _bump_stock(product_id)
+    # Again once the change is committed, in case another request cached the
+    # old stock under the new generation in the meantime.
+    transaction.on_commit(lambda: _bump_stock(product_id))
+
+
+def _take(product_id, quantity):
+    taken = Product.objects.filter(pk=product_id, stock__gte=quantity).update(stock=F('stock') - quantity)
+    if not taken:
+        raise OutOfStock(product_id, quantity)
+    _stock_changed(product_id)
+
+
+def _restock(product_id, quantity):
+    if Product.objects.filter(pk=product_id).update(stock=F('stock') + quantity):
+        _stock_changed(product_id)
+
+
+def _release(reservations):
+    # Each row is deleted on its own and only restocked if this call deleted
+    # it, so two concurrent releases can't both return the same stock.
+    released = 0
+    for reservation in reservations:
+        if StockReservation.objects.filter(pk=reservation.pk).delete()[0]:
+            _restock(reservation.product_id, reservation.quantity)
+            released += reservation.quantity
+    return released
+
+
+def reserve(cart, product_id, quantity=1):
+    """Take quantity of a product out of stock for cart, or raise OutOfStock"""
+    expires_at = timezone.now() + RESERVATION_TTL
+    with transaction.atomic():
+        _take(product_id, quantity)
+        StockReservation.objects.create(cart=cart, product_id=product_id, quantity=quantity,
+                                        expires_at=expires_at)
+        # Any activity keeps the whole cart's reservations alive.
+        cart.reservations.update(expires_at=expires_at)
+
+
+def release(cart, product_id=None):
+    """Return the stock reserved by cart, or by its lines of one product"""
+    reservations = cart.reservations.all()
+    if product_id is not None:
+        reservations = reservations.filter(product_id=product_id)
+    with transaction.atomic():
+        return _release(list(reservations))
+
+
+def release_expired(now=None, batch_size=500):
+    """Return the stock of every expired reservation, a batch at a time"""
+    now = now or timezone.now()
+    released = 0
+    while True:
+        batch = list(StockReservation.objects.filter(expires_at__lte=now).order_by('pk')[:batch_size])
+        if not batch:
+            return released
+        with transaction.atomic():
+            released += _release(batch)
+
+
+def checkout(cart):
+    """Sell the cart's contents: its reservations become permanent and the cart is emptied.
+
+    Lines whose reservation expired and was released are re-reserved if the
+    stock is still there; otherwise OutOfStock is raised and nothing changes.
+    """
+    with transaction.atomic():
+        held = defaultdict(int)
+        for reservation in cart.reservations.all():
+            if StockReservation.objects.filter(pk=reservation.pk).delete()[0]:
+                held[reservation.product_id] += reservation.quantity
+
+        lines = list(cart.items.values_list('product_id', 'quantity'))
+        for product_id, quantity in lines:
+            shortfall = quantity - held.pop(product_id, 0)
+            if shortfall > 0:
+                _take(product_id, shortfall)
+            elif shortfall < 0:
+                _restock(product_id, -shortfall)
+        for product_id, quantity in held.items():
+            _restock(product_id, quantity)
+
+        cart.items.all().delete()
+        cart.refresh_totals()
+        pricing.cart_changed(cart)
+    return lines
@@ -0,0 +1,76 @@
+"""Cached top-N lists: the most liked categories and most viewed pages.
+
+Each list is read with an index scan (ORDER BY the counter, LIMIT N) and
+kept in the cache. When buffered counts are flushed, only the rows that
+changed are re-read and merged in, keeping the N best with a heap. Counts
+only ever go up between flushes, so the merge is exact; anything else, like
+an edit in the admin, bumps the model's generation, which the cache key
+includes. A list is rebuilt from the database at least every
+LEADERBOARD_MAX_AGE seconds regardless, which also bounds the damage of two
+processes merging into it at once.
+"""
+import heapq
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import get_generation
+from .models import Category, Page
+
+
+def leaderboard_size():
+    return getattr(settings, 'LEADERBOARD_SIZE', 5)
+
+
+def leaderboard_max_age():
+    return getattr(settings, 'LEADERBOARD_MAX_AGE', 60)
+
+
+class Leaderboard:
+    """The leaderboard_size() rows of model with the highest field, cached under the generation of tag"""
+
+    def __init__(self, model, field, tag):
+        self.model = model
+        self.field = field
+        self.tag = tag
+
+    def _key(self):
+        return f'ShopSphere:leaderboard:{self.model._meta.label_lower}:{self.field}:{get_generation(self.tag)}'
+
+    def _rank(self, obj):
+        return -getattr(obj, self.field), obj.pk
+
+    def top(self):
+        """The current leaderboard, best first"""
+        cached = cache.get(self._key())
+        if cached is not None:
+            return cached[1]
+        return self.rebuild()
+
+    def rebuild(self):
+        """Read the leaderboard from the database and cache it"""
+        rows = list(self.model.objects.order_by(f'-{self.field}', 'pk')[:leaderboard_size()])
+        cache.set(self._key(), (time.time(), rows), leaderboard_max_age())
+        return rows
+
+    def update(self, changed):
+        """Merge changed rows (a queryset) into the cached leaderboard, if there is one"""
+        key = self._key()
+        cached = cache.get(key)
+        if cached is None:
+            # Nothing to merge into; the next read rebuilds it.
+            return
+        built_at, rows = cached
+        merged = {obj.pk: obj for obj in rows}
+        merged.update((obj.pk, obj) for obj in changed)
+        rows = heapq.nsmallest(leaderboard_size(), merged.values(), key=self._rank)
+        # Keeps the original expiry, so merges never put off the periodic rebuild.
+        remaining = leaderboard_max_age() - (time.time() - built_at)
+        if remaining > 0:
+            cache.set(key, (built_at, rows), remaining)
+
+
+top_categories = Leaderboard(Category, 'likes', 'categories')
+top_pages = Leaderboard(Page, 'views', 'pages')
+LEADERBOARDS = (top_categories, top_pages)
@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from ShopSphere import bench, fanout, urls
+
+COLUMNS = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+
+
+class Command(BaseCommand):
+    help = ('Measure throughput, latency and queries per request of every ShopSphere URL under '
+            'concurrent load. It writes to the database, so run it against one of its own.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true',
+                            help='First top the database up to --products/--users/--carts of synthetic data.')
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--carts', type=int, default=100)
+        parser.add_argument('--route', action='append', dest='routes', metavar='NAME',
+                            help='URL name to benchmark; repeat for several. Defaults to all of them.')
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent clients.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per route.')
+        parser.add_argument('--cold', action='store_true', help='Bypass the page cache.')
+        parser.add_argument('--compare-fanout', action='store_true',
+                            help="Run each route with a view's queries fetched one after another, then concurrently.")
+        parser.add_argument('--output', help='Write the results to this file as JSON.')
+        parser.add_argument('--baseline', help='Fail if the results are worse than this earlier --output.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Fraction by which req/s and p95 may worsen against the baseline.')
+
+    def handle(self, *args, **options):
+        names = {pattern.name for pattern in urls.urlpatterns}
+        routes = {route.name: route for route in bench.ROUTES}
+        if names - set(routes):
+            raise CommandError(f'No benchmark scenario for: {", ".join(sorted(names - set(routes)))}')
+        selected = options['routes'] or [route.name for route in bench.ROUTES]
+        unknown = set(selected) - set(routes)
+        if unknown:
+            raise CommandError(f'Unknown routes: {", ".join(sorted(unknown))}')
+
+        if options['seed']:
+            created = bench.seed(options['products'], options['users'], options['carts'])
+            self.stdout.write('Seeded ' + ', '.join(f'{n} {model}' for model, n in created.items()) + '.')
+
+        modes = [('serial', 0), ('fanout', fanout.fanout_workers())] if options['compare_fanout'] else [(None, None)]
+        sample = bench.Sample()
+        results = {}
+        self.stdout.write('  '.join(['route'.ljust(24)] + [column.rjust(9) for column in COLUMNS]))
+        for name in selected:
+            for mode, workers in modes:
+                key = f'{name}[{mode}]' if mode else name
+                with override_settings(**({} if workers is None else {'FANOUT_WORKERS': workers})):
+                    try:
+                        result = bench.run(routes[name], sample, options['clients'], options['requests'],
+                                           options['cold'])
+                    except (ValueError, IndexError) as e:
+                        raise CommandError(f'{name}: {e or "nothing to request; use --seed"}')
+                results[key] = result
+                self.stdout.write('  '.join([key.ljust(24)] + [str(result[c]).rjust(9) for c in COLUMNS]))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'options': {k: options[k] for k in ('clients', 'requests', 'cold')},
+                           'routes': results}, f, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['routes']
+            regressions = bench.compare(baseline, results, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from ShopSphere import recommendations
+
+
+class Command(BaseCommand):
+    help = ('Build the product recommendation matrix from the carted-together counts. '
+            'Run it nightly or so; pairs counted in between are picked up without it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=recommendations.TOP_K,
+                            help='Neighbours kept per product.')
+        parser.add_argument('--recount', action='store_true',
+                            help="Reset the counts from the carts' current lines first.")
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            pairs = recommendations.recount()
+            self.stdout.write(f'Counted {pairs} product pairs in current carts.')
+        matrix = recommendations.build(top_k=options['top_k'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote recommendations for {len(matrix)} products to {recommendations.recommendations_file()}.'))
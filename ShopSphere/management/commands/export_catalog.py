@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ShopSphere.exporter import EXPORTS, FORMATS, export
+
+
+class Command(BaseCommand):
+    help = ('Stream products, categories or pages out to a CSV or JSONL file, one chunk of rows '
+            'at a time. A path ending in .gz is gzipped as it is written.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=list(EXPORTS))
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Output format; guessed from the file extension if omitted.')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Rows fetched from the database and encoded at a time.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        path = options['path']
+        compress = path.endswith('.gz')
+        stem = path[:-3] if compress else path
+        fmt = options['format'] or ('jsonl' if stem.endswith(('.jsonl', '.ndjson')) else 'csv')
+
+        started = time.monotonic()
+        written = 0
+        with open(path, 'wb') as f:
+            for chunk in export(options['name'], fmt, compress, options['chunk_size']):
+                f.write(chunk)
+                written += len(chunk)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {options["name"]} to {path} ({written} bytes) in {elapsed:.1f}s.'))
@@ -0,0 +1,78 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ShopSphere.importer import InvalidRow, chunked, clean_row, read_rows, upsert_products
+
+
+class Command(BaseCommand):
+    help = ('Stream products from a CSV or JSONL file into the catalog, upserting on '
+            '(category, name) one chunk at a time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Input format; guessed from the file extension if omitted.')
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Rows read, validated and committed per transaction.')
+        parser.add_argument('--checkpoint',
+                            help='File recording how many rows have been committed, so an '
+                                 'interrupted import resumes where it stopped.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore an existing checkpoint and start from the first row.')
+
+    def _load_checkpoint(self, options):
+        path = options['checkpoint']
+        if not path or options['restart'] or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('source') != os.path.abspath(options['path']):
+            raise CommandError(f'{path} is a checkpoint for {checkpoint.get("source")}; '
+                               f'use --restart to discard it.')
+        return checkpoint['rows']
+
+    def _save_checkpoint(self, options, rows):
+        path = options['checkpoint']
+        if path:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'source': os.path.abspath(options['path']), 'rows': rows}, f)
+            os.replace(path + '.tmp', path)
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        done = self._load_checkpoint(options)
+        if done:
+            self.stdout.write(f'Resuming after row {done}.')
+
+        created = updated = skipped = 0
+        started = time.monotonic()
+        rows = read_rows(options['path'], options['format'], skip=done)
+        for chunk in chunked(rows, options['chunk_size']):
+            cleaned = []
+            for number, row in enumerate(chunk, start=done + 1):
+                try:
+                    cleaned.append(clean_row(row))
+                except InvalidRow as e:
+                    skipped += 1
+                    self.stderr.write(f'Skipping row {number}: {e}')
+            chunk_created, chunk_updated = upsert_products(cleaned)
+            created += chunk_created
+            updated += chunk_updated
+            done += len(chunk)
+            self._save_checkpoint(options, done)
+
+            elapsed = time.monotonic() - started
+            rate = (created + updated + skipped) / elapsed if elapsed else 0
+            self.stdout.write(f'{done} rows, {rate:.0f} rows/sec')
+
+        if options['checkpoint'] and os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
+        elapsed = time.monotonic() - started
+        rate = (created + updated + skipped) / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {created} new and {updated} updated products, skipped {skipped} '
+            f'invalid rows in {elapsed:.1f}s ({rate:.0f} rows/sec).'))
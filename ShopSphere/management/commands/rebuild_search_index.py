@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ShopSphere import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index from the product table.'
+
+    def handle(self, *args, **options):
+        search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {type(search.get_index()).__name__}.'))
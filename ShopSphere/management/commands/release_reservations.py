@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ShopSphere import inventory
+
+
+class Command(BaseCommand):
+    help = 'Return the stock of expired cart reservations. Run it every minute or so from cron.'
+
+    def handle(self, *args, **options):
+        released = inventory.release_expired()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} reserved units back into stock.'))
@@ -0,0 +1,46 @@
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ShopSphere import tasks
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of processes working through the queued background tasks until interrupted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=getattr(settings, 'TASK_WORKERS', 2),
+                            help='Worker processes to run (default: TASK_WORKERS).')
+        parser.add_argument('--batch', type=int, default=10, help='Tasks each worker claims at a time.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds a worker sleeps when no task is due.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Run the tasks due now in this process, then exit.')
+
+    def handle(self, *args, **options):
+        if options['burst']:
+            ran = tasks.run_pending(tasks.worker_name(), options['batch'])
+            self.stdout.write(self.style.SUCCESS(f'Ran {ran} tasks.'))
+            return
+
+        # Forked workers must open their own connections, not share this one's.
+        connections.close_all()
+        workers = [multiprocessing.Process(target=tasks.run_worker, args=(options['batch'], options['poll_interval']),
+                                           name=f'task-worker-{i}')
+                   for i in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f'Started {len(workers)} task workers.')
+
+        def stop(signum, frame):
+            # SIGTERM: each worker finishes the task in hand, then exits.
+            for worker in workers:
+                worker.terminate()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for worker in workers:
+            worker.join()
+        self.stdout.write(self.style.SUCCESS('Task workers stopped.'))
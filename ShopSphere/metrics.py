@@ -0,0 +1,65 @@
+"""Prometheus text exposition of ShopSphere's internal counters."""
+from collections import defaultdict
+
+from .caching import page_cache_stats
+from .instrumentation import stats as view_stats
+from .tasks import stats as task_stats
+
+# (metric, field of the per-view totals, help text) for the sampled request profiles.
+VIEW_METRICS = (
+    ('shopsphere_view_requests_total', 'requests', 'Sampled requests by view.'),
+    ('shopsphere_view_seconds_total', 'seconds', 'Time spent answering sampled requests, by view.'),
+    ('shopsphere_view_queries_total', 'queries', 'SQL queries run by sampled requests, by view.'),
+    ('shopsphere_view_sql_seconds_total', 'sql_seconds', 'Time spent in SQL by sampled requests, by view.'),
+    ('shopsphere_view_template_seconds_total', 'template_seconds',
+     'Time spent rendering templates by sampled requests, by view.'),
+    ('shopsphere_view_response_bytes_total', 'response_bytes', 'Bytes sent in answer to sampled requests, by view.'),
+)
+
+# (metric, field of the per-task totals, help text) for the background tasks still on record.
+TASK_METRICS = (
+    ('shopsphere_tasks', 'count', 'Background tasks by name and status.'),
+    ('shopsphere_task_attempts', 'attempts', 'Attempts made at background tasks, by name and status.'),
+    ('shopsphere_task_seconds', 'seconds', 'Time spent running background tasks, by name and status.'),
+)
+
+
+def _sample(name, value, labels=None):
+    if labels:
+        label_text = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+        return f'{name}{{{label_text}}} {value}'
+    return f'{name} {value}'
+
+
+def render_metrics():
+    """Return all metrics in the Prometheus text format"""
+    lines = [
+        '# HELP shopsphere_page_cache_requests_total Anonymous page cache lookups by outcome.',
+        '# TYPE shopsphere_page_cache_requests_total counter',
+    ]
+    for outcome, count in page_cache_stats().items():
+        lines.append(_sample('shopsphere_page_cache_requests_total', count, {'outcome': outcome}))
+
+    snapshot = view_stats.snapshot()
+    for name, field, help_text in VIEW_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for view, totals in sorted(snapshot['views'].items()):
+            lines.append(_sample(name, round(totals[field], 6), {'view': view}))
+
+    lines += [
+        '# HELP shopsphere_view_duplicate_queries_total Sampled requests that repeated one query, '
+        'a likely N+1, by view and the line of views.py responsible.',
+        '# TYPE shopsphere_view_duplicate_queries_total counter',
+    ]
+    duplicates = defaultdict(int)
+    for duplicate in snapshot['duplicates']:
+        duplicates[duplicate['view'], duplicate['location']] += duplicate['requests']
+    for (view, location), count in sorted(duplicates.items()):
+        lines.append(_sample('shopsphere_view_duplicate_queries_total', count, {'view': view, 'location': location}))
+
+    rows = task_stats()
+    for name, field, help_text in TASK_METRICS:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+        for row in rows:
+            lines.append(_sample(name, round(row[field], 6), {'task': row['name'], 'status': row['status']}))
+    return '\n'.join(lines) + '\n'
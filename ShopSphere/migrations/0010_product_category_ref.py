@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ShopSphere', '0009_cart_cartitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='category_ref',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='products', to='ShopSphere.Category'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='category',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
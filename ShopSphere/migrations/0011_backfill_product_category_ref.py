@@ -0,0 +1,66 @@
+from django.db import migrations, transaction
+from django.template.defaultfilters import slugify
+
+# Products are linked in primary-key ranges of this size, each in its own short
+# transaction, so the backfill never holds a lock on the whole product table.
+BATCH_SIZE = 1000
+
+
+def _unique_slug(name, taken, max_length=50):
+    base = slugify(name)[:max_length] or 'category'
+    slug, n = base, 1
+    while slug in taken:
+        n += 1
+        suffix = f'-{n}'
+        slug = base[:max_length - len(suffix)] + suffix
+    return slug
+
+
+def backfill_category_ref(apps, schema_editor):
+    Category = apps.get_model('ShopSphere', 'Category')
+    Product = apps.get_model('ShopSphere', 'Product')
+    db = schema_editor.connection.alias
+
+    category_ids = {}
+    taken = set(Category.objects.using(db).values_list('slug', flat=True))
+    names = (Product.objects.using(db)
+             .filter(category_ref__isnull=True).exclude(category='')
+             .order_by().values_list('category', flat=True).distinct())
+    for name in names:
+        category = Category.objects.using(db).filter(name=name).first()
+        if category is None:
+            # Historical models don't run Category.save(), so set the slug here,
+            # suffixed where distinct names slugify alike.
+            category = Category.objects.using(db).create(name=name, slug=_unique_slug(name, taken))
+            taken.add(category.slug)
+        category_ids[name] = category.id
+
+    last_pk = 0
+    while True:
+        batch = list(Product.objects.using(db)
+                     .filter(pk__gt=last_pk, category_ref__isnull=True)
+                     .order_by('pk').values_list('pk', 'category')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+
+        by_category = {}
+        for pk, name in batch:
+            if name in category_ids:
+                by_category.setdefault(category_ids[name], []).append(pk)
+        with transaction.atomic(using=db):
+            for category_id, pks in by_category.items():
+                Product.objects.using(db).filter(pk__in=pks).update(category_ref=category_id)
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own rather than the whole backfill in one transaction.
+    atomic = False
+
+    dependencies = [
+        ('ShopSphere', '0010_product_category_ref'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_category_ref, migrations.RunPython.noop),
+    ]
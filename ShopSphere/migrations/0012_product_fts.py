@@ -0,0 +1,36 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+FTS_TABLE = 'ShopSphere_product_fts'
+
+
+def create_fts_table(apps, schema_editor):
+    # FTS5 only exists on SQLite, and not every SQLite build has it; without
+    # the table ShopSphere.search falls back to its in-process index.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS "{FTS_TABLE}" '
+            f'USING fts5(name, category, description, tokenize="unicode61")')
+    except OperationalError:
+        return
+    schema_editor.execute(
+        f'INSERT INTO "{FTS_TABLE}" (rowid, name, category, description) '
+        f'SELECT id, name, category, description FROM "ShopSphere_product"')
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS "{FTS_TABLE}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ShopSphere', '0011_backfill_product_category_ref'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ShopSphere', '0015_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_digest',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
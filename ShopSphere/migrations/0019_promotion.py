@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ShopSphere', '0018_leaderboard_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Promotion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('kind', models.CharField(choices=[('category', 'Percent off a category'), ('product', 'Percent off a product'), ('threshold', 'Percent off orders over a minimum'), ('bogo', 'Buy some, get some free')], max_length=16)),
+                ('active', models.BooleanField(default=True)),
+                ('starts_at', models.DateTimeField(blank=True, null=True)),
+                ('ends_at', models.DateTimeField(blank=True, null=True)),
+                ('percent_off', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('min_subtotal', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('buy_quantity', models.PositiveIntegerField(default=1)),
+                ('free_quantity', models.PositiveIntegerField(default=1)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='promotions', to='ShopSphere.Category')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='promotions', to='ShopSphere.Product')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ShopSphere', '0020_task'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='page',
+            name='title',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='name',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='promotion',
+            name='name',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='name',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+    ]
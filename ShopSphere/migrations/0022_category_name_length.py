@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ShopSphere', '0021_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='category',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+    ]
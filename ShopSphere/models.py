@@ -1,18 +1,63 @@
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.template.defaultfilters import slugify
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+def unique_slug(name, taken, max_length=50):
+    """slugify(name), suffixed -2, -3, ... while it is one of the taken slugs"""
+    base = slugify(name)[:max_length] or 'category'
+    slug, n = base, 1
+    while slug in taken:
+        n += 1
+        suffix = f'-{n}'
+        slug = base[:max_length - len(suffix)] + suffix
+    return slug
+
 class Category(models.Model):
     NAME_MAX_LENGTH = 128
+    SLUG_MAX_LENGTH = 50
 
     name = models.CharField(max_length=NAME_MAX_LENGTH, unique=True)
     views = models.IntegerField(default=0)
-    likes = models.IntegerField(default=0)
-    slug = models.SlugField(unique=True)
+    likes = models.IntegerField(default=0, db_index=True)
+    slug = models.SlugField(max_length=SLUG_MAX_LENGTH, unique=True)
+
+    @classmethod
+    def taken_slugs(cls, names, exclude_pk=None):
+        """The slugs in use that a slug for one of names could collide with"""
+        # Suffixed slugs may be cut short, so match on a shorter prefix.
+        prefixes = {slugify(name)[:cls.SLUG_MAX_LENGTH - 10] or 'category' for name in names}
+        condition = models.Q()
+        for prefix in prefixes:
+            condition |= models.Q(slug__startswith=prefix)
+        return set(cls.objects.filter(condition).exclude(pk=exclude_pk).values_list('slug', flat=True))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'name' in field_names:
+            instance._loaded_name = instance.name
+        return instance
 
     def save(self, *args, **kwargs):
-        self.slug = slugify(self.name)
+        if not self.slug or self.name != getattr(self, '_loaded_name', None):
+            # Distinct names can slugify alike ('Home & Kitchen', 'Home Kitchen').
+            self.slug = unique_slug(self.name, self.taken_slugs([self.name], exclude_pk=self.pk),
+                                    self.SLUG_MAX_LENGTH)
         super(Category, self).save(*args, **kwargs)
+        old_name = getattr(self, '_loaded_name', None)
+        if old_name is not None and old_name != self.name:
+            # Products name their category too; rename it there, in one UPDATE.
+            from . import search
+            from .caching import bump_generation
+            self.products.update(category=self.name)
+            search.index_products(self.products.only('id', 'name', 'category', 'description'))
+            bump_generation('products')
+            bump_generation('products:bulk')
+        self._loaded_name = self.name
 
     class Meta:
         verbose_name_plural = 'Categories'
@@ -25,9 +70,9 @@ class Page(models.Model):
     URL_MAX_LENGTH = 200
 
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
-    title = models.CharField(max_length=TITLE_MAX_LENGTH)
+    title = models.CharField(max_length=TITLE_MAX_LENGTH, db_index=True)
     url = models.URLField()
-    views = models.IntegerField(default=0)
+    views = models.IntegerField(default=0, db_index=True)
 
     def __str__(self):
         return self.title
@@ -42,35 +87,211 @@ class UserProfile(models.Model):
 
    
 class Product(models.Model):
-   category = models.CharField(max_length=255)
-   name = models.CharField(max_length=255)
+   category = models.CharField(max_length=Category.NAME_MAX_LENGTH, db_index=True)
+   # Normalised link to the Category the name above refers to; kept in step by save()
+   category_ref = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True,
+                                    related_name='products')
+   name = models.CharField(max_length=255, db_index=True)
    description = models.TextField()
    price = models.DecimalField(max_digits=10, decimal_places=2)
    stock = models.PositiveIntegerField()
    image = models.ImageField(upload_to='product_images/', blank=True, null=True)
+   # Content hash naming the resized variants of image; blank until they are generated.
+   image_digest = models.CharField(max_length=16, blank=True, default='')
+
+   class Meta:
+       # (category, name) is the natural key the catalog importer upserts on.
+       indexes = [models.Index(fields=['category', 'name'], name='product_natural_key')]
+
+   @classmethod
+   def from_db(cls, db, field_names, values):
+       instance = super().from_db(db, field_names, values)
+       if 'image' in field_names:
+           instance._loaded_image = instance.image.name
+       if 'category' in field_names:
+           instance._loaded_category = instance.category
+       if 'price' in field_names:
+           instance._loaded_price = instance.price
+       return instance
+
+   def save(self, *args, **kwargs):
+       if self.image.name != getattr(self, '_loaded_image', None):
+           # A new image needs new variants.
+           self.image_digest = ''
+       if not self.category:
+           self.category_ref = None
+       elif self.category_ref_id is None or self.category != getattr(self, '_loaded_category', None):
+           # Only looked up when the name changed, not on every save.
+           self.category_ref = Category.objects.get_or_create(name=self.category)[0]
+       # Carts holding it are repriced if its price or category (which promotions go by) changed.
+       reprice = not self._state.adding and (self.price != getattr(self, '_loaded_price', None) or
+                                             self.category != getattr(self, '_loaded_category', None))
+       super(Product, self).save(*args, **kwargs)
+       if reprice:
+           from .caching import bump_generation
+           from .pricing import PRICE_TAG
+           bump_generation(PRICE_TAG)
+       self._loaded_image = self.image.name
+       self._loaded_category = self.category
+       self._loaded_price = self.price
+
    def __str__(self):
        return self.name
    
 
+CENT = Decimal('0.01')
+
+
 class Cart(models.Model):
-   user = models.OneToOneField(User, on_delete=models.CASCADE)
+   # Carts of anonymous visitors have no user; the session holds their id.
+   user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True)
    created_at = models.DateTimeField(auto_now_add=True)
+
+   def totals(self):
+       """Total quantity and price of the cart, worked out once per instance"""
+       if getattr(self, '_totals', None) is None:
+           from .pricing import price_cart, price_rows
+           prefetched = getattr(self, '_prefetched_objects_cache', {}).get('items')
+           if prefetched is not None:
+               # Items (and their products) are already loaded, so price them here.
+               priced = price_rows((item.product_id, item.quantity, item.product.price, item.product.category_ref_id)
+                                   for item in prefetched)
+           else:
+               priced = price_cart(self)
+           self._totals = priced.totals()
+       return self._totals
+
+   def refresh_totals(self):
+       """Forget memoized totals after the cart's items change"""
+       self._totals = None
+
    def total_price(self):
        """Calculate total price of items in the cart"""
-       return sum(item.total_price() for item in self.items.all())
+       return self.totals()['price']
+
    def total_items(self):
        """Total quantity of items in the cart"""
-       return sum(item.quantity for item in self.items.all())
+       return self.totals()['items']
    
    
 class CartItem(models.Model):
    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name="items")
    product = models.ForeignKey(Product, on_delete=models.CASCADE)
    quantity = models.PositiveIntegerField(default=1)
+
+   class Meta:
+       unique_together = ('cart', 'product')
+
    def total_price(self):
        """Calculate total price of this item"""
        return self.product.price * self.quantity
    
+class StockReservation(models.Model):
+   """Stock taken off a product for a cart, returned to stock if it expires"""
+   product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+   cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+   quantity = models.PositiveIntegerField()
+   expires_at = models.DateTimeField(db_index=True)
+
+
+class ProductPair(models.Model):
+   """How many carts have held both products; product has the lower id"""
+   product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+   other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+   count = models.PositiveIntegerField(default=0)
+   updated = models.DateTimeField(db_index=True)
+
+   class Meta:
+       unique_together = ('product', 'other')
+
+
+class Promotion(models.Model):
+   """A discount: percent off a category's or a product's lines, buy N get M free, or percent off big orders"""
+   CATEGORY = 'category'
+   PRODUCT = 'product'
+   THRESHOLD = 'threshold'
+   BOGO = 'bogo'
+   KINDS = (
+       (CATEGORY, 'Percent off a category'),
+       (PRODUCT, 'Percent off a product'),
+       (THRESHOLD, 'Percent off orders over a minimum'),
+       (BOGO, 'Buy some, get some free'),
+   )
+
+   name = models.CharField(max_length=128, db_index=True)
+   kind = models.CharField(max_length=16, choices=KINDS)
+   active = models.BooleanField(default=True)
+   starts_at = models.DateTimeField(null=True, blank=True)
+   ends_at = models.DateTimeField(null=True, blank=True)
+   # What a CATEGORY/PRODUCT/BOGO promotion applies to; BOGO takes either.
+   category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True,
+                                related_name='promotions')
+   product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True,
+                               related_name='promotions')
+   percent_off = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+   min_subtotal = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+   buy_quantity = models.PositiveIntegerField(default=1)
+   free_quantity = models.PositiveIntegerField(default=1)
+
+   def clean(self):
+       if self.kind == self.CATEGORY and self.category_id is None:
+           raise ValidationError({'category': 'Choose the category on sale.'})
+       if self.kind == self.PRODUCT and self.product_id is None:
+           raise ValidationError({'product': 'Choose the product on sale.'})
+       if self.kind == self.BOGO and (self.category_id is None) == (self.product_id is None):
+           raise ValidationError('Choose either a product or a category.')
+       if self.kind == self.BOGO and (self.buy_quantity < 1 or self.free_quantity < 1):
+           raise ValidationError('Buy and free quantities must both be at least 1.')
+       if self.kind == self.THRESHOLD and self.min_subtotal is None:
+           raise ValidationError({'min_subtotal': 'Set the order total the discount starts at.'})
+       if self.kind != self.BOGO and not 0 < self.percent_off <= 100:
+           raise ValidationError({'percent_off': 'Enter a percentage above 0 and up to 100.'})
+
+   def is_live(self, now):
+       return (self.active and (self.starts_at is None or self.starts_at <= now) and
+               (self.ends_at is None or now < self.ends_at))
+
+   def __str__(self):
+       return self.name
+
+
+class Task(models.Model):
+   """A call queued for the run_workers processes (see ShopSphere.tasks)"""
+   QUEUED = 'queued'
+   RUNNING = 'running'
+   DONE = 'done'
+   FAILED = 'failed'
+   STATUSES = (
+       (QUEUED, 'Queued'),
+       (RUNNING, 'Running'),
+       (DONE, 'Done'),
+       (FAILED, 'Failed'),
+   )
+
+   name = models.CharField(max_length=128, db_index=True)
+   # JSON list of the positional arguments.
+   args = models.TextField(default='[]')
+   # Enqueueing again under a key already used returns the existing task.
+   key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+   status = models.CharField(max_length=8, choices=STATUSES, default=QUEUED)
+   attempts = models.PositiveIntegerField(default=0)
+   max_attempts = models.PositiveIntegerField(default=5)
+   run_at = models.DateTimeField(default=timezone.now)
+   locked_by = models.CharField(max_length=64, blank=True, default='')
+   locked_at = models.DateTimeField(null=True, blank=True)
+   last_error = models.TextField(blank=True, default='')
+   created_at = models.DateTimeField(auto_now_add=True)
+   finished_at = models.DateTimeField(null=True, blank=True)
+   # Time spent running it, over all its attempts.
+   seconds = models.FloatField(default=0)
+
+   class Meta:
+       indexes = [models.Index(fields=['status', 'run_at'], name='task_due')]
+
+   def __str__(self):
+       return f'{self.name} #{self.pk}'
+
+
 #class UserProfile(models.Model):
  #  user = models.OneToOneField(User, on_delete=models.CASCADE)
   # address = models.TextField(blank=True, null=True)
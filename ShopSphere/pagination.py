@@ -0,0 +1,91 @@
+from django.conf import settings
+
+# Default and maximum number of rows on a page. The maximum caps what a client
+# can ask for with ?page_size= so a single request can never pull the whole table.
+DEFAULT_PAGE_SIZE = getattr(settings, 'SHOPSPHERE_PAGE_SIZE', 20)
+MAX_PAGE_SIZE = getattr(settings, 'SHOPSPHERE_MAX_PAGE_SIZE', 100)
+
+
+def _positive_int(value):
+    """Return value as a positive int, or None if it is missing or invalid"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+class KeysetPage:
+    """One page of a keyset (seek) paginated queryset"""
+
+    def __init__(self, object_list, page_size, params, next_cursor=None, prev_cursor=None):
+        self.object_list = object_list
+        self.page_size = page_size
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self._params = params
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def _query(self, **cursor):
+        params = self._params.copy()
+        for name in ('after', 'before'):
+            params.pop(name, None)
+        params.update(cursor)
+        return params.urlencode()
+
+    @property
+    def next_query(self):
+        """Query string for the next page, keeping any other GET parameters"""
+        return self._query(after=self.next_cursor) if self.has_next else ''
+
+    @property
+    def previous_query(self):
+        """Query string for the previous page, keeping any other GET parameters"""
+        return self._query(before=self.prev_cursor) if self.has_previous else ''
+
+
+def paginate_by_key(queryset, request, key='id', page_size=None):
+    """Paginate queryset on a unique, indexed column instead of OFFSET.
+
+    The cursor is the last (or first) key value seen, passed back as
+    ?after=<key> or ?before=<key>, so every page is a range scan on the
+    index of `key` and costs the same no matter how deep into the table it is.
+    """
+    size = _positive_int(request.GET.get('page_size')) or page_size or DEFAULT_PAGE_SIZE
+    size = min(size, MAX_PAGE_SIZE)
+    after = _positive_int(request.GET.get('after'))
+    before = _positive_int(request.GET.get('before'))
+
+    if before is not None:
+        # Walk backwards from the cursor, then flip the rows into display order.
+        rows = list(queryset.filter(**{key + '__lt': before}).order_by('-' + key)[:size + 1])
+        more = len(rows) > size
+        rows = rows[:size][::-1]
+        next_cursor = getattr(rows[-1], key) if rows else None
+        prev_cursor = getattr(rows[0], key) if rows and more else None
+    else:
+        if after is not None:
+            queryset = queryset.filter(**{key + '__gt': after})
+        rows = list(queryset.order_by(key)[:size + 1])
+        more = len(rows) > size
+        rows = rows[:size]
+        next_cursor = getattr(rows[-1], key) if rows and more else None
+        prev_cursor = getattr(rows[0], key) if rows and after is not None else None
+
+    params = request.GET.copy()
+    if size != (page_size or DEFAULT_PAGE_SIZE):
+        params['page_size'] = size
+    return KeysetPage(rows, size, params, next_cursor=next_cursor, prev_cursor=prev_cursor)
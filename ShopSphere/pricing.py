@@ -0,0 +1,134 @@
+"""Cart pricing in integer pennies.
+
+A cart's lines are held as parallel arrays of product ids, category ids,
+quantities and unit prices in minor units (pennies), so line totals and the subtotal are
+computed in one pass over machine integers, exactly, with no float or
+per-line Decimal arithmetic. Rules named in PRICING_RULES (taxes,
+discounts) then each see the whole priced cart at once and return
+adjustments to it.
+
+A priced cart is cached under its cart's version: the generation of the
+cart's tag, bumped by everything that changes its lines (see cart_changed),
+the generation of PRICE_TAG, bumped only when a product's price or category
+changes or a product is deleted, and those a rule
+names through its price_tags() function, bumped when the rule changes. So
+rendering a cart whose lines haven't changed prices nothing and queries
+nothing.
+"""
+from array import array
+from decimal import ROUND_HALF_UP, Decimal
+from operator import mul
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+# A module import: caching and cart import each other through this module.
+from . import caching
+from .models import CENT
+
+# What else a cart's prices depend on: the prices and categories of products,
+# changed one at a time, in bulk or by an import. Not 'products', which every
+# product save bumps.
+PRICE_TAG = 'prices'
+PRICING_TIMEOUT = 60 * 60
+
+
+def to_minor(amount):
+    """Decimal (or str) amount in pennies"""
+    return int((Decimal(amount) / CENT).to_integral_value(ROUND_HALF_UP))
+
+
+def from_minor(pennies):
+    return (Decimal(pennies) * CENT).quantize(CENT)
+
+
+def cart_tag(cart_id=None, user_id=None):
+    """The tag versioning a cart, named by its owner where it has one"""
+    return f'cart:user:{user_id}' if user_id else f'cart:{cart_id}'
+
+
+def cart_changed(cart):
+    """Move cart on to a new version after its lines change"""
+    tag = cart_tag(cart.pk, cart.user_id)
+    caching.bump_generation(tag)
+    # Again once the change is committed, in case another request priced the
+    # old lines under the new version in the meantime.
+    transaction.on_commit(lambda: caching.bump_generation(tag))
+
+
+def pricing_rules():
+    return [import_string(path) for path in getattr(settings, 'PRICING_RULES', [])]
+
+
+class PricedCart:
+    """The lines of a cart, their totals, and the adjustments of the pricing rules"""
+
+    def __init__(self, rows, rules=()):
+        """rows are (product id, quantity, unit price, category id or None) for each line"""
+        self.product_ids = array('q')
+        self.category_ids = array('q')
+        self.quantities = array('q')
+        self.unit_prices = array('q')
+        for product_id, quantity, price, category_id in rows:
+            self.product_ids.append(product_id)
+            self.category_ids.append(category_id or 0)
+            self.quantities.append(quantity)
+            self.unit_prices.append(to_minor(price))
+        self.line_totals = array('q', map(mul, self.quantities, self.unit_prices))
+        self.items = sum(self.quantities)
+        self.subtotal = sum(self.line_totals)
+        # (label, pennies) pairs; discounts are negative.
+        self.adjustments = []
+        for rule in rules:
+            self.adjustments.extend(rule(self))
+        self.total = max(0, self.subtotal + sum(amount for _, amount in self.adjustments))
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    @property
+    def subtotal_price(self):
+        return from_minor(self.subtotal)
+
+    @property
+    def total_price(self):
+        return from_minor(self.total)
+
+    @property
+    def adjustment_prices(self):
+        return [(label, from_minor(amount)) for label, amount in self.adjustments]
+
+    def line_price(self, product_id):
+        """Total of the cart's line of product_id, before adjustments"""
+        return from_minor(self.line_totals[self.product_ids.index(product_id)])
+
+    def totals(self):
+        return {'items': self.items, 'price': self.total_price}
+
+
+def price_rows(rows):
+    return PricedCart(rows, pricing_rules())
+
+
+def _rule_tags(rules):
+    return [tag for rule in rules if hasattr(rule, 'price_tags') for tag in rule.price_tags()]
+
+
+def price_lines(tag, lines):
+    """The priced cart of a CartItem queryset, cached under tag's version"""
+    rules = pricing_rules()
+    tags = [tag, PRICE_TAG] + _rule_tags(rules)
+    version = ':'.join(str(generation) for generation in caching.get_generations(tags))
+    key = f'ShopSphere:pricing:{tag}:{version}'
+    priced = cache.get(key)
+    if priced is None:
+        rows = lines.values_list('product_id', 'quantity', 'product__price', 'product__category_ref_id')
+        priced = PricedCart(rows, rules)
+        cache.set(key, priced, PRICING_TIMEOUT)
+    return priced
+
+
+def price_cart(cart):
+    return price_lines(cart_tag(cart.pk, cart.user_id), cart.items.all())
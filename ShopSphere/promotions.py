@@ -0,0 +1,128 @@
+"""Promotions, applied to priced carts (a rule in PRICING_RULES).
+
+The live promotions are compiled into an index: line promotions keyed by
+product id and by category id, and the order-total thresholds. Applying
+them looks each line up in the two dicts, so pricing a cart costs one pass
+over its lines however many promotions are running. Each line gets the
+single best promotion that covers it; then the best threshold it reaches is
+taken off what's left of the order.
+
+The index is cached under the 'promotions' generation, which saving or
+deleting a Promotion bumps. It also records when the next promotion starts
+or ends; the first lookup after that time bumps the generation too, so the
+index and every cart priced with it are rebuilt. Like priced carts, it is
+kept for at most PRICING_TIMEOUT seconds, so a process whose cache misses
+another's bump still picks up the change.
+"""
+import time
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .caching import bump_generation, get_generation
+from .models import Promotion
+from .pricing import PRICING_TIMEOUT, to_minor
+
+TAG = 'promotions'
+
+
+def _basis_points(percent):
+    return int(percent * 100)
+
+
+def _percent_of(pennies, basis_points):
+    # Rounded half up, in integers.
+    return (pennies * basis_points + 5000) // 10000
+
+
+class CompiledPromotions:
+    """The promotions live at one moment, indexed for pricing"""
+
+    def __init__(self, promotions, now):
+        self.by_product = defaultdict(list)
+        self.by_category = defaultdict(list)
+        self.thresholds = []
+        # When the set of live promotions next changes, as a timestamp.
+        self.expires = None
+        for promotion in promotions:
+            for moment in (promotion.starts_at, promotion.ends_at):
+                if moment is not None and moment > now:
+                    self.expires = min(self.expires or moment.timestamp(), moment.timestamp())
+            if not promotion.is_live(now):
+                continue
+            if promotion.kind == Promotion.THRESHOLD:
+                self.thresholds.append((_basis_points(promotion.percent_off), to_minor(promotion.min_subtotal),
+                                        promotion.name))
+                continue
+            if promotion.kind == Promotion.BOGO:
+                rule = ('bogo', promotion.buy_quantity, promotion.free_quantity, promotion.name)
+            else:
+                rule = ('percent', _basis_points(promotion.percent_off), None, promotion.name)
+            if promotion.product_id is not None:
+                self.by_product[promotion.product_id].append(rule)
+            else:
+                self.by_category[promotion.category_id].append(rule)
+        self.by_product = dict(self.by_product)
+        self.by_category = dict(self.by_category)
+
+    def _line_discount(self, rule, quantity, unit_price, line_total):
+        kind, a, b, _ = rule
+        if kind == 'percent':
+            return _percent_of(line_total, a)
+        # Buy a, get b free: every a + b units, b of them cost nothing.
+        return quantity // (a + b) * b * unit_price
+
+    def apply(self, priced):
+        """Adjustments to a PricedCart, one per promotion used, as (name, -pennies)"""
+        discounts = {}
+        for i, product_id in enumerate(priced.product_ids):
+            rules = self.by_product.get(product_id, []) + self.by_category.get(priced.category_ids[i], [])
+            if not rules:
+                continue
+            quantity, unit_price, line_total = priced.quantities[i], priced.unit_prices[i], priced.line_totals[i]
+            amount, rule = max((self._line_discount(rule, quantity, unit_price, line_total), rule) for rule in rules)
+            if amount:
+                discounts[rule[3]] = discounts.get(rule[3], 0) + min(amount, line_total)
+
+        remaining = priced.subtotal - sum(discounts.values())
+        reached = [(_percent_of(remaining, bp), name) for bp, minimum, name in self.thresholds if remaining >= minimum]
+        if reached:
+            amount, name = max(reached)
+            discounts[name] = discounts.get(name, 0) + amount
+        return [(name, -amount) for name, amount in discounts.items() if amount]
+
+
+def _key():
+    return f'ShopSphere:promotions:{get_generation(TAG)}'
+
+
+def compiled():
+    """The index of the live promotions, rebuilt after promotions change or one starts or ends"""
+    key = _key()
+    index = cache.get(key)
+    if index is not None and index.expires is not None and time.time() >= index.expires:
+        # A promotion has started or ended since the index was built.
+        bump_generation(TAG)
+        key, index = _key(), None
+    if index is None:
+        now = timezone.now()
+        # Promotions over for good can never go live again, so they're not even read.
+        promotions = Promotion.objects.filter(active=True).exclude(ends_at__lte=now)
+        index = CompiledPromotions(promotions, now)
+        cache.set(key, index, PRICING_TIMEOUT)
+    return index
+
+
+def apply(priced):
+    """The pricing rule: the live promotions' discounts on a priced cart"""
+    return compiled().apply(priced)
+
+
+def price_tags():
+    # Checks the index is current, so carts priced before a promotion started or ended are repriced.
+    compiled()
+    return [TAG]
+
+
+apply.price_tags = price_tags
@@ -0,0 +1,226 @@
+"""Item-to-item recommendations from products carted together.
+
+ProductPair counts, for each pair of products, the carts that have held both.
+CartService.add bumps it as lines are added, so it keeps its history after
+checkout empties the carts. The build_recommendations command turns it into
+a compact matrix, each product's TOP_K most co-carted products in flat
+arrays (CSR layout), and writes that to RECOMMENDATIONS_FILE.
+
+Each process loads the file once and answers lookups from memory. Pairs
+counted since the file was built are polled from ProductPair at most every
+RECOMMENDATIONS_REFRESH seconds and laid over it, so new carts show up
+without waiting for a rebuild.
+"""
+import heapq
+import os
+import pickle
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import combinations, groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import CartItem, Product, ProductPair
+
+TOP_K = getattr(settings, 'RECOMMENDATIONS_TOP_K', 50)
+
+
+def recommendations_file():
+    return getattr(settings, 'RECOMMENDATIONS_FILE', os.path.join(settings.BASE_DIR, 'recommendations.bin'))
+
+
+def refresh_interval():
+    return getattr(settings, 'RECOMMENDATIONS_REFRESH', 60)
+
+
+class CoOccurrenceMatrix:
+    """Each product's most co-carted products, best first.
+
+    ids is sorted; the neighbours of ids[i] and their counts are
+    neighbours[indptr[i]:indptr[i + 1]] and counts[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, ids=None, indptr=None, neighbours=None, counts=None, built_at=None):
+        self.ids = ids or array('q')
+        self.indptr = indptr or array('q', [0])
+        self.neighbours = neighbours or array('q')
+        self.counts = counts or array('q')
+        self.built_at = built_at
+
+    @classmethod
+    def build(cls, pairs, top_k=TOP_K, built_at=None):
+        """Build from (product id, other id, count) triples, each pair given once"""
+        rows = defaultdict(list)
+        for a, b, count in pairs:
+            for row, other in ((a, b), (b, a)):
+                # A min-heap of the best top_k so far; ties go to the lower id.
+                heap, entry = rows[row], (count, -other)
+                if len(heap) < top_k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+        matrix = cls(built_at=built_at)
+        for product_id in sorted(rows):
+            matrix.ids.append(product_id)
+            for count, other in sorted(rows[product_id], reverse=True):
+                matrix.neighbours.append(-other)
+                matrix.counts.append(count)
+            matrix.indptr.append(len(matrix.neighbours))
+        return matrix
+
+    def row(self, product_id):
+        """(other product id, count) pairs for product_id, best first"""
+        i = bisect_left(self.ids, product_id)
+        if i == len(self.ids) or self.ids[i] != product_id:
+            return []
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return list(zip(self.neighbours[start:end], self.counts[start:end]))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, path):
+        data = {'ids': self.ids, 'indptr': self.indptr, 'neighbours': self.neighbours,
+                'counts': self.counts, 'built_at': self.built_at}
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Swapped in whole so a process loading it never sees half a file.
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(**pickle.load(f))
+
+
+class Recommender:
+    """The matrix as loaded in this process, plus the pair counts changed since it was built.
+
+    Until a matrix has been built, every ProductPair row is polled into the
+    overlay instead.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._matrix = CoOccurrenceMatrix()
+        self._mtime = None
+        # product id -> {other id: count}; replaced, never mutated, so readers need no lock.
+        self._overlay = {}
+        self._since = None
+        self._checked = None
+
+    def _refresh(self):
+        if self._checked is not None and time.monotonic() - self._checked < refresh_interval():
+            return
+        # If another thread is already refreshing, answer from what's loaded.
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            path = self.path or recommendations_file()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self._mtime:
+                self._matrix = CoOccurrenceMatrix.load(path) if mtime else CoOccurrenceMatrix()
+                self._mtime = mtime
+                self._overlay = {}
+                self._since = self._matrix.built_at
+            self._poll()
+            self._checked = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def _poll(self):
+        pairs = ProductPair.objects.all()
+        if self._since is not None:
+            pairs = pairs.filter(updated__gte=self._since)
+        changed = defaultdict(dict)
+        for a, b, count, updated in pairs.values_list('product_id', 'other_id', 'count', 'updated').iterator():
+            changed[a][b] = changed[b][a] = count
+            if self._since is None or updated > self._since:
+                self._since = updated
+        if changed:
+            overlay = dict(self._overlay)
+            for product_id, counts in changed.items():
+                overlay[product_id] = {**overlay.get(product_id, {}), **counts}
+            self._overlay = overlay
+
+    def scores(self, product_ids, limit=10):
+        """The limit best (product id, score) pairs for someone with product_ids in their cart.
+
+        A product's score is how often it was carted with each of product_ids,
+        summed; product_ids themselves are left out.
+        """
+        self._refresh()
+        matrix, overlay = self._matrix, self._overlay
+        scores = Counter()
+        for product_id in product_ids:
+            row = dict(matrix.row(product_id))
+            row.update(overlay.get(product_id, {}))
+            scores.update(row)
+        for product_id in product_ids:
+            scores.pop(product_id, None)
+        return heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+recommender = Recommender()
+
+
+def recommend(product_ids, limit=10):
+    """Products most often carted with product_ids, best first, fetched in one query"""
+    ids = [product_id for product_id, _ in recommender.scores(product_ids, limit)]
+    products = Product.objects.in_bulk(ids)
+    return [products[product_id] for product_id in ids if product_id in products]
+
+
+def record_line(cart_id, product_id):
+    """Count product_id as carted together with each other product in the cart"""
+    others = list(CartItem.objects.filter(cart_id=cart_id).exclude(product_id=product_id)
+                  .values_list('product_id', flat=True))
+    if not others:
+        return
+    now = timezone.now()
+    pairs = ProductPair.objects.filter(
+        Q(product_id=product_id, other_id__in=[o for o in others if o > product_id]) |
+        Q(other_id=product_id, product_id__in=[o for o in others if o < product_id]))
+    pairs.update(count=F('count') + 1, updated=now)
+    missing = {(min(product_id, o), max(product_id, o)) for o in others} - set(
+        pairs.values_list('product_id', 'other_id'))
+    # A pair created by a concurrent request loses this one count, which the ranking can spare.
+    ProductPair.objects.bulk_create(
+        [ProductPair(product_id=a, other_id=b, count=1, updated=now) for a, b in missing],
+        ignore_conflicts=True)
+
+
+def recount():
+    """Reset ProductPair from the carts' current lines; returns the number of pairs"""
+    counts = Counter()
+    lines = CartItem.objects.order_by('cart_id', 'product_id').values_list('cart_id', 'product_id')
+    for _, group in groupby(lines.iterator(), key=itemgetter(0)):
+        counts.update(combinations([product_id for _, product_id in group], 2))
+    now = timezone.now()
+    with transaction.atomic():
+        ProductPair.objects.all().delete()
+        ProductPair.objects.bulk_create(
+            [ProductPair(product_id=a, other_id=b, count=n, updated=now) for (a, b), n in counts.items()])
+    return len(counts)
+
+
+def build(path=None, top_k=TOP_K):
+    """Write the matrix of the current ProductPair counts to path; returns it"""
+    # Taken before reading, so pairs counted during the build are polled afterwards.
+    built_at = timezone.now()
+    pairs = ProductPair.objects.values_list('product_id', 'other_id', 'count').iterator()
+    matrix = CoOccurrenceMatrix.build(pairs, top_k, built_at)
+    matrix.save(path or recommendations_file())
+    return matrix
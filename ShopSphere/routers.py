@@ -0,0 +1,90 @@
+"""Routing of ORM queries between the primary database and read replicas.
+
+Reads go to one of the DATABASE_REPLICAS aliases and writes to 'default'.
+Replicas lag behind the primary, so once a request writes, the rest of it
+reads from the primary too, and PrimaryPinningMiddleware keeps that client's
+requests on the primary for REPLICA_LAG seconds more, long enough for the
+redirect after a POST to see what it just did. Reads inside a transaction
+also stay on the primary.
+
+The pin is a context variable: each request thread has its own, and work
+handed to another thread with contextvars.copy_context().run keeps it.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'primary_pin'
+
+_pinned = ContextVar('pinned_to_primary', default=False)
+# Set by writes alone, where the pin may also come from the client's cookie.
+_wrote = ContextVar('wrote_to_primary', default=False)
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def replica_lag():
+    return getattr(settings, 'REPLICA_LAG', 5)
+
+
+def is_pinned():
+    return _pinned.get()
+
+
+@contextmanager
+def primary():
+    """Send every query in the block to the primary"""
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        pool = replicas()
+        if not pool or _pinned.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        # Related objects are read from wherever the instance came from.
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return random.choice(pool)
+
+    def db_for_write(self, model, **hints):
+        _pinned.set(True)
+        _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary.
+        pool = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+
+class PrimaryPinningMiddleware:
+    """Scope the pin to one request, and carry it to the client's next requests after a write"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _pinned.set(PIN_COOKIE in request.COOKIES)
+        wrote_token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            # Every write restarts the pin, even one made while the cookie was still set.
+            if _wrote.get() and replicas():
+                response.set_cookie(PIN_COOKIE, '1', max_age=replica_lag(), httponly=True)
+        finally:
+            _wrote.reset(wrote_token)
+            _pinned.reset(token)
+        return response
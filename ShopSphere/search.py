@@ -0,0 +1,276 @@
+"""Full-text product search.
+
+On SQLite the index is an FTS5 virtual table (created by migration 0012) ranked
+with bm25. On any other database, or a SQLite build without FTS5, an in-process
+inverted index is used instead. It is built from the product table on first
+use. Either way the index is kept current by the Product save/delete signals
+in signals.py, so a search never scans the product table itself.
+"""
+import bisect
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.db import connection
+
+from .models import Product
+
+FTS_TABLE = 'ShopSphere_product_fts'
+
+# Relative weight of a match in each indexed column: name, category, description.
+NAME_WEIGHT = 10.0
+CATEGORY_WEIGHT = 5.0
+DESCRIPTION_WEIGHT = 1.0
+
+RESULTS_PER_PAGE = 20
+# Ranked results are paged by position; past this many pages the query should be refined.
+MAX_PAGES = 50
+MAX_QUERY_TERMS = 8
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Split text into lower-case word tokens"""
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def _query_terms(query):
+    return tokenize(query)[:MAX_QUERY_TERMS]
+
+
+class SQLiteFTSIndex:
+    """Search index stored in an FTS5 table next to the product table"""
+
+    def index(self, products):
+        rows = [(p.id, p.name, p.category, p.description) for p in products]
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM "{FTS_TABLE}" WHERE rowid = %s', [(r[0],) for r in rows])
+            cursor.executemany(
+                f'INSERT INTO "{FTS_TABLE}" (rowid, name, category, description) VALUES (%s, %s, %s, %s)',
+                rows)
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM "{FTS_TABLE}" WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM "{FTS_TABLE}"')
+            cursor.execute(
+                f'INSERT INTO "{FTS_TABLE}" (rowid, name, category, description) '
+                f'SELECT id, name, category, description FROM "{Product._meta.db_table}"')
+
+    def _match(self, terms, column=None):
+        # Terms are \w+ tokens, so quoting them is enough to keep FTS5 syntax out.
+        # The last term is treated as a prefix so results update while typing.
+        phrases = [f'"{t}"' for t in terms]
+        phrases[-1] += '*'
+        expression = ' '.join(phrases)
+        return f'{column} : ({expression})' if column else expression
+
+    def search(self, terms, limit, offset):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM "{FTS_TABLE}" WHERE "{FTS_TABLE}" MATCH %s '
+                f'ORDER BY bm25("{FTS_TABLE}", %s, %s, %s), rowid LIMIT %s OFFSET %s',
+                [self._match(terms), NAME_WEIGHT, CATEGORY_WEIGHT, DESCRIPTION_WEIGHT, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+    def suggest(self, terms, limit):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT name FROM "{FTS_TABLE}" WHERE "{FTS_TABLE}" MATCH %s '
+                f'ORDER BY rank LIMIT %s',
+                [self._match(terms, column='name'), limit * 2])
+            names = [row[0] for row in cursor.fetchall()]
+        return list(dict.fromkeys(names))[:limit]
+
+
+class InvertedIndex:
+    """Pure-Python inverted index used when FTS5 is unavailable"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._postings = defaultdict(dict)  # token -> {product id: weighted term frequency}
+        self._doc_tokens = {}  # product id -> tokens it is posted under
+        self._names = {}
+        self._vocabulary = []  # sorted tokens, for prefix lookups
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    rows = Product.objects.values_list('id', 'name', 'category', 'description')
+                    for row in rows.iterator(chunk_size=2000):
+                        self._add(*row)
+                    self._loaded = True
+
+    def _add(self, pk, name, category, description):
+        self._remove(pk)
+        weights = defaultdict(float)
+        for field, weight in ((name, NAME_WEIGHT), (category, CATEGORY_WEIGHT),
+                              (description, DESCRIPTION_WEIGHT)):
+            for token in tokenize(field):
+                weights[token] += weight
+        for token, weight in weights.items():
+            if token not in self._postings:
+                bisect.insort(self._vocabulary, token)
+            self._postings[token][pk] = weight
+        self._doc_tokens[pk] = tuple(weights)
+        self._names[pk] = name
+
+    def _remove(self, pk):
+        for token in self._doc_tokens.pop(pk, ()):
+            postings = self._postings[token]
+            postings.pop(pk, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+        self._names.pop(pk, None)
+
+    def index(self, products):
+        self._ensure_loaded()
+        with self._lock:
+            for p in products:
+                self._add(p.id, p.name, p.category, p.description)
+
+    def remove(self, product_ids):
+        self._ensure_loaded()
+        with self._lock:
+            for pk in product_ids:
+                self._remove(pk)
+
+    def rebuild(self):
+        with self._lock:
+            self._postings.clear()
+            self._doc_tokens.clear()
+            self._names.clear()
+            self._vocabulary.clear()
+            self._loaded = False
+        self._ensure_loaded()
+
+    def _prefix_tokens(self, prefix):
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        end = bisect.bisect_left(self._vocabulary, prefix + '\uffff')
+        return self._vocabulary[start:end]
+
+    def _scores(self, terms):
+        total = len(self._doc_tokens) or 1
+        scores = None
+        for i, term in enumerate(terms):
+            tokens = self._prefix_tokens(term) if i == len(terms) - 1 else [term]
+            term_scores = defaultdict(float)
+            for token in tokens:
+                postings = self._postings.get(token, {})
+                idf = math.log(1 + total / (len(postings) or 1))
+                for pk, weight in postings.items():
+                    term_scores[pk] += weight * idf
+            # Every term has to match, as with FTS5's implicit AND.
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {pk: s + term_scores[pk] for pk, s in scores.items() if pk in term_scores}
+            if not scores:
+                break
+        return scores or {}
+
+    def _ranked(self, scores, count):
+        return heapq.nsmallest(count, scores, key=lambda pk: (-scores[pk], pk))
+
+    def search(self, terms, limit, offset):
+        self._ensure_loaded()
+        with self._lock:
+            scores = self._scores(terms)
+        return self._ranked(scores, offset + limit)[offset:]
+
+    def suggest(self, terms, limit):
+        self._ensure_loaded()
+        with self._lock:
+            scores = self._scores(terms)
+            names = []
+            for pk in self._ranked(scores, limit * 10):
+                # Like the FTS5 backend, only suggest products whose name itself matches.
+                name_tokens = tokenize(self._names[pk])
+                if (all(t in name_tokens for t in terms[:-1])
+                        and any(t.startswith(terms[-1]) for t in name_tokens)):
+                    names.append(self._names[pk])
+        return list(dict.fromkeys(names))[:limit]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _fts_available():
+    if connection.vendor != 'sqlite':
+        return False
+    return FTS_TABLE in connection.introspection.table_names()
+
+
+def get_index():
+    """Return the search index for this process, choosing the backend on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SQLiteFTSIndex() if _fts_available() else InvertedIndex()
+    return _index
+
+
+class SearchResults:
+    """One page of ranked search results"""
+
+    def __init__(self, query, products, page, has_next):
+        self.query = query
+        self.products = products
+        self.page = page
+        self.has_next = has_next
+
+    @property
+    def has_previous(self):
+        return self.page > 1
+
+    @property
+    def next_page(self):
+        return self.page + 1
+
+    @property
+    def previous_page(self):
+        return self.page - 1
+
+
+def search_products(query, page=1, per_page=RESULTS_PER_PAGE):
+    """Return a page of products matching query, best match first"""
+    terms = _query_terms(query)
+    page = max(1, min(page, MAX_PAGES))
+    if not terms:
+        return SearchResults(query, [], page, False)
+    ids = get_index().search(terms, per_page + 1, (page - 1) * per_page)
+    has_next = len(ids) > per_page and page < MAX_PAGES
+    ids = ids[:per_page]
+    products = Product.objects.in_bulk(ids)
+    return SearchResults(query, [products[pk] for pk in ids if pk in products], page, has_next)
+
+
+def suggest(prefix, limit=10):
+    """Return product names to autocomplete a partially typed query"""
+    terms = _query_terms(prefix)
+    if not terms:
+        return []
+    return get_index().suggest(terms, limit)
+
+
+def index_products(products):
+    get_index().index(products)
+
+
+def remove_products(product_ids):
+    get_index().remove(product_ids)
+
+
+def rebuild_index():
+    get_index().rebuild()
@@ -0,0 +1,239 @@
+"""Session store for cart-heavy traffic (SESSION_ENGINE = 'ShopSphere.sessions').
+
+It builds on Django's cached_db store, which reads sessions from the cache
+and falls back to the database, and changes three things:
+
+* A save whose data hashes the same as what was loaded writes nothing. Cart
+  views set the item count on every click, usually to the count it already
+  had.
+* A save that did change something goes to the cache at once, but the
+  database row is only written behind it: changes are buffered in process
+  memory and written SESSION_WRITE_BEHIND seconds after the first of them, a
+  batch at a time in one transaction, like the buffered counters. New
+  sessions are still inserted straight away, so their keys stay unique, and
+  a change to the logged-in user or the cart id is written through at once.
+  An interval of 0 writes every change straight through. Until a change is
+  written, other processes only see it through a cache they share with this
+  one, so only set an interval with a shared cache.
+* Session data is stored signed, compact and compressed where that helps
+  (Django's signing format), instead of as a base64 JSON blob with a hex
+  hash in front. Rows written in the old format are still read.
+
+Expired sessions are deleted in batches of SESSION_PURGE_BATCH, by
+clearsessions or by a background thread started at most every
+SESSION_PURGE_INTERVAL seconds, never while a request waits on it.
+"""
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends import cached_db
+from django.core import signing
+from django.db import DatabaseError, connections, router, transaction
+from django.utils import timezone
+
+from .cart import CART_ID_SESSION_KEY
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'ShopSphere.sessions'
+SALT = 'ShopSphere.sessions'
+# Keys another process must see at once: losing them logs the user out or
+# forgets their cart.
+WRITE_THROUGH_KEYS = (SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY, CART_ID_SESSION_KEY)
+
+
+def write_behind():
+    return getattr(settings, 'SESSION_WRITE_BEHIND', 5)
+
+
+def purge_interval():
+    return getattr(settings, 'SESSION_PURGE_INTERVAL', 60 * 60)
+
+
+def purge_batch():
+    return getattr(settings, 'SESSION_PURGE_BATCH', 1000)
+
+
+class SessionBuffer:
+    """Session rows changed since the last flush, keyed by session key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._shutdown_hook = False
+        self._timer = None
+
+    def write(self, session_key, session_data, expire_date, now=False):
+        """Buffer a session row, or write it and anything pending at once if now is true"""
+        now = now or write_behind() <= 0
+        with self._lock:
+            self._pending[session_key] = (session_data, expire_date)
+            if not self._shutdown_hook:
+                atexit.register(self.flush_on_shutdown)
+                self._shutdown_hook = True
+            if not now and self._timer is None:
+                # Not only at the end of a request: a process that goes idle
+                # would otherwise hold its changes until the next one.
+                self._timer = threading.Timer(write_behind(), self.flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if now:
+            self.flush()
+
+    def get(self, session_key):
+        """The unwritten (session_data, expire_date) of a session, or None"""
+        with self._lock:
+            return self._pending.get(session_key)
+
+    def discard(self, session_key):
+        with self._lock:
+            self._pending.pop(session_key, None)
+
+    def flush_if_due(self):
+        if self._pending and time.monotonic() - self._last_flush >= write_behind():
+            self.flush()
+
+    def flush(self):
+        """Write all pending sessions; returns the number written"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+
+        model = SessionStore.get_model_class()
+        using = router.db_for_write(model)
+        try:
+            with transaction.atomic(using=using):
+                for session_key, (session_data, expire_date) in pending.items():
+                    model.objects.using(using).filter(session_key=session_key).update(
+                        session_data=session_data, expire_date=expire_date)
+        except DatabaseError:
+            # Put back whatever hasn't been replaced since, so the next flush retries it.
+            with self._lock:
+                for session_key, row in pending.items():
+                    self._pending.setdefault(session_key, row)
+            raise
+        return len(pending)
+
+    def flush_on_timer(self):
+        try:
+            self.flush()
+        except DatabaseError:
+            logger.exception('Could not write buffered sessions')
+        finally:
+            # The timer's thread opened its own connections.
+            connections.close_all()
+
+    def flush_on_shutdown(self):
+        try:
+            self.flush()
+        except DatabaseError:
+            logger.exception('Could not write buffered sessions at shutdown')
+
+
+buffer = SessionBuffer()
+
+_purge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-purge')
+_purge_lock = threading.Lock()
+# The first purge waits a whole interval, so short-lived processes never start one.
+_last_purge = time.monotonic()
+
+
+def _purge():
+    try:
+        SessionStore.clear_expired()
+    except DatabaseError:
+        logger.exception('Could not purge expired sessions')
+
+
+def schedule_purge():
+    """Start a background purge of expired sessions if the purge interval has passed"""
+    global _last_purge
+    with _purge_lock:
+        now = time.monotonic()
+        if now - _last_purge < purge_interval():
+            return
+        _last_purge = now
+    _purge_executor.submit(_purge)
+
+
+class SessionStore(cached_db.SessionStore):
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._loaded_digest = None
+        self._loaded_pinned = None
+
+    def _digest(self, data):
+        return hashlib.md5(self.serializer().dumps(data)).hexdigest()
+
+    def _pinned(self, data):
+        return [data.get(key) for key in WRITE_THROUGH_KEYS]
+
+    def encode(self, session_dict):
+        return signing.dumps(session_dict, salt=SALT, serializer=self.serializer, compress=True)
+
+    def decode(self, session_data):
+        try:
+            return signing.loads(session_data, salt=SALT, serializer=self.serializer)
+        except signing.BadSignature:
+            # Written before this store, or tampered with; the old format handles both.
+            return super().decode(session_data)
+
+    def load(self):
+        pending = buffer.get(self.session_key) if self.session_key else None
+        if pending is not None:
+            session_data, expire_date = pending
+            if expire_date > timezone.now():
+                data = self.decode(session_data)
+            else:
+                self._session_key = None
+                data = {}
+        else:
+            data = super().load()
+        self._loaded_digest = self._digest(data)
+        self._loaded_pinned = self._pinned(data)
+        return data
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        digest = self._digest(data)
+        if must_create:
+            super().save(must_create=True)
+        elif digest != self._loaded_digest:
+            self._cache.set(self.cache_key, data, self.get_expiry_age())
+            buffer.write(self.session_key, self.encode(data), self.get_expiry_date(),
+                         now=self._pinned(data) != self._loaded_pinned)
+        self._loaded_digest = digest
+        self._loaded_pinned = self._pinned(data)
+
+    def delete(self, session_key=None):
+        buffer.discard(session_key or self.session_key)
+        super().delete(session_key)
+
+    @classmethod
+    def clear_expired(cls, batch_size=None):
+        """Delete expired sessions a batch at a time, so no one DELETE holds the table for long"""
+        model = cls.get_model_class()
+        batch_size = batch_size or purge_batch()
+        deleted = 0
+        while True:
+            expired = model.objects.filter(expire_date__lt=timezone.now()).values_list('session_key', flat=True)
+            keys = list(expired[:batch_size])
+            if not keys:
+                return deleted
+            deleted += model.objects.filter(session_key__in=keys).delete()[0]
@@ -1,10 +1,93 @@
-from django.db.models.signals import post_save
+import logging
+
+from django.core.signals import request_finished
+from django.db import DatabaseError
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from django.contrib.auth.models import User
-from .models import Cart
-
-@receiver(post_save, sender=User)
-def create_cart(sender, instance, created, **kwargs):
-   """Create a cart for new users"""
-   if created:
-       Cart.objects.create(user=instance)
\ No newline at end of file
+from django.contrib.auth.signals import user_logged_in
+from .models import Cart, Category, Page, Product, Promotion
+from . import counters, images, inventory, leaderboards, pricing, promotions, search, sessions
+from .caching import bump_generation
+from .cart import merge_anonymous_cart
+
+logger = logging.getLogger(__name__)
+
+@receiver(pre_delete, sender=Cart)
+def release_cart_stock(sender, instance, **kwargs):
+   """Return stock reserved by a cart before the cascade deletes its reservations"""
+   inventory.release(instance)
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+   """Carry what was carted before logging in over to the user's cart"""
+   merge_anonymous_cart(request, user)
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+   """Keep the search index in step with product edits"""
+   search.index_products([instance])
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_pages(sender, instance, **kwargs):
+   """Evict cached pages showing this product"""
+   bump_generation('products')
+   bump_generation(f'product:{instance.id}')
+
+@receiver(post_delete, sender=Product)
+def reprice_carts(sender, instance, **kwargs):
+   """Reprice carts, which lose their lines of a deleted product"""
+   bump_generation(pricing.PRICE_TAG)
+
+@receiver(post_save, sender=Page)
+@receiver(post_delete, sender=Page)
+def invalidate_page_lists(sender, instance, **kwargs):
+   """Evict cached pages listing pages"""
+   bump_generation('pages')
+
+@receiver(post_save, sender=Product)
+def resize_product_image(sender, instance, **kwargs):
+   """Render thumbnail/WebP variants of a new or changed product image"""
+   if instance.image and not instance.image_digest:
+       images.schedule_derivatives(instance.id)
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+   """Drop deleted products from the search index"""
+   search.remove_products([instance.id])
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_list(sender, instance, **kwargs):
+   """Make cached category lists and pages showing categories re-render"""
+   bump_generation('categories')
+
+@receiver(post_save, sender=Promotion)
+@receiver(post_delete, sender=Promotion)
+def invalidate_promotions(sender, instance, **kwargs):
+   """Recompile the promotions, and reprice carts, after one changes"""
+   bump_generation(promotions.TAG)
+
+@receiver(request_finished)
+def flush_counters(sender, **kwargs):
+   """Write buffered view/like counts once the flush interval has passed"""
+   try:
+       counters.buffer.flush_if_due()
+   except DatabaseError:
+       logger.exception('Could not flush buffered counters')
+
+@receiver(request_finished)
+def flush_sessions(sender, **kwargs):
+   """Write buffered session changes once the write-behind interval has passed, and purge expired ones"""
+   try:
+       sessions.buffer.flush_if_due()
+   except DatabaseError:
+       logger.exception('Could not write buffered sessions')
+   sessions.schedule_purge()
+
+@receiver(counters.counters_flushed)
+def update_leaderboards(sender, lookup, values, fields, **kwargs):
+   """Merge the rows whose counts were just written into the leaderboards they rank on"""
+   for board in leaderboards.LEADERBOARDS:
+       if board.model is sender and board.field in fields:
+           board.update(sender.objects.filter(**{f'{lookup}__in': values}))
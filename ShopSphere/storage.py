@@ -0,0 +1,53 @@
+"""Static files storage that also writes precompressed copies.
+
+collectstatic with this storage stores every file under a content-hashed
+name (ManifestStaticFilesStorage) and, for compressible types, .gz and .br
+siblings that FileServingMiddleware hands to clients that accept them.
+Brotli output needs the optional `brotli` package; without it only gzip
+copies are written.
+"""
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.html', '.json', '.xml', '.map', '.ico')
+# Compressing tiny files doesn't pay for the extra Content-Encoding handling.
+MIN_SIZE = 256
+
+
+def _compressors():
+    yield '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield '.br', lambda data: brotli.compress(data, quality=11)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # Fall back to the unhashed name rather than erroring on a missing manifest entry.
+    manifest_strict = False
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for name in list(self.hashed_files.values()):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self._write_compressed(name)
+
+    def _write_compressed(self, name):
+        with self.open(name) as f:
+            data = f.read()
+        if len(data) < MIN_SIZE:
+            return
+        for ext, compress in _compressors():
+            compressed = compress(data)
+            # Only keep a variant that is actually smaller.
+            if len(compressed) < len(data):
+                if self.exists(name + ext):
+                    self.delete(name + ext)
+                self._save(name + ext, ContentFile(compressed))
@@ -0,0 +1,231 @@
+"""A task queue kept in the database, for work a request shouldn't wait on.
+
+Functions decorated with @task are queued by name with enqueue(), which
+inserts a Task row in the caller's transaction: the task is only seen once
+the work that queued it commits, and vanishes with it on a rollback. Passing
+a key makes enqueueing idempotent; a second enqueue under the same key
+returns the task already queued (or run) instead of adding another.
+
+The run_workers command runs a pool of worker processes. Each claims due
+tasks with a conditional UPDATE, so two workers never run the same task, and
+runs them pinned to the primary database. A task that raises is retried
+after TASK_RETRY_BACKOFF seconds, doubling with each attempt, until it has
+had its max_attempts; then it is left FAILED for someone to look at. One
+whose worker died is taken over once it has been running for TASK_TIMEOUT
+seconds, so tasks must be safe to run more than once; that too uses up an
+attempt. Finished tasks are deleted after TASK_RETENTION seconds.
+
+Tests, and run_workers --burst, run the due tasks in the current process
+with run_pending().
+"""
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from . import routers
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+REGISTRY = {}
+# Seconds between the workers' deletions of old finished tasks.
+PURGE_EVERY = 5 * 60
+
+
+def task_timeout():
+    return getattr(settings, 'TASK_TIMEOUT', 5 * 60)
+
+
+def retry_backoff():
+    return getattr(settings, 'TASK_RETRY_BACKOFF', 10)
+
+
+def max_backoff():
+    return getattr(settings, 'TASK_MAX_BACKOFF', 60 * 60)
+
+
+def default_max_attempts():
+    return getattr(settings, 'TASK_MAX_ATTEMPTS', 5)
+
+
+def retention():
+    return getattr(settings, 'TASK_RETENTION', 7 * 24 * 60 * 60)
+
+
+def task(name=None, max_attempts=None):
+    """Register a function as a task, by default named 'module.function' (e.g. 'images.generate_derivatives')"""
+    def register(func):
+        task_name = name or f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}'
+        REGISTRY[task_name] = func
+        func.task_name = task_name
+        func.max_attempts = max_attempts
+        return func
+    return register
+
+
+def enqueue(name, *args, key=None, delay=0):
+    """Queue a call of the task name with args (JSON-serialisable), to run delay seconds from now"""
+    func = REGISTRY.get(name)
+    if func is None:
+        raise ValueError(f'Unknown task {name!r}')
+    fields = {
+        'name': name,
+        'args': json.dumps(args),
+        'run_at': timezone.now() + timedelta(seconds=delay),
+        'max_attempts': func.max_attempts or default_max_attempts(),
+    }
+    if key is None:
+        return Task.objects.create(**fields)
+    try:
+        # A savepoint, so the duplicate key doesn't break the caller's transaction.
+        with transaction.atomic():
+            return Task.objects.create(key=key, **fields)
+    except IntegrityError:
+        return Task.objects.get(key=key)
+
+
+def backoff(attempts):
+    """Seconds before retrying a task that has failed attempts times, with up to 10% jitter"""
+    delay = min(retry_backoff() * 2 ** (attempts - 1), max_backoff())
+    return delay * (1 + random.random() / 10)
+
+
+def _stale(now):
+    return Q(status=Task.RUNNING, locked_at__lt=now - timedelta(seconds=task_timeout()))
+
+
+def _claimable(now):
+    return Q(status=Task.QUEUED, run_at__lte=now) | _stale(now) & Q(attempts__lt=F('max_attempts'))
+
+
+def claim(worker, limit=10):
+    """Take up to limit due tasks for worker, oldest first"""
+    now = timezone.now()
+    # A task that kills its worker never reaches execute()'s error handling,
+    # so it is given up here once it has used all its attempts.
+    Task.objects.filter(_stale(now), attempts__gte=F('max_attempts')).update(
+        status=Task.FAILED, finished_at=now, locked_by='', locked_at=None,
+        last_error='Its worker stopped while running its last attempt.')
+    candidates = list(Task.objects.filter(_claimable(now)).order_by('run_at', 'pk')
+                      .values_list('pk', flat=True)[:limit])
+    claimed = []
+    for pk in candidates:
+        # Only one worker's UPDATE can still find the task claimable.
+        if Task.objects.filter(_claimable(now), pk=pk).update(
+                status=Task.RUNNING, locked_by=worker, locked_at=now, attempts=F('attempts') + 1):
+            claimed.append(pk)
+    return list(Task.objects.filter(pk__in=claimed).order_by('run_at', 'pk'))
+
+
+def execute(claimed):
+    """Run a claimed task and record how it went; returns whether it succeeded"""
+    func = REGISTRY.get(claimed.name)
+    started = time.perf_counter()
+    try:
+        if func is None:
+            raise LookupError(f'No task named {claimed.name!r} is registered')
+        with routers.primary():
+            func(*json.loads(claimed.args))
+    except Exception:
+        elapsed = time.perf_counter() - started
+        retry = func is not None and claimed.attempts < claimed.max_attempts
+        now = timezone.now()
+        logger.warning('Task %s failed (attempt %s of %s)', claimed, claimed.attempts, claimed.max_attempts,
+                       exc_info=True)
+        Task.objects.filter(pk=claimed.pk, locked_by=claimed.locked_by).update(
+            status=Task.QUEUED if retry else Task.FAILED,
+            run_at=now + timedelta(seconds=backoff(claimed.attempts)) if retry else claimed.run_at,
+            finished_at=None if retry else now,
+            last_error=traceback.format_exc()[-4000:],
+            seconds=F('seconds') + elapsed, locked_by='', locked_at=None)
+        return False
+    elapsed = time.perf_counter() - started
+    Task.objects.filter(pk=claimed.pk, locked_by=claimed.locked_by).update(
+        status=Task.DONE, finished_at=timezone.now(), last_error='',
+        seconds=F('seconds') + elapsed, locked_by='', locked_at=None)
+    return True
+
+
+def run_pending(worker='inline', batch=10):
+    """Run every due task in this process, including retries that come due meanwhile; returns how many ran"""
+    ran = 0
+    while True:
+        claimed = claim(worker, batch)
+        if not claimed:
+            return ran
+        for queued in claimed:
+            execute(queued)
+        ran += len(claimed)
+
+
+def purge_finished(batch_size=1000):
+    """Delete tasks done more than TASK_RETENTION seconds ago, a batch at a time; failed ones are kept"""
+    cutoff = timezone.now() - timedelta(seconds=retention())
+    deleted = 0
+    while True:
+        finished = Task.objects.filter(status=Task.DONE, finished_at__lt=cutoff).values_list('pk', flat=True)
+        pks = list(finished[:batch_size])
+        if not pks:
+            return deleted
+        deleted += Task.objects.filter(pk__in=pks).delete()[0]
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'[:64]
+
+
+class Worker:
+    """The loop of one worker process: claim a batch, run it, and sleep when nothing is due"""
+
+    def __init__(self, batch=10, poll_interval=1.0):
+        self.name = worker_name()
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.stopping = False
+        self._last_purge = time.monotonic()
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info('Task worker %s started', self.name)
+        while not self.stopping:
+            close_old_connections()
+            claimed = claim(self.name, self.batch)
+            for queued in claimed:
+                execute(queued)
+            if time.monotonic() - self._last_purge >= PURGE_EVERY:
+                self._last_purge = time.monotonic()
+                purge_finished()
+            if not claimed:
+                time.sleep(self.poll_interval)
+        logger.info('Task worker %s stopped', self.name)
+
+
+def run_worker(batch, poll_interval):
+    """Entry point of a worker process"""
+    import django
+    django.setup()
+    Worker(batch, poll_interval).run()
+
+
+def stats():
+    """Tasks by (name, status): how many, their attempts, and seconds spent running them"""
+    rows = (Task.objects.values_list('name', 'status')
+            .annotate(count=Count('pk'), attempts=Sum('attempts'), seconds=Sum('seconds'))
+            .order_by('name', 'status'))
+    return [{'name': name, 'status': status, 'count': count, 'attempts': attempts or 0, 'seconds': seconds or 0}
+            for name, status, count, attempts, seconds in rows]
@@ -1,9 +1,51 @@
 from django import template
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.templatetags.static import static
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from ShopSphere import images
+from ShopSphere.caching import get_generation
 from ShopSphere.models import Category
 
 register = template.Library()
 
+# How long a rendered category list is kept; it is invalidated sooner if a category changes.
+CATEGORY_LIST_TIMEOUT = 60 * 60 * 24
+
 @register.inclusion_tag('ShopSphere/categories.html')
 def get_category_list(current_category=None):
     return {'categories': Category.objects.all(),
-            'current_category': current_category}
\ No newline at end of file
+            'current_category': current_category}
+
+@register.simple_tag
+def get_cached_category_list(current_category=None):
+    """Render the category list from cache, re-rendering only when categories change"""
+    current_id = current_category.pk if current_category else ''
+    key = f'ShopSphere:category_list:{get_generation("categories")}:{current_id}'
+    html = cache.get(key)
+    if html is None:
+        html = render_to_string('ShopSphere/categories.html',
+                                get_category_list(current_category))
+        cache.set(key, html, CATEGORY_LIST_TIMEOUT)
+    return mark_safe(html)
+
+@register.simple_tag
+def product_image(product, sizes='100vw', width=None):
+    """Responsive <picture> for a product, using its resized variants once they exist"""
+    alt = product.name
+    if not product.image:
+        return format_html('<img src="{}" alt="No image available">',
+                           static('images/default-product-image.png'))
+    if not product.image_digest:
+        # Variants are still being generated; fall back to the original upload.
+        return format_html('<img src="{}" alt="{}" width="{}">', product.image.url, alt,
+                           width or images.IMAGE_WIDTHS[-1])
+    fallback = images.derivative_name(product.image_digest, images.IMAGE_WIDTHS[0], 'jpg')
+    webp = ''
+    if 'webp' in images.formats():
+        webp = format_html('<source type="image/webp" srcset="{}" sizes="{}">',
+                           images.srcset(product, 'webp'), sizes)
+    return format_html('<picture>{}<img src="{}" srcset="{}" sizes="{}" alt="{}" loading="lazy"></picture>',
+                       webp, images.default_storage.url(fallback),
+                       images.srcset(product, 'jpg'), sizes, alt)
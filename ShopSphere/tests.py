@@ -1,14 +1,30 @@
-from django.test import TestCase, Client
+import csv
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from io import BytesIO, StringIO
+
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.core.cache import cache
+from django.db import connection
+from django.core.management import call_command
+from django.template import Context, Template
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.contrib.admin.sites import site
-from ShopSphere.models import Category, Page, Product, Cart, CartItem, UserProfile
+from ShopSphere.models import Category, Page, Product, Cart, CartItem, UserProfile, StockReservation, ProductPair, Promotion, Task
 from ShopSphere.forms import CategoryForm, PageForm, UserForm, ProductForm
 from ShopSphere.admin import CategoryAdmin, PageAdmin
+from ShopSphere import counters, tasks
 
 class ShopSphereTests(TestCase):
     def setUp(self):
         # Set up test data before each test runs
+        cache.clear()
         self.client = Client()
         self.category = Category.objects.create(name='TestCategory', slug='testcategory')
         self.product = Product.objects.create(name='TestProduct', description='Test Description', price=10.99, stock=10)
@@ -138,3 +154,1668 @@ class ShopSphereTests(TestCase):
     def test_admin_user_profile_registered(self):
         # Test if the UserProfile model is registered in the Django admin
         self.assertTrue(site.is_registered(UserProfile))
+
+
+class ProductPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.products = [
+            Product.objects.create(name=f'Product {i}', description='', price=1, stock=1)
+            for i in range(5)
+        ]
+
+    def test_index_shows_first_page_with_next_cursor(self):
+        # Only page_size products are rendered and the next cursor is the last id shown
+        response = self.client.get(reverse('ShopSphere:index'), {'page_size': 2})
+        page = response.context['product_page']
+        self.assertEqual(list(page), self.products[:2])
+        self.assertEqual(page.next_cursor, self.products[1].id)
+        self.assertFalse(page.has_previous)
+
+    def test_index_follows_cursors(self):
+        # Seeking after/before a cursor returns the neighbouring pages
+        response = self.client.get(reverse('ShopSphere:index'),
+                                   {'page_size': 2, 'after': self.products[1].id})
+        page = response.context['product_page']
+        self.assertEqual(list(page), self.products[2:4])
+        self.assertTrue(page.has_next)
+        self.assertTrue(page.has_previous)
+
+        response = self.client.get(reverse('ShopSphere:index'),
+                                   {'page_size': 2, 'before': self.products[2].id})
+        page = response.context['product_page']
+        self.assertEqual(list(page), self.products[:2])
+        self.assertFalse(page.has_previous)
+
+    def test_page_size_is_capped(self):
+        # A huge page_size is clamped to MAX_PAGE_SIZE
+        from ShopSphere.pagination import MAX_PAGE_SIZE
+        response = self.client.get(reverse('ShopSphere:index'), {'page_size': 10 ** 6})
+        self.assertEqual(response.context['product_page'].page_size, MAX_PAGE_SIZE)
+
+
+class ProductCategoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.category = Category.objects.create(name='Electronics')
+
+    def test_product_save_links_category(self):
+        # Saving a product resolves its category name to a Category row
+        product = Product.objects.create(category='Electronics', name='Laptop',
+                                         description='', price=1, stock=1)
+        self.assertEqual(product.category_ref, self.category)
+
+        product.category = 'Books'
+        product.save()
+        self.assertEqual(product.category_ref.name, 'Books')
+
+    def test_saving_an_unchanged_category_reads_no_category(self):
+        Product.objects.create(category='Electronics', name='Laptop', description='', price=1, stock=1)
+        product = Product.objects.get()
+        product.price = 2
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            product.save()
+        self.assertFalse([sql for sql in queries if 'ShopSphere_category' in sql])
+        self.assertEqual(product.category_ref, self.category)
+
+    def test_renaming_a_category_renames_it_on_products(self):
+        Product.objects.create(category='Electronics', name='Laptop', description='', price=1, stock=1)
+        category = Category.objects.get()
+        category.name = 'Gadgets'
+        category.save()
+        product = Product.objects.get()
+        self.assertEqual(product.category, 'Gadgets')
+        from ShopSphere import search
+        self.assertEqual([p.name for p in search.search_products('gadgets').products], ['Laptop'])
+        product.save()
+        self.assertEqual(list(Category.objects.values_list('name', flat=True)), ['Gadgets'])
+        self.assertEqual(product.category_ref, category)
+
+    def test_names_that_slugify_alike_get_distinct_slugs(self):
+        kitchen = Product.objects.create(category='Home & Kitchen', name='Kettle', description='', price=1, stock=1)
+        home = Product.objects.create(category='Home Kitchen', name='Toaster', description='', price=1, stock=1)
+        self.assertEqual((kitchen.category_ref.slug, home.category_ref.slug), ('home-kitchen', 'home-kitchen-2'))
+        response = self.client.get(reverse('ShopSphere:show_category', args=['home-kitchen-2']))
+        self.assertEqual(list(response.context['products']), [home])
+
+        # Resaving keeps the slug; renaming to a free name frees the suffix.
+        category = kitchen.category_ref
+        category.save()
+        self.assertEqual(Category.objects.get(pk=category.pk).slug, 'home-kitchen')
+        category.name = 'Kitchen'
+        category.save()
+        self.assertEqual(category.slug, 'kitchen')
+
+    def test_category_page_lists_products(self):
+        # The category page shows the products linked to that category
+        product = Product.objects.create(category='Electronics', name='Laptop',
+                                         description='', price=1, stock=1)
+        Product.objects.create(category='Books', name='Novel', description='', price=1, stock=1)
+        response = self.client.get(reverse('ShopSphere:show_category', args=[self.category.slug]))
+        self.assertEqual(list(response.context['products']), [product])
+
+    def test_backfill_migration(self):
+        # The data migration links existing products in batches, creating missing categories
+        from importlib import import_module
+        from types import SimpleNamespace
+        from django.apps import apps
+        from django.db import connection
+        migration = import_module('ShopSphere.migrations.0011_backfill_product_category_ref')
+
+        Product.objects.create(category='Electronics', name='Laptop', description='', price=1, stock=1)
+        Product.objects.create(category='Garden', name='Spade', description='', price=1, stock=1)
+        Product.objects.update(category_ref=None)
+        Category.objects.filter(name='Garden').delete()
+
+        migration.backfill_category_ref(apps, SimpleNamespace(connection=connection))
+
+        linked = dict(Product.objects.values_list('name', 'category_ref__name'))
+        self.assertEqual(linked, {'Laptop': 'Electronics', 'Spade': 'Garden'})
+        self.assertEqual(Category.objects.get(name='Garden').slug, 'garden')
+
+    def test_backfill_migration_suffixes_colliding_slugs(self):
+        from importlib import import_module
+        from types import SimpleNamespace
+        from django.apps import apps
+        from django.db import connection
+        migration = import_module('ShopSphere.migrations.0011_backfill_product_category_ref')
+
+        Product.objects.create(category='Home & Kitchen', name='Kettle', description='', price=1, stock=1)
+        Product.objects.create(category='Home Kitchen', name='Toaster', description='', price=1, stock=1)
+        Product.objects.update(category_ref=None)
+        Category.objects.filter(name__startswith='Home').delete()
+
+        migration.backfill_category_ref(apps, SimpleNamespace(connection=connection))
+
+        slugs = dict(Product.objects.values_list('name', 'category_ref__slug'))
+        self.assertEqual(sorted(slugs.values()), ['home-kitchen', 'home-kitchen-2'])
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.laptop = Product.objects.create(category='Electronics', name='Gaming Laptop',
+                                             description='Powerful laptop.', price=1, stock=1)
+        self.phone = Product.objects.create(category='Electronics', name='Smartphone',
+                                            description='Pairs with any laptop.', price=1, stock=1)
+        self.book = Product.objects.create(category='Books', name='Python Programming',
+                                           description='Learn Python.', price=1, stock=1)
+
+    def test_search_view_ranks_name_matches_first(self):
+        # A name match outranks a description match
+        response = self.client.get(reverse('ShopSphere:search'), {'q': 'laptop'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['results'].products, [self.laptop, self.phone])
+
+    def test_search_follows_saves_and_deletes(self):
+        # The index is updated by the product signals
+        self.book.name = 'Django Unchained'
+        self.book.save()
+        response = self.client.get(reverse('ShopSphere:search'), {'q': 'unchained'})
+        self.assertEqual(response.context['results'].products, [self.book])
+
+        self.book.delete()
+        response = self.client.get(reverse('ShopSphere:search'), {'q': 'unchained'})
+        self.assertEqual(response.context['results'].products, [])
+
+    def test_suggest_autocompletes_prefix(self):
+        response = self.client.get(reverse('ShopSphere:search_suggest'), {'q': 'smart'})
+        self.assertEqual(response.json(), {'suggestions': ['Smartphone']})
+
+    def test_inverted_index_fallback(self):
+        # The pure-Python index gives the same answers as FTS5
+        from ShopSphere.search import InvertedIndex
+        index = InvertedIndex()
+        self.assertEqual(index.search(['laptop'], 10, 0), [self.laptop.id, self.phone.id])
+        self.assertEqual(index.search(['electronics', 'smart'], 10, 0), [self.phone.id])
+        self.assertEqual(index.suggest(['pyth'], 10), ['Python Programming'])
+
+        index.remove([self.laptop.id])
+        self.assertEqual(index.search(['gaming'], 10, 0), [])
+
+
+class CategoryListCacheTests(TestCase):
+    template = Template('{% load ShopSphere_template_tags %}{% get_cached_category_list %}')
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Python')
+
+    def assert_cached_until_category_changes(self):
+        # The first render is cached; category writes invalidate it
+        with self.assertNumQueries(1):
+            html = self.template.render(Context())
+        self.assertIn('Python', html)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.template.render(Context()), html)
+
+        Category.objects.create(name='Django')
+        self.assertIn('Django', self.template.render(Context()))
+
+        self.category.delete()
+        self.assertNotIn('Python', self.template.render(Context()))
+
+    def test_locmem_cache(self):
+        self.assert_cached_until_category_changes()
+
+    def test_file_based_cache(self):
+        with tempfile.TemporaryDirectory() as location:
+            with override_settings(CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                    'LOCATION': location}}):
+                self.assert_cached_until_category_changes()
+
+
+def metrics_client():
+    """A client scraping /metrics/ with the token the tests configure"""
+    return Client(HTTP_AUTHORIZATION='Bearer scrape-token')
+
+
+@override_settings(METRICS_TOKEN='scrape-token')
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.product = Product.objects.create(category='Electronics', name='Laptop',
+                                              description='', price=1, stock=1)
+        self.other = Product.objects.create(category='Books', name='Novel',
+                                            description='', price=1, stock=1)
+        self.url = reverse('ShopSphere:product_detail', args=[self.product.id])
+
+    def test_anonymous_pages_are_cached(self):
+        self.assertEqual(self.client.get(self.url)['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+
+    def test_product_save_evicts_its_page_and_index(self):
+        index_url = reverse('ShopSphere:index')
+        other_url = reverse('ShopSphere:product_detail', args=[self.other.id])
+        for url in (self.url, index_url, other_url):
+            self.client.get(url)
+
+        self.product.name = 'Gaming Laptop'
+        self.product.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Gaming Laptop')
+        self.assertEqual(self.client.get(index_url)['X-Page-Cache'], 'miss')
+        self.assertEqual(self.client.get(other_url)['X-Page-Cache'], 'hit')
+
+    def test_authenticated_and_cart_sessions_bypass(self):
+        User.objects.create_user(username='shopper', password='password123')
+        self.client.login(username='shopper', password='password123')
+        self.client.get(self.url)
+        self.assertNotIn('X-Page-Cache', self.client.get(self.url))
+
+        self.client.logout()
+        self.client.post(reverse('ShopSphere:add_to_cart', args=[self.other.id]))
+        self.assertNotIn('X-Page-Cache', self.client.get(self.url))
+
+    def test_cached_pages_serve_each_visitor_their_own_csrf_token(self):
+        add_url = reverse('ShopSphere:add_to_cart', args=[self.product.id])
+        Client(enforce_csrf_checks=True).get(self.url)
+        visitor = Client(enforce_csrf_checks=True)
+        response = visitor.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode()).group(1)
+        self.assertEqual(visitor.post(add_url, {'csrfmiddlewaretoken': token}).status_code, 302)
+        self.assertEqual(CartItem.objects.get().product, self.product)
+
+    def test_metrics_endpoint_reports_counters(self):
+        self.client.get(self.url)
+        self.client.get(self.url)
+        response = metrics_client().get(reverse('ShopSphere:metrics'))
+        self.assertContains(response, 'shopsphere_page_cache_requests_total{outcome="hit"} 1')
+        self.assertContains(response, 'shopsphere_page_cache_requests_total{outcome="miss"} 1')
+
+
+class ImportCatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_csv_import_upserts_on_natural_key(self):
+        Product.objects.create(category='Books', name='Novel', description='old', price=1, stock=1)
+        path = self.write('feed.csv', 'category,name,description,price,stock\n'
+                                      'Books,Novel,new,9.99,3\n'
+                                      'Garden,Spade,Digs,12.50,7\n'
+                                      'Garden,,No name,1,1\n')
+        out = StringIO()
+        call_command('import_catalog', path, chunk_size=2, stdout=out, stderr=StringIO())
+
+        self.assertIn('Imported 1 new and 1 updated products, skipped 1', out.getvalue())
+        novel = Product.objects.get(name='Novel')
+        self.assertEqual((novel.description, novel.stock), ('new', 3))
+        spade = Product.objects.get(name='Spade')
+        self.assertEqual(spade.category_ref, Category.objects.get(name='Garden'))
+
+    def test_import_creates_categories_whose_names_slugify_alike(self):
+        from ShopSphere.caching import get_generation
+        categories = get_generation('categories')
+        path = self.write('feed.csv', 'category,name,price,stock\n'
+                                      'Home & Kitchen,Kettle,20,1\n'
+                                      'Home Kitchen,Toaster,30,1\n'
+                                      f'{"x" * 129},Long,1,1\n')
+        out = StringIO()
+        call_command('import_catalog', path, stdout=out, stderr=StringIO())
+
+        self.assertIn('Imported 2 new and 0 updated products, skipped 1', out.getvalue())
+        linked = dict(Product.objects.values_list('name', 'category_ref__slug'))
+        self.assertEqual(linked, {'Kettle': 'home-kitchen', 'Toaster': 'home-kitchen-2'})
+        self.assertNotEqual(get_generation('categories'), categories)
+
+    def test_jsonl_import_resumes_from_checkpoint(self):
+        rows = [{'category': 'Toys', 'name': f'Toy {i}', 'price': '1.00', 'stock': 1} for i in range(5)]
+        path = self.write('feed.jsonl', ''.join(json.dumps(row) + '\n' for row in rows))
+        checkpoint = self.write('checkpoint.json', json.dumps({'source': os.path.abspath(path), 'rows': 3}))
+
+        call_command('import_catalog', path, checkpoint=checkpoint, stdout=StringIO())
+
+        self.assertEqual(sorted(Product.objects.values_list('name', flat=True)), ['Toy 3', 'Toy 4'])
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.laptop = Product.objects.create(category='Electronics', name='Laptop',
+                                             description='', price='999.99', stock=5)
+        self.book = Product.objects.create(category='Books', name='Novel',
+                                           description='', price='10.50', stock=5)
+
+    def add(self, product):
+        self.client.post(reverse('ShopSphere:add_to_cart', args=[product.id]))
+
+    def test_session_holds_only_cart_id_and_count(self):
+        # However many lines are carted, the session keeps the same two keys
+        self.add(self.laptop)
+        self.add(self.book)
+        self.add(self.book)
+        session = self.client.session
+        self.assertEqual(set(session.keys()), {'cart_id', 'cart_items'})
+        self.assertEqual(session['cart_items'], 3)
+        cart = Cart.objects.get(pk=session['cart_id'])
+        self.assertIsNone(cart.user)
+        self.assertEqual(dict(cart.items.values_list('product__name', 'quantity')),
+                         {'Laptop': 1, 'Novel': 2})
+
+    def test_cart_detail_renders_from_one_query_and_cached_pricing(self):
+        self.add(self.laptop)
+        self.add(self.book)
+        response = self.client.get(reverse('ShopSphere:cart_detail'))
+        self.assertContains(response, 'Total: £1010.49')
+
+        from ShopSphere.cart import CartService
+        request = response.wsgi_request
+        service = CartService(request)
+        # The cart was priced when the page rendered, so only its lines are fetched.
+        with self.assertNumQueries(1):
+            self.assertEqual([item.product.name for item in service], ['Laptop', 'Novel'])
+            self.assertEqual(str(service.total_price()), '1010.49')
+
+    def test_anonymous_cart_merges_on_login(self):
+        user = User.objects.create_user(username='shopper', password='password123')
+        user_cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=user_cart, product=self.book, quantity=1)
+
+        self.add(self.laptop)
+        self.add(self.book)
+        self.client.login(username='shopper', password='password123')
+
+        self.assertEqual(dict(user_cart.items.values_list('product__name', 'quantity')),
+                         {'Laptop': 1, 'Novel': 2})
+        self.assertEqual(Cart.objects.filter(user__isnull=True).count(), 0)
+        self.assertEqual(self.client.session['cart_items'], 3)
+
+
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        from ShopSphere import promotions
+        cache.clear()
+        promotions.compiled()  # the (empty) promotions index, read once per change
+        self.cart = Cart.objects.create()
+        for i, price in enumerate(['1.10', '2.20', '3.30']):
+            product = Product.objects.create(name=f'Product {i}', description='', price=price, stock=9)
+            CartItem.objects.create(cart=self.cart, product=product, quantity=i + 1)
+
+    def test_totals_are_one_query_memoized(self):
+        # However many lines and calls, the totals cost a single query
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(str(cart.total_price()), '15.40')
+            self.assertEqual(cart.total_items(), 6)
+            cart.total_price()
+            cart.total_items()
+
+    def test_prefetched_items_need_no_queries(self):
+        cart = Cart.objects.prefetch_related('items__product').get(pk=self.cart.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(cart.total_price()), '15.40')
+            self.assertEqual(cart.total_items(), 6)
+
+    def test_refresh_totals_after_changes(self):
+        self.assertEqual(self.cart.total_items(), 6)
+        from ShopSphere.cart import add_item
+        add_item(self.cart, CartItem.objects.first().product_id, 4)
+        self.assertEqual(self.cart.total_items(), 10)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.product = Product.objects.create(name='Console', description='', price=300, stock=2)
+
+    def stock(self):
+        return Product.objects.get(pk=self.product.pk).stock
+
+    def add(self):
+        return self.client.post(reverse('ShopSphere:add_to_cart', args=[self.product.id]))
+
+    def test_add_to_cart_reserves_and_refuses_oversell(self):
+        self.add()
+        self.add()
+        self.assertEqual(self.stock(), 0)
+        response = self.add()
+        self.assertRedirects(response, reverse('ShopSphere:product_detail', args=[self.product.id]),
+                             fetch_redirect_response=False)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_stock_changes_evict_cached_pages(self):
+        page = reverse('ShopSphere:product_detail', args=[self.product.id])
+        self.assertContains(Client().get(page), 'Stock: 2')
+        self.add()
+        response = Client().get(page)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Stock: 1')
+
+    def test_stock_changes_leave_catalog_caches_alone(self):
+        from ShopSphere import facets
+        Category.objects.create(name='Consoles')
+        category_page = reverse('ShopSphere:show_category', args=['consoles'])
+        for page in (category_page, reverse('ShopSphere:index')):
+            Client().get(page)
+        facets.facet_cube()
+        self.add()
+        self.assertEqual(Client().get(category_page)['X-Page-Cache'], 'hit')
+        # The index shows stock, so it is re-rendered.
+        self.assertEqual(Client().get(reverse('ShopSphere:index'))['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            facets.facet_cube()
+
+    def test_add_to_cart_refuses_get(self):
+        response = self.client.get(reverse('ShopSphere:add_to_cart', args=[self.product.id]))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(self.stock(), 2)
+
+    def test_remove_and_clear_release_stock(self):
+        self.add()
+        self.client.get(reverse('ShopSphere:remove_from_cart', args=[self.product.id]))
+        self.assertEqual(self.stock(), 2)
+        self.add()
+        self.client.get(reverse('ShopSphere:clear_cart'))
+        self.assertEqual(self.stock(), 2)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_expired_reservations_return_to_stock(self):
+        from ShopSphere import inventory
+        from django.utils import timezone
+        self.add()
+        self.assertEqual(inventory.release_expired(), 0)
+        self.assertEqual(inventory.release_expired(now=timezone.now() + inventory.RESERVATION_TTL), 1)
+        self.assertEqual(self.stock(), 2)
+
+    def test_checkout_commits_reservations(self):
+        self.add()
+        self.client.post(reverse('ShopSphere:checkout'))
+        self.assertEqual(self.stock(), 1)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_checkout_rereserves_expired_lines_or_fails(self):
+        from ShopSphere import inventory
+        from django.utils import timezone
+        self.add()
+        inventory.release_expired(now=timezone.now() + inventory.RESERVATION_TTL)
+        Product.objects.filter(pk=self.product.pk).update(stock=0)
+        self.client.post(reverse('ShopSphere:checkout'))
+        self.assertEqual(CartItem.objects.get().quantity, 1)
+        self.assertEqual(self.stock(), 0)
+
+
+class StockReservationConcurrencyTests(TransactionTestCase):
+    def test_many_threads_never_oversell(self):
+        # Many buyers race for the same SKU; exactly `stock` of them succeed
+        from ShopSphere import inventory
+        from django.db import OperationalError, connection
+        product = Product.objects.create(name='Limited', description='', price=1, stock=25)
+        carts = [Cart.objects.create() for _ in range(60)]
+        outcomes = []
+
+        def buy(cart):
+            try:
+                while True:
+                    try:
+                        inventory.reserve(cart, product.pk)
+                        outcomes.append(True)
+                        return
+                    except inventory.OutOfStock:
+                        outcomes.append(False)
+                        return
+                    except OperationalError:
+                        # SQLite allows one writer at a time; retry when locked out.
+                        time.sleep(0.001)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(cart,)) for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes.count(True), 25)
+        self.assertEqual(Product.objects.get(pk=product.pk).stock, 0)
+        self.assertEqual(StockReservation.objects.count(), 25)
+
+
+class CounterBufferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        counters.buffer.flush()
+        self.category = Category.objects.create(name='Python')
+        self.page = Page.objects.create(category=self.category, title='Docs', url='http://docs.python.org/')
+
+    def test_increments_are_buffered_then_written_once_per_row(self):
+        counters.incr(Category, self.category.pk, 'views')
+        counters.incr(Category, self.category.pk, 'views')
+        counters.incr(Category, self.category.slug, 'likes', lookup='slug')
+        self.assertEqual(Category.objects.get(pk=self.category.pk).views, 0)
+        self.assertEqual(counters.buffer.pending(Category, self.category.pk, 'views'), 2)
+
+        with self.assertNumQueries(2):  # one UPDATE per (row, lookup)
+            counters.buffer.flush()
+        category = Category.objects.get(pk=self.category.pk)
+        self.assertEqual((category.views, category.likes), (2, 1))
+
+    def test_views_feed_the_buffer(self):
+        self.client.get(reverse('ShopSphere:show_category', args=[self.category.slug]))
+        self.client.get(reverse('ShopSphere:show_category', args=[self.category.slug]))
+        response = self.client.get(reverse('ShopSphere:goto', args=[self.page.id]))
+        self.assertRedirects(response, self.page.url, fetch_redirect_response=False)
+
+        counters.buffer.flush()
+        self.assertEqual(Category.objects.get(pk=self.category.pk).views, 2)
+        self.assertEqual(Page.objects.get(pk=self.page.pk).views, 1)
+
+    @override_settings(COUNTER_FLUSH_INTERVAL=0)
+    def test_zero_interval_writes_through(self):
+        counters.incr(Page, self.page.pk, 'views')
+        self.assertEqual(Page.objects.get(pk=self.page.pk).views, 1)
+
+    @override_settings(COUNTER_FLUSH_INTERVAL=3600)
+    def test_flush_waits_for_interval(self):
+        counters.incr(Page, self.page.pk, 'views')
+        counters.buffer.flush_if_due()
+        self.assertEqual(Page.objects.get(pk=self.page.pk).views, 0)
+
+
+def tearDownModule():
+    # Write out any counts and sessions still buffered while the test database exists.
+    from ShopSphere import sessions
+    counters.buffer.flush()
+    sessions.buffer.flush()
+
+
+class ProductImageTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def upload(self, colour='red'):
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        data = BytesIO()
+        Image.new('RGB', (1200, 800), colour).save(data, 'JPEG')
+        return SimpleUploadedFile('photo.jpg', data.getvalue(), content_type='image/jpeg')
+
+    def test_derivatives_are_content_addressed(self):
+        from ShopSphere import images
+        from django.core.files.storage import default_storage
+        product = Product.objects.create(name='Lamp', description='', price=1, stock=1, image=self.upload())
+        digest = images.generate_derivatives(product.id)
+
+        product.refresh_from_db()
+        self.assertEqual(product.image_digest, digest)
+        for width in images.IMAGE_WIDTHS:
+            for ext in images.formats():
+                name = images.derivative_name(digest, width, ext)
+                self.assertTrue(default_storage.exists(name))
+        with default_storage.open(images.derivative_name(digest, 160, 'jpg')) as f:
+            from PIL import Image
+            self.assertEqual(Image.open(f).size, (160, 107))
+
+    def test_new_image_clears_digest(self):
+        from ShopSphere import images
+        product = Product.objects.create(name='Lamp', description='', price=1, stock=1, image=self.upload())
+        images.generate_derivatives(product.id)
+        product = Product.objects.get(pk=product.pk)
+        product.image = self.upload('blue')
+        product.save()
+        self.assertEqual(product.image_digest, '')
+        self.assertNotEqual(images.generate_derivatives(product.id), '')
+
+    def test_template_tag_emits_srcset(self):
+        from ShopSphere import images
+        product = Product.objects.create(name='Lamp', description='', price=1, stock=1, image=self.upload())
+        template = Template('{% load ShopSphere_template_tags %}{% product_image product sizes="160px" %}')
+        self.assertIn(product.image.url, template.render(Context({'product': product})))
+
+        images.generate_derivatives(product.id)
+        product.refresh_from_db()
+        html = template.render(Context({'product': product}))
+        self.assertIn(f'/media/derivatives/{product.image_digest}-320.jpg 320w', html)
+        self.assertIn('sizes="160px"', html)
+
+    def test_derivatives_evict_the_cached_product_page(self):
+        from ShopSphere import images
+        cache.clear()
+        product = Product.objects.create(name='Lamp', description='', price=1, stock=1, image=self.upload())
+        page = reverse('ShopSphere:product_detail', args=[product.id])
+        self.assertNotContains(Client().get(page), 'srcset')
+        images.generate_derivatives(product.id)
+        response = Client().get(page)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'srcset')
+
+
+class FileServingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        media = override_settings(MEDIA_ROOT=self.root, MEDIA_URL='/media/')
+        media.enable()
+        self.addCleanup(media.disable)
+        self.body = b'body { color: red; }\n' * 100
+        with open(os.path.join(self.root, 'site.css'), 'wb') as f:
+            f.write(self.body)
+
+    def test_revalidation_returns_304(self):
+        response = self.client.get('/media/site.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.body)
+        etag = response['ETag']
+
+        response = self.client.get('/media/site.css', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/media/site.css', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.client.get('/media/site.css', HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.body)}')
+        self.assertEqual(b''.join(response.streaming_content), self.body[10:20])
+
+        response = self.client.get('/media/site.css', HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.body[-5:])
+
+        response = self.client.get('/media/site.css', HTTP_RANGE=f'bytes={len(self.body)}-')
+        self.assertEqual(response.status_code, 416)
+
+        # A stale If-Range gets the whole file.
+        response = self.client.get('/media/site.css', HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_precompressed_variant(self):
+        import gzip
+        with open(os.path.join(self.root, 'site.css.gz'), 'wb') as f:
+            f.write(gzip.compress(self.body))
+
+        response = self.client.get('/media/site.css', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.body)
+
+        response = self.client.get('/media/site.css', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_missing_and_escaping_paths_fall_through(self):
+        self.assertEqual(self.client.get('/media/missing.css').status_code, 404)
+        self.assertEqual(self.client.get('/media/../settings.py').status_code, 404)
+
+    def test_collectstatic_writes_compressed_copies(self):
+        import gzip
+        from ShopSphere.storage import CompressedManifestStaticFilesStorage
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        with open(os.path.join(source.name, 'app.js'), 'wb') as f:
+            f.write(b'console.log("ShopSphere");\n' * 50)
+        with override_settings(STATICFILES_DIRS=[source.name], STATIC_ROOT=os.path.join(self.root, 'static'),
+                               STATICFILES_STORAGE='ShopSphere.storage.CompressedManifestStaticFilesStorage'):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            storage = CompressedManifestStaticFilesStorage()
+            hashed = storage.stored_name('app.js')
+            self.assertNotEqual(hashed, 'app.js')
+            with storage.open(hashed + '.gz') as f:
+                self.assertEqual(gzip.decompress(f.read()), b'console.log("ShopSphere");\n' * 50)
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        from unittest import mock
+        from ShopSphere import recommendations
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'recommendations.bin')
+        overrides = override_settings(RECOMMENDATIONS_FILE=self.path, RECOMMENDATIONS_REFRESH=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(recommendations, 'recommender', recommendations.Recommender())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = Client()
+        self.products = [Product.objects.create(name=name, description='', price=1, stock=100)
+                         for name in ('Tent', 'Stove', 'Lantern', 'Kettle')]
+
+    def cart(self, *products):
+        client = Client()
+        for product in products:
+            client.post(reverse('ShopSphere:add_to_cart', args=[product.id]))
+
+    def test_pairs_are_counted_as_lines_are_added(self):
+        tent, stove, lantern, _ = self.products
+        self.cart(tent, stove, lantern)
+        self.cart(stove, tent, tent)
+        counts = {(p.product.name, p.other.name): p.count for p in ProductPair.objects.all()}
+        self.assertEqual(counts, {('Tent', 'Stove'): 2, ('Tent', 'Lantern'): 1, ('Stove', 'Lantern'): 1})
+
+    def test_matrix_keeps_the_top_neighbours(self):
+        from ShopSphere.recommendations import CoOccurrenceMatrix
+        matrix = CoOccurrenceMatrix.build([(1, 2, 5), (1, 3, 7), (1, 4, 5), (2, 3, 1)], top_k=2)
+        self.assertEqual(matrix.row(1), [(3, 7), (2, 5)])
+        self.assertEqual(matrix.row(3), [(1, 7), (2, 1)])
+        self.assertEqual(matrix.row(99), [])
+        matrix.save(self.path)
+        self.assertEqual(CoOccurrenceMatrix.load(self.path).row(2), [(1, 5), (3, 1)])
+
+    def test_recommendations_follow_new_carts_without_a_rebuild(self):
+        from ShopSphere import recommendations
+        tent, stove, lantern, kettle = self.products
+        self.cart(tent, stove)
+        self.cart(tent, stove)
+        self.cart(tent, lantern)
+        call_command('build_recommendations', stdout=StringIO())
+        self.assertEqual(recommendations.recommend([tent.id]), [stove, lantern])
+
+        # Kettle overtakes both once it has been carted with a tent three times.
+        for _ in range(3):
+            self.cart(kettle, tent)
+        self.assertEqual(recommendations.recommend([tent.id]), [kettle, stove, lantern])
+        self.assertEqual(recommendations.recommend([tent.id, stove.id]), [kettle, lantern])
+
+    def test_recount_and_view(self):
+        tent, stove, lantern, _ = self.products
+        cart = Cart.objects.create()
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=p) for p in (tent, lantern)])
+        call_command('build_recommendations', recount=True, stdout=StringIO())
+        self.assertEqual(ProductPair.objects.get().count, 1)
+
+        user = User.objects.create_user(username='camper', password='password123')
+        self.client.login(username='camper', password='password123')
+        self.client.post(reverse('ShopSphere:add_to_cart', args=[tent.id]))
+        response = self.client.get(reverse('ShopSphere:recommended'))
+        self.assertEqual(list(response.context['products']), [lantern])
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRoutingTests(TransactionTestCase):
+    """Two SQLite files stand in for the replicas; nothing copies rows to them."""
+    replicas = ['replica1', 'replica2']
+    databases = {'default', *replicas}
+
+    @classmethod
+    def setUpClass(cls):
+        from django.db import connections
+        cls.directory = tempfile.TemporaryDirectory()
+        for alias in cls.replicas:
+            connections.databases[alias] = {'ENGINE': 'django.db.backends.sqlite3',
+                                            'NAME': os.path.join(cls.directory.name, f'{alias}.sqlite3')}
+            with override_settings(DATABASE_REPLICAS=cls.replicas):
+                call_command('migrate', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        from django.db import connections
+        super().tearDownClass()
+        for alias in cls.replicas:
+            connections[alias].close()
+            del connections.databases[alias]
+        cls.directory.cleanup()
+
+    def setUp(self):
+        from ShopSphere import routers
+        cache.clear()
+        # Earlier tests' writes pinned this thread to the primary.
+        token = routers._pinned.set(False)
+        self.addCleanup(routers._pinned.reset, token)
+
+        self.product = Product.objects.using('default').create(name='Tent', description='', price=1, stock=5)
+        for alias in self.replicas:
+            Product.objects.using(alias).create(id=self.product.id, name=f'Tent on {alias}',
+                                                description='', price=1, stock=5)
+
+    def test_reads_go_to_replicas_and_writes_pin_to_primary(self):
+        from ShopSphere import routers
+        self.assertIn(Product.objects.get().name, ['Tent on replica1', 'Tent on replica2'])
+        with routers.primary():
+            self.assertEqual(Product.objects.get().name, 'Tent')
+
+        Category.objects.create(name='Camping')
+        self.assertTrue(routers.is_pinned())
+        self.assertEqual(Product.objects.get().name, 'Tent')
+
+    def test_client_stays_on_primary_after_writing(self):
+        response = self.client.get(reverse('ShopSphere:index'))
+        self.assertContains(response, 'Tent on replica')
+        self.assertNotIn('primary_pin', response.cookies)
+
+        response = self.client.post(reverse('ShopSphere:add_to_cart', args=[self.product.id]))
+        self.assertEqual(response.cookies['primary_pin']['max-age'], 5)
+        self.assertEqual(Cart.objects.using('default').get().items.get().product_id, self.product.id)
+
+        response = self.client.get(reverse('ShopSphere:product_detail', args=[self.product.id]))
+        self.assertNotContains(response, 'Tent on replica')
+        self.assertContains(response, 'Tent')
+
+        self.assertNotIn('primary_pin', response.cookies)
+
+        # A write made while pinned restarts the pin.
+        response = self.client.post(reverse('ShopSphere:add_to_cart', args=[self.product.id]))
+        self.assertEqual(response.cookies['primary_pin']['max-age'], 5)
+
+        self.client.cookies.pop('primary_pin')
+        response = self.client.get(reverse('ShopSphere:product_detail', args=[self.product.id]))
+        self.assertContains(response, 'Tent on replica')
+
+
+@override_settings(FANOUT_WORKERS=4)
+class FanoutTests(TransactionTestCase):
+    def test_gather_runs_thunks_in_worker_threads(self):
+        from django.db import transaction
+        from ShopSphere.fanout import gather
+        Category.objects.create(name='Gear')
+        thunks = [lambda i=i: (i, threading.current_thread().name, Category.objects.count()) for i in range(3)]
+
+        results = gather(*thunks)
+        self.assertEqual([(i, n) for i, _, n in results], [(0, 1), (1, 1), (2, 1)])
+        self.assertTrue(all(name.startswith('fanout') for _, name, _ in results[1:]))
+
+        # Other connections couldn't see the transaction's rows, so it stays in this thread.
+        with transaction.atomic():
+            Category.objects.create(name='Tents')
+            results = gather(*thunks)
+        self.assertEqual({name for _, name, _ in results}, {threading.current_thread().name})
+        self.assertEqual([n for _, _, n in results], [2, 2, 2])
+
+    def test_views_render_the_same_with_and_without_fanout(self):
+        category = Category.objects.create(name='Gear')
+        Page.objects.create(category=category, title='Guide', url='http://example.com/')
+        Product.objects.create(category='Gear', name='Tent', description='', price=1, stock=1)
+        for path in (reverse('ShopSphere:index'), reverse('ShopSphere:show_category', args=['gear'])):
+            cache.clear()
+            parallel = self.client.get(path)
+            with override_settings(FANOUT_WORKERS=0):
+                cache.clear()
+                serial = self.client.get(path)
+            self.assertContains(parallel, 'Tent')
+            self.assertContains(parallel, 'Guide')
+            self.assertEqual(parallel.content, serial.content)
+
+
+class BenchTests(TransactionTestCase):
+    def test_seed_tops_up_to_the_requested_sizes(self):
+        from ShopSphere import bench
+        created = bench.seed(products=1200, users=5, carts=3)
+        self.assertEqual(created, {'categories': 2, 'pages': 6, 'products': 1200, 'users': 5, 'carts': 3})
+        self.assertEqual(Cart.objects.filter(items__isnull=False).distinct().count(), 3)
+        self.assertEqual(bench.seed(products=1200, users=5, carts=3),
+                         dict.fromkeys(created, 0))
+        from ShopSphere import search
+        self.assertTrue(search.search_products('lamp').products)
+
+    def test_run_reports_latencies_and_queries(self):
+        from ShopSphere import bench
+        bench.seed(products=20, users=2, carts=0)
+        sample = bench.Sample()
+        routes = {route.name: route for route in bench.ROUTES}
+
+        result = bench.run(routes['product_detail'], sample, clients=2, requests=6, cold=True)
+        self.assertEqual((result['requests'], result['errors']), (6, 0))
+        self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertGreaterEqual(result['queries_per_request'], 1)
+
+        result = bench.run(routes['cart_detail'], sample, clients=2, requests=4)
+        self.assertEqual(result['errors'], 0)
+
+    def test_every_url_has_a_scenario(self):
+        from ShopSphere import bench, urls
+        self.assertEqual({p.name for p in urls.urlpatterns}, {route.name for route in bench.ROUTES})
+
+    def test_regressions_against_a_baseline(self):
+        from ShopSphere import bench
+        base = {'index': {'rps': 100, 'p95_ms': 10, 'queries_per_request': 2, 'errors': 0}}
+        self.assertEqual(bench.compare(base, {'index': {'rps': 90, 'p95_ms': 11, 'queries_per_request': 2,
+                                                        'errors': 0}}), [])
+        self.assertEqual(len(bench.compare(base, {'index': {'rps': 50, 'p95_ms': 20, 'queries_per_request': 3,
+                                                            'errors': 1}})), 4)
+
+
+@override_settings(INSTRUMENTATION_SAMPLE_RATE=1, INSTRUMENTATION_DUPLICATE_THRESHOLD=3, METRICS_TOKEN='scrape-token')
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        from ShopSphere.instrumentation import stats
+        cache.clear()
+        stats.reset()
+        self.addCleanup(stats.reset)
+
+    def test_requests_are_profiled_per_view(self):
+        from ShopSphere.instrumentation import stats
+        Product.objects.create(name='Tent', description='', price=1, stock=1)
+        response = self.client.get(reverse('ShopSphere:index'))
+        totals = stats.snapshot()['views']['ShopSphere:index']
+        self.assertEqual(totals['requests'], 1)
+        self.assertGreaterEqual(totals['queries'], 3)
+        self.assertGreater(totals['sql_seconds'], 0)
+        self.assertGreater(totals['template_seconds'], 0)
+        self.assertLess(totals['template_seconds'], totals['seconds'])
+        self.assertEqual(totals['response_bytes'], len(response.content))
+
+        metrics = metrics_client().get(reverse('ShopSphere:metrics')).content.decode()
+        self.assertIn('shopsphere_view_requests_total{view="ShopSphere:index"} 1', metrics)
+        self.assertIn('shopsphere_view_queries_total{view="ShopSphere:index"}', metrics)
+
+    def test_repeated_queries_are_attributed_to_the_view_line(self):
+        from unittest import mock
+        from ShopSphere import instrumentation
+        from django.db import connection
+        products = [Product.objects.create(name=f'P{i}', description='', price=1, stock=1) for i in range(4)]
+        # As the middleware does when it starts.
+        instrumentation._install(connection=connection)
+        profile = instrumentation.RequestProfile()
+        token = instrumentation._profile.set(profile)
+        try:
+            with mock.patch.object(instrumentation, 'VIEWS_FILE', __file__.replace('.pyc', '.py')):
+                for product in products:
+                    Product.objects.get(pk=product.pk)
+        finally:
+            instrumentation._profile.reset(token)
+        instrumentation.stats.record('ShopSphere:index', profile, 0.1, 10)
+
+        (duplicate,) = instrumentation.stats.snapshot()['duplicates']
+        self.assertIn('WHERE "ShopSphere_product"."id" = %s', duplicate['sql'])
+        self.assertRegex(duplicate['location'], r'^tests\.py:\d+ in test_repeated_queries')
+        self.assertIn('shopsphere_view_duplicate_queries_total{location="tests.py:',
+                      metrics_client().get(reverse('ShopSphere:metrics')).content.decode())
+
+    def test_metrics_endpoint_needs_staff_or_the_token(self):
+        url = reverse('ShopSphere:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(Client(HTTP_AUTHORIZATION='Bearer wrong').get(url).status_code, 403)
+        self.assertEqual(metrics_client().get(url).status_code, 200)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(Client(HTTP_AUTHORIZATION='Bearer ').get(url).status_code, 403)
+        User.objects.create_user(username='admin', password='password123', is_staff=True)
+        self.client.login(username='admin', password='password123')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_stats_endpoint_is_for_staff(self):
+        self.assertEqual(self.client.get(reverse('ShopSphere:request_stats')).status_code, 302)
+        User.objects.create_user(username='admin', password='password123', is_staff=True)
+        self.client.login(username='admin', password='password123')
+        self.client.get(reverse('ShopSphere:about'))
+        response = self.client.get(reverse('ShopSphere:request_stats'))
+        self.assertEqual(response.json()['views']['ShopSphere:about']['requests'], 1)
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_disabled_middleware_steps_aside(self):
+        from django.core.exceptions import MiddlewareNotUsed
+        from ShopSphere.instrumentation import InstrumentationMiddleware
+        with self.assertRaises(MiddlewareNotUsed):
+            InstrumentationMiddleware(lambda request: None)
+
+
+@override_settings(LEADERBOARD_SIZE=3, COUNTER_FLUSH_INTERVAL=3600)
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        counters.buffer.flush()
+        self.categories = [Category.objects.create(name=f'Category {i}', likes=i) for i in range(5)]
+
+    def names(self, rows):
+        return [row.name for row in rows]
+
+    def test_served_from_cache(self):
+        from ShopSphere.leaderboards import top_categories
+        with self.assertNumQueries(1):
+            self.assertEqual(self.names(top_categories.top()), ['Category 4', 'Category 3', 'Category 2'])
+        with self.assertNumQueries(0):
+            top_categories.top()
+
+    def test_flushed_counts_are_merged_in(self):
+        from ShopSphere.leaderboards import top_categories
+        top_categories.top()
+        for _ in range(3):
+            counters.incr(Category, self.categories[1].slug, 'likes', lookup='slug')
+        counters.incr(Category, self.categories[3].pk, 'likes', amount=2)
+        # The two UPDATEs, then a read of the changed rows for each lookup field (slug, pk).
+        with self.assertNumQueries(4):
+            counters.buffer.flush()
+        with self.assertNumQueries(0):
+            # 5 likes, then 4 and 4, tied ones in id order.
+            self.assertEqual(self.names(top_categories.top()), ['Category 3', 'Category 1', 'Category 4'])
+
+    def test_edits_and_age_force_a_rebuild(self):
+        from ShopSphere.leaderboards import top_categories
+        top_categories.top()
+        Category.objects.filter(pk=self.categories[4].pk).update(likes=0)
+        self.categories[0].save()  # bumps the categories generation
+        self.assertEqual(self.names(top_categories.top()), ['Category 3', 'Category 2', 'Category 1'])
+
+        Category.objects.filter(pk=self.categories[0].pk).update(likes=10)
+        with override_settings(LEADERBOARD_MAX_AGE=0):
+            top_categories.rebuild()
+            self.assertEqual(self.names(top_categories.top())[0], 'Category 0')
+
+    def test_index_lists_the_leaders(self):
+        response = self.client.get(reverse('ShopSphere:index'))
+        self.assertEqual(self.names(response.context['categories']), ['Category 4', 'Category 3', 'Category 2'])
+
+
+class BrowseFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for name, category, price, stock in [('Kettle', 'Kitchen', 8, 3), ('Toaster', 'Kitchen', 30, 0),
+                                             ('Pan', 'Kitchen', 30, 5), ('Tent', 'Outdoors', 120, 2),
+                                             ('Stove', 'Outdoors', 40, 0)]:
+            Product.objects.create(name=name, category=category, description='', price=price, stock=stock)
+
+    def facets(self, **params):
+        from django.http import QueryDict
+        from ShopSphere.facets import Selection
+        query = QueryDict(mutable=True)
+        query.update(params)
+        return Selection(query).facets()
+
+    def counts(self, options):
+        return {option['label']: option['count'] for option in options}
+
+    def test_counts_come_from_one_cached_query(self):
+        with self.assertNumQueries(1):
+            facets = self.facets()
+        with self.assertNumQueries(0):
+            self.facets(category='kitchen')
+        self.assertEqual(self.counts(facets['categories']), {'Kitchen': 3, 'Outdoors': 2})
+        self.assertEqual(self.counts(facets['prices']),
+                         {'£0 to £10': 1, '£25 to £50': 3, '£100 to £250': 1})
+        self.assertEqual(facets['in_stock']['count'], 3)
+
+    def test_in_stock_counts_follow_reservations_once_the_cube_expires(self):
+        from ShopSphere import facets, inventory
+        self.assertEqual(self.facets()['in_stock']['count'], 3)
+        tent = Product.objects.get(name='Tent')
+        cart = Cart.objects.create()
+        inventory.reserve(cart, tent.pk, 2)
+        cache.delete(facets.cube_key())  # as CUBE_TIMEOUT would
+        self.assertEqual(self.facets()['in_stock']['count'], 2)
+        inventory.release(cart)
+        cache.delete(facets.cube_key())
+        self.assertEqual(self.facets()['in_stock']['count'], 3)
+
+    def test_counts_follow_the_other_facets(self):
+        facets = self.facets(category='kitchen', in_stock='1')
+        # Each facet is counted under the other facets' selections, not its own.
+        self.assertEqual(self.counts(facets['categories']), {'Kitchen': 2, 'Outdoors': 1})
+        self.assertEqual(self.counts(facets['prices']), {'£0 to £10': 1, '£25 to £50': 1})
+        self.assertEqual(facets['in_stock']['count'], 2)
+        kitchen = facets['categories'][0]
+        self.assertTrue(kitchen['selected'])
+        self.assertEqual(kitchen['query'], 'in_stock=1')
+
+    def test_view_filters_the_products(self):
+        response = self.client.get(reverse('ShopSphere:browse'),
+                                   {'category': 'kitchen', 'price': '25-50', 'in_stock': '1', 'after': '1'})
+        self.assertEqual([p.name for p in response.context['products']], ['Pan'])
+        # Changing the selection starts again from the first page.
+        self.assertNotIn('after', response.context['facets']['in_stock']['query'])
+
+    def test_catalog_changes_refresh_the_counts(self):
+        self.facets()
+        Product.objects.create(name='Lamp', category='Lighting', description='', price=300, stock=1)
+        facets = self.facets()
+        self.assertEqual(self.counts(facets['categories'])['Lighting'], 1)
+        self.assertEqual(self.counts(facets['prices'])['£250 and over'], 1)
+
+
+class ExportCatalogTests(TestCase):
+    def setUp(self):
+        for i in range(5):
+            Product.objects.create(category='Books', name=f'Book {i}', description='A "good" read, really',
+                                   price='9.99', stock=i)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_view_streams_for_staff_only(self):
+        User.objects.create_user(username='shopper', password='password123')
+        self.client.login(username='shopper', password='password123')
+        self.assertEqual(self.client.get(reverse('ShopSphere:export_catalog', args=['products'])).status_code, 302)
+
+        User.objects.create_user(username='admin', password='password123', is_staff=True)
+        self.client.login(username='admin', password='password123')
+        response = self.client.get(reverse('ShopSphere:export_catalog', args=['products']))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="products.csv"')
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['name'] for row in rows], [f'Book {i}' for i in range(5)])
+        self.assertEqual(rows[0]['description'], 'A "good" read, really')
+        self.assertEqual(self.client.get(reverse('ShopSphere:export_catalog', args=['users'])).status_code, 404)
+
+    def test_gzipped_jsonl_round_trips_through_the_importer(self):
+        import gzip
+        from ShopSphere.exporter import export
+        data = gzip.decompress(b''.join(export('products', 'jsonl', compress=True, chunk_size=2)))
+        rows = [json.loads(line) for line in data.decode().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[1]['price'], '9.99')
+
+        path = os.path.join(self.directory.name, 'products.jsonl')
+        with open(path, 'wb') as f:
+            f.write(data)
+        Product.objects.all().delete()
+        call_command('import_catalog', path, stdout=StringIO())
+        self.assertEqual(Product.objects.count(), 5)
+
+    def test_command_infers_format_and_compression(self):
+        import gzip
+        path = os.path.join(self.directory.name, 'categories.csv.gz')
+        # One query, its rows fetched from the cursor two at a time.
+        with self.assertNumQueries(1):
+            call_command('export_catalog', 'products', os.path.join(self.directory.name, 'p.csv'),
+                         chunk_size=2, stdout=StringIO())
+        with open(os.path.join(self.directory.name, 'p.csv')) as f:
+            self.assertEqual(len(f.read().splitlines()), 6)
+        call_command('export_catalog', 'categories', path, stdout=StringIO())
+        with gzip.open(path, 'rt') as f:
+            self.assertEqual(f.read().splitlines(), ['id,name,slug,views,likes',
+                                                     f'{Category.objects.get().id},Books,books,0,0'])
+
+
+@override_settings(SESSION_WRITE_BEHIND=3600)
+@override_settings(SESSION_WRITE_BEHIND=5)
+class SessionStoreTests(TestCase):
+    def setUp(self):
+        from ShopSphere import sessions
+        cache.clear()
+        sessions.buffer.flush()
+        # Also stops the flush timer, so it never writes in a later test.
+        self.addCleanup(sessions.buffer.flush)
+        self.product = Product.objects.create(name='Mug', category='Kitchen', description='', price=5, stock=10)
+
+    def row(self, session_key):
+        from django.contrib.sessions.models import Session
+        return Session.objects.get(session_key=session_key)
+
+    def test_unchanged_saves_write_nothing(self):
+        from ShopSphere.sessions import SessionStore
+        session = SessionStore()
+        session['cart_items'] = 2
+        session.create()
+        session = SessionStore(session.session_key)
+        session['cart_items'] = 2
+        with self.assertNumQueries(0):
+            session.save()
+
+    def test_changes_are_written_behind_the_cache(self):
+        from ShopSphere import sessions
+        session = sessions.SessionStore()
+        session['cart_items'] = 1
+        session.create()
+        session['cart_items'] = 3
+        with self.assertNumQueries(0):
+            session.save()
+        self.assertEqual(sessions.SessionStore(session.session_key)['cart_items'], 3)
+        self.assertEqual(session.decode(self.row(session.session_key).session_data), {'cart_items': 1})
+
+        # Lost from the cache, the change is still read from the buffer.
+        cache.clear()
+        self.assertEqual(sessions.SessionStore(session.session_key)['cart_items'], 3)
+        with self.assertNumQueries(3):  # one UPDATE per session, in a transaction
+            sessions.buffer.flush()
+        self.assertEqual(session.decode(self.row(session.session_key).session_data), {'cart_items': 3})
+
+    def test_repeated_cart_clicks_write_the_session_once(self):
+        from ShopSphere import sessions
+        self.client.post(reverse('ShopSphere:add_to_cart', args=[self.product.id]))
+        key = self.client.session.session_key
+        self.assertEqual(sessions.buffer.get(key), None)
+        self.client.post(reverse('ShopSphere:add_to_cart', args=[self.product.id]))
+        self.assertIsNotNone(sessions.buffer.get(key))
+        self.assertEqual(self.client.session['cart_items'], 2)
+
+    def test_logins_and_cart_ids_are_written_through(self):
+        from ShopSphere import sessions
+        User.objects.create_user(username='shopper', password='password123')
+        self.client.login(username='shopper', password='password123')
+        key = self.client.session.session_key
+        self.assertIsNone(sessions.buffer.get(key))
+        self.assertIn('_auth_user_id', sessions.SessionStore().decode(self.row(key).session_data))
+
+        # Anonymous carts are found through the session's cart id.
+        anonymous = Client()
+        anonymous.post(reverse('ShopSphere:add_to_cart', args=[self.product.id]))
+        key = anonymous.session.session_key
+        self.assertIsNone(sessions.buffer.get(key))
+        self.assertIn('cart_id', sessions.SessionStore().decode(self.row(key).session_data))
+
+    def test_buffered_changes_are_flushed_by_a_timer(self):
+        from unittest import mock
+        from ShopSphere import sessions
+        session = sessions.SessionStore()
+        session.create()
+        session['cart_items'] = 3
+        flushed = threading.Event()
+        with override_settings(SESSION_WRITE_BEHIND=0.01), \
+                mock.patch.object(sessions.buffer, 'flush', side_effect=lambda: flushed.set()):
+            session.save()
+            self.assertTrue(flushed.wait(5))
+
+    def test_old_format_rows_are_still_read(self):
+        from django.contrib.sessions.backends.db import SessionStore as DBStore
+        from ShopSphere.sessions import SessionStore
+        old = DBStore()
+        old['cart_id'] = 7
+        old.create()
+        self.assertEqual(SessionStore(old.session_key)['cart_id'], 7)
+        self.assertLess(len(SessionStore().encode({'cart_id': 7})), len(old.encode({'cart_id': 7})))
+
+    def test_expired_sessions_are_purged_in_batches(self):
+        from datetime import timedelta
+        from django.contrib.sessions.models import Session
+        from django.utils import timezone
+        from ShopSphere.sessions import SessionStore
+        past = timezone.now() - timedelta(days=1)
+        Session.objects.bulk_create([Session(session_key=f'expired{i}', session_data='', expire_date=past)
+                                     for i in range(5)])
+        Session.objects.create(session_key='current', session_data='', expire_date=timezone.now() + timedelta(days=1))
+        # Each batch is one SELECT of keys and one DELETE, then a SELECT finds none left.
+        with self.assertNumQueries(7):
+            self.assertEqual(SessionStore.clear_expired(batch_size=2), 5)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['current'])
+
+
+class ProductAdminTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser(username='admin', email='admin@example.com', password='password123')
+        self.client.login(username='admin', password='password123')
+        self.products = [Product.objects.create(name=f'Lamp {i}', category='Lighting', description='',
+                                                price='20.00', stock=5) for i in range(30)]
+
+    def test_changelists_query_a_fixed_number_of_times(self):
+        for model in (Product, Page, Cart, CartItem):
+            self.assertTrue(site.is_registered(model))
+        cart = Cart.objects.create()
+        for product in self.products:
+            CartItem.objects.create(cart=cart, product=product)
+        category = Category.objects.get(name='Lighting')
+        for i in range(10):
+            Page.objects.create(category=category, title=f'Guide {i}', url='http://example.com/')
+
+        for name in ('product', 'page', 'cartitem'):
+            url = reverse(f'admin:ShopSphere_{name}_changelist')
+            self.client.get(url)
+            with self.assertNumQueries(3):  # the user, the filtered count and the page; the session is cached
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, name)
+
+    def test_search_uses_indexes(self):
+        url = reverse('admin:ShopSphere_product_changelist')
+        response = self.client.get(url, {'q': 'Lamp 1'})
+        self.assertEqual(sorted(p.name for p in response.context['cl'].result_list),
+                         ['Lamp 1', 'Lamp 10', 'Lamp 11', 'Lamp 12', 'Lamp 13', 'Lamp 14', 'Lamp 15', 'Lamp 16',
+                          'Lamp 17', 'Lamp 18', 'Lamp 19'])
+        self.assertEqual(len(self.client.get(url, {'q': 'Lighting'}).context['cl'].result_list), 30)
+        # Matches are case-sensitive, unlike Django's default LIKE search, and cover the whole term.
+        self.assertEqual(len(self.client.get(url, {'q': 'lamp 1'}).context['cl'].result_list), 0)
+        self.assertEqual(len(self.client.get(url, {'q': 'lighting'}).context['cl'].result_list), 0)
+        self.assertEqual(len(self.client.get(url, {'q': 'Lighting Lamp'}).context['cl'].result_list), 0)
+
+        from ShopSphere.admin import ProductAdmin
+        queryset, _ = ProductAdmin(Product, site).get_search_results(None, Product.objects.all(), 'Lamp 1')
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertNotIn('SCAN', plan)
+
+    def test_bulk_update_is_a_single_update(self):
+        url = reverse('admin:ShopSphere_product_changelist')
+        selected = [p.pk for p in self.products[:20]]
+        response = self.client.post(url, {'action': 'bulk_update', '_selected_action': selected})
+        self.assertContains(response, 'Change prices by')
+
+        product_page = reverse('ShopSphere:product_detail', args=[self.products[0].pk])
+        Client().get(product_page)
+        statements = []
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+        with connection.execute_wrapper(record):
+            response = self.client.post(url, {'action': 'bulk_update', '_selected_action': selected,
+                                              'apply': '1', 'price_percent': '-12.5', 'stock': '0'})
+        self.assertRedirects(response, url)
+        self.assertEqual(len([sql for sql in statements if sql.startswith('UPDATE "ShopSphere_product"')]), 1)
+        self.assertEqual(Product.objects.filter(price=Decimal('17.50'), stock=0).count(), 20)
+        self.assertEqual(Product.objects.filter(price=Decimal('20.00'), stock=5).count(), 10)
+        response = Client().get(product_page)
+        # product_detail depends on 'products:bulk', so the page cached before the update is dropped.
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, '17.50')
+
+
+def tenth_off(priced):
+    """A pricing rule for the tests: 10% off orders of 3 items or more"""
+    if priced.items >= 3:
+        yield 'Tenth off', -(priced.subtotal // 10)
+
+
+class PricingTests(TestCase):
+    def setUp(self):
+        from ShopSphere import promotions
+        cache.clear()
+        promotions.compiled()
+        self.cart = Cart.objects.create()
+        self.pen = Product.objects.create(name='Pen', description='', price='0.10', stock=50)
+        self.pad = Product.objects.create(name='Pad', description='', price='0.20', stock=50)
+        from ShopSphere.cart import add_item
+        add_item(self.cart, self.pen.pk, 3)
+        add_item(self.cart, self.pad.pk, 1)
+
+    def test_totals_are_exact_pennies(self):
+        from ShopSphere.pricing import price_cart, to_minor
+        priced = price_cart(self.cart)
+        self.assertEqual(list(priced.line_totals), [30, 20])
+        self.assertEqual(priced.total_price, Decimal('0.50'))
+        self.assertEqual(priced.line_price(self.pad.pk), Decimal('0.20'))
+        self.assertEqual(to_minor('19.999'), 2000)
+
+    def test_priced_once_per_cart_version(self):
+        from ShopSphere.cart import add_item
+        from ShopSphere.pricing import price_cart
+        with self.assertNumQueries(1):
+            price_cart(self.cart)
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(price_cart(cart).items, 4)
+        add_item(self.cart, self.pad.pk, 1)
+        self.assertEqual(price_cart(self.cart).total_price, Decimal('0.70'))
+        self.pen.price = Decimal('1.00')
+        self.pen.save()
+        self.assertEqual(price_cart(self.cart).total_price, Decimal('3.40'))
+
+    def test_only_price_changes_reprice(self):
+        from ShopSphere import inventory
+        from ShopSphere.pricing import price_cart
+        price_cart(self.cart)
+        # Stock reservations, other carts and edits that leave the price alone keep the cached total.
+        inventory.reserve(Cart.objects.create(), self.pad.pk, 2)
+        pen = Product.objects.get(pk=self.pen.pk)
+        pen.description = 'Blue ink'
+        pen.save()
+        with self.assertNumQueries(0):
+            price_cart(self.cart)
+        call_command('import_catalog', self.write_catalog('Pen,,0.30,50'), stdout=StringIO())
+        self.assertEqual(price_cart(self.cart).total_price, Decimal('1.10'))
+
+    def write_catalog(self, *lines):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'catalog.csv')
+        with open(path, 'w') as f:
+            f.write('\n'.join(['name,category,price,stock', *lines]) + '\n')
+        return path
+
+    @override_settings(PRICING_RULES=['ShopSphere.tests.tenth_off'])
+    def test_rules_adjust_the_total(self):
+        from ShopSphere.pricing import price_cart
+        priced = price_cart(self.cart)
+        self.assertEqual(priced.adjustments, [('Tenth off', -5)])
+        self.assertEqual((priced.subtotal_price, priced.total_price), (Decimal('0.50'), Decimal('0.45')))
+
+
+class PromotionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tv = Product.objects.create(name='TV', category='Electronics', description='', price='200.00', stock=9)
+        self.cable = Product.objects.create(name='Cable', category='Electronics', description='', price='5.00',
+                                            stock=9)
+        self.book = Product.objects.create(name='Novel', category='Books', description='', price='8.00', stock=9)
+        self.electronics = Category.objects.get(name='Electronics')
+        self.cart = Cart.objects.create()
+        from ShopSphere.cart import add_item
+        add_item(self.cart, self.tv.pk, 1)
+        add_item(self.cart, self.cable.pk, 2)
+        add_item(self.cart, self.book.pk, 3)
+
+    def price(self):
+        from ShopSphere.pricing import price_cart
+        return price_cart(self.cart)
+
+    def test_promotions_saved_by_another_process_are_seen_within_the_pricing_timeout(self):
+        from unittest import mock
+        from ShopSphere import promotions
+        from ShopSphere.pricing import PRICING_TIMEOUT
+        self.assertEqual(promotions.compiled().by_product, {})
+        # bulk_create sends no post_save, like a save whose bump went to another process's cache.
+        Promotion.objects.bulk_create([Promotion(name='TV deal', kind=Promotion.PRODUCT, product=self.tv,
+                                                 percent_off=25)])
+        self.assertEqual(promotions.compiled().by_product, {})
+        later = time.time() + PRICING_TIMEOUT + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertIn(self.tv.pk, promotions.compiled().by_product)
+
+    def test_each_line_gets_its_best_promotion(self):
+        Promotion.objects.create(name='Electronics sale', kind=Promotion.CATEGORY, category=self.electronics,
+                                 percent_off=20)
+        Promotion.objects.create(name='TV deal', kind=Promotion.PRODUCT, product=self.tv, percent_off=25)
+        Promotion.objects.create(name='Three for two', kind=Promotion.BOGO, product=self.book,
+                                 buy_quantity=2, free_quantity=1)
+        priced = self.price()
+        self.assertEqual(dict(priced.adjustments), {'TV deal': -5000, 'Electronics sale': -200, 'Three for two': -800})
+        self.assertEqual(priced.total_price, Decimal('174.00'))
+
+    def test_threshold_applies_to_the_discounted_total(self):
+        Promotion.objects.create(name='TV deal', kind=Promotion.PRODUCT, product=self.tv, percent_off=50)
+        Promotion.objects.create(name='Big order', kind=Promotion.THRESHOLD, min_subtotal=100, percent_off=10)
+        Promotion.objects.create(name='Huge order', kind=Promotion.THRESHOLD, min_subtotal=200, percent_off=30)
+        # 234.00 - 100.00 off the TV leaves 134.00, over 100 but not 200.
+        self.assertEqual(dict(self.price().adjustments), {'TV deal': -10000, 'Big order': -1340})
+
+    def test_compiled_once_and_refreshed_when_promotions_change(self):
+        from ShopSphere import promotions
+        promotion = Promotion.objects.create(name='Sale', kind=Promotion.CATEGORY, category=self.electronics,
+                                             percent_off=10)
+        self.price()
+        with self.assertNumQueries(0):
+            self.price()
+            promotions.compiled()
+        promotion.percent_off = 50
+        promotion.save()
+        self.assertEqual(dict(self.price().adjustments), {'Sale': -10500})
+
+    def test_promotions_start_and_end_on_time(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        promotion = Promotion.objects.create(name='Weekend', kind=Promotion.PRODUCT, product=self.cable,
+                                             percent_off=100, starts_at=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(self.price().adjustments, [])
+        Promotion.objects.filter(pk=promotion.pk).update(starts_at=timezone.now() - timedelta(seconds=1))
+        # The index was built to expire when the promotion started; pretend that time has come.
+        from ShopSphere import promotions
+        index = promotions.compiled()
+        index.expires = time.time() - 1
+        cache.set(promotions._key(), index, None)
+        self.assertEqual(self.price().adjustments, [('Weekend', -1000)])
+
+    def test_rules_are_validated(self):
+        from django.core.exceptions import ValidationError
+        with self.assertRaises(ValidationError):
+            Promotion(name='No target', kind=Promotion.CATEGORY, percent_off=10).full_clean()
+        with self.assertRaises(ValidationError):
+            Promotion(name='Too much', kind=Promotion.PRODUCT, product=self.tv, percent_off=150).full_clean()
+        for buy, free in ((0, 0), (0, 1), (2, 0)):
+            with self.assertRaises(ValidationError):
+                Promotion(name='Free', kind=Promotion.BOGO, product=self.tv, buy_quantity=buy,
+                          free_quantity=free).full_clean()
+
+    def test_cart_page_shows_the_discounts(self):
+        Promotion.objects.create(name='Electronics sale', kind=Promotion.CATEGORY, category=self.electronics,
+                                 percent_off=20)
+        self.client.post(reverse('ShopSphere:add_to_cart', args=[self.cable.pk]))
+        response = self.client.get(reverse('ShopSphere:cart_detail'))
+        self.assertContains(response, 'Electronics sale: -£1.00')
+        self.assertContains(response, 'Total: £4.00')
+
+
+TASK_CALLS = []
+
+
+@tasks.task(name='tests.record', max_attempts=3)
+def record(value, fail_times=0):
+    """A task for the tests: fails its first fail_times calls, then records value"""
+    TASK_CALLS.append(value)
+    if TASK_CALLS.count(value) <= fail_times:
+        raise RuntimeError(f'attempt {TASK_CALLS.count(value)} failed')
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        TASK_CALLS.clear()
+
+    def make_due(self):
+        from django.utils import timezone
+        Task.objects.update(run_at=timezone.now())
+
+    def test_tasks_run_in_process(self):
+        queued = tasks.enqueue('tests.record', 'a')
+        self.assertEqual(queued.status, Task.QUEUED)
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(TASK_CALLS, ['a'])
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.locked_by), (Task.DONE, 1, ''))
+        self.assertIsNotNone(queued.finished_at)
+        self.assertGreater(queued.seconds, 0)
+        self.assertEqual(tasks.run_pending(), 0)
+
+    def test_unknown_tasks_are_refused(self):
+        with self.assertRaises(ValueError):
+            tasks.enqueue('tests.missing')
+
+    def test_idempotency_key_queues_a_task_once(self):
+        first = tasks.enqueue('tests.record', 'a', key='only-once')
+        self.assertEqual(tasks.enqueue('tests.record', 'b', key='only-once'), first)
+        tasks.run_pending()
+        self.assertEqual(tasks.enqueue('tests.record', 'c', key='only-once'), first)
+        self.assertEqual(tasks.run_pending(), 0)
+        self.assertEqual(TASK_CALLS, ['a'])
+
+    def test_tasks_are_queued_in_the_callers_transaction(self):
+        from django.db import transaction
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                tasks.enqueue('tests.record', 'a')
+                raise RuntimeError('rolled back')
+        self.assertFalse(Task.objects.exists())
+
+    def test_failures_are_retried_with_backoff(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        queued = tasks.enqueue('tests.record', 'a', 1)
+        # The retry isn't due yet, so this runs just the first attempt.
+        self.assertEqual(tasks.run_pending(), 1)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.QUEUED, 1))
+        self.assertIn('attempt 1 failed', queued.last_error)
+        self.assertGreater(queued.run_at, timezone.now() + timedelta(seconds=9))
+        self.make_due()
+        tasks.run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.last_error), (Task.DONE, 2, ''))
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        with override_settings(TASK_RETRY_BACKOFF=10, TASK_MAX_BACKOFF=60):
+            self.assertTrue(10 <= tasks.backoff(1) <= 11)
+            self.assertTrue(40 <= tasks.backoff(3) <= 44)
+            self.assertTrue(60 <= tasks.backoff(10) <= 66)
+
+    def test_gives_up_after_max_attempts(self):
+        queued = tasks.enqueue('tests.record', 'a', 10)
+        for _ in range(3):
+            self.make_due()
+            tasks.run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.FAILED, 3))
+        self.assertIn('attempt 3 failed', queued.last_error)
+        self.make_due()
+        self.assertEqual(tasks.run_pending(), 0)
+
+    def test_claims_are_exclusive_until_the_worker_times_out(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        queued = tasks.enqueue('tests.record', 'a')
+        self.assertEqual(tasks.claim('first'), [queued])
+        self.assertEqual(tasks.claim('second'), [])
+        Task.objects.update(locked_at=timezone.now() - timedelta(seconds=tasks.task_timeout() + 1))
+        reclaimed = tasks.claim('second')
+        self.assertEqual([(task.locked_by, task.attempts) for task in reclaimed], [('second', 2)])
+
+    def test_tasks_that_kill_their_worker_are_given_up(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        queued = tasks.enqueue('tests.record', 'a')
+        for _ in range(3):
+            self.assertEqual(len(tasks.claim('doomed')), 1)
+            # The worker dies mid-task, so the task is left running.
+            Task.objects.update(locked_at=timezone.now() - timedelta(seconds=tasks.task_timeout() + 1))
+        self.assertEqual(tasks.claim('next'), [])
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.locked_by), (Task.FAILED, 3, ''))
+        self.assertIn('stopped', queued.last_error)
+
+    def test_new_users_get_their_cart_when_they_first_use_it(self):
+        user = User.objects.create_user('shopper', password='secret')
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Task.objects.exists())
+        product = Product.objects.create(category='Books', name='Novel', description='', price=1, stock=1)
+        self.client.force_login(user)
+        self.client.post(reverse('ShopSphere:add_to_cart', args=[product.id]))
+        self.assertEqual(Cart.objects.get().user, user)
+
+    def test_registering_saves_the_user_once_with_a_hashed_password(self):
+        from django.contrib.auth.hashers import check_password
+        from django.db.models.signals import post_save
+        saves = []
+        post_save.connect(lambda **kwargs: saves.append(kwargs['created']), sender=User, weak=False,
+                          dispatch_uid='count_saves')
+        try:
+            self.client.post(reverse('ShopSphere:register'),
+                             {'username': 'shopper', 'email': 'shopper@example.com', 'password': 'secret'})
+        finally:
+            post_save.disconnect(sender=User, dispatch_uid='count_saves')
+        self.assertEqual(saves, [True])
+        self.assertTrue(check_password('secret', User.objects.get(username='shopper').password))
+
+    def test_finished_tasks_are_purged(self):
+        tasks.enqueue('tests.record', 'a')
+        tasks.enqueue('tests.record', 'b', 10)
+        tasks.run_pending()
+        with override_settings(TASK_RETENTION=0):
+            self.assertEqual(tasks.purge_finished(), 1)
+        self.assertEqual(list(Task.objects.values_list('status', flat=True)), [Task.QUEUED])
+
+    def test_metrics_report_tasks(self):
+        from ShopSphere.metrics import render_metrics
+        tasks.enqueue('tests.record', 'a')
+        tasks.enqueue('tests.record', 'b', 10)
+        tasks.run_pending()
+        metrics = render_metrics()
+        self.assertIn('shopsphere_tasks{status="done",task="tests.record"} 1', metrics)
+        self.assertIn('shopsphere_task_attempts{status="queued",task="tests.record"} 1', metrics)
+        self.assertIn('shopsphere_task_seconds{status="done",task="tests.record"}', metrics)
+
+    def test_run_workers_burst(self):
+        tasks.enqueue('tests.record', 'a')
+        out = StringIO()
+        call_command('run_workers', '--burst', stdout=out)
+        self.assertIn('Ran 1 tasks.', out.getvalue())
+        self.assertEqual(TASK_CALLS, ['a'])
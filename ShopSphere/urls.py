@@ -1,7 +1,5 @@
 from django.urls import path
 from ShopSphere import views
-from shop_sphere_project import settings
-from django.conf.urls.static import static
 
 
 app_name = 'ShopSphere'
@@ -9,19 +7,25 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('about/', views.about, name='about'),
     path('category/<slug:category_name_slug>/', views.show_category, name='show_category'),
+    path('category/<slug:category_name_slug>/like/', views.like_category, name='like_category'),
+    path('goto/<int:page_id>/', views.goto_url, name='goto'),
     path('add_category/', views.add_category, name='add_category'),
     path('category/<slug:category_name_slug>/add_page/', views.add_page, name='add_page'),
     path('register/', views.register, name='register'),
     path('login/', views.user_login, name='login'), 
     path('recommended/', views.recommended, name='recommended'),
     path('logout/', views.user_logout, name='logout'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('stats/', views.request_stats, name='request_stats'),
+    path('export/<slug:name>/', views.export_catalog, name='export_catalog'),
     
+    path('browse/', views.browse, name='browse'),
+    path('search/', views.search, name='search'),
+    path('search/suggest/', views.search_suggest, name='search_suggest'),
     path('product/<int:product_id>/', views.product_detail, name='product_detail'),
     path('cart/', views.cart_detail, name='cart_detail'),
     path('cart/add/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
     path('cart/remove/<int:product_id>/', views.remove_from_cart, name='remove_from_cart'),
     path('cart/clear/', views.clear_cart, name='clear_cart'),
+    path('cart/checkout/', views.checkout, name='checkout'),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
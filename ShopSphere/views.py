@@ -1,5 +1,6 @@
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse,
+                         StreamingHttpResponse)
 from ShopSphere.models import Page
 from ShopSphere.models import Category
 from ShopSphere.forms import CategoryForm
@@ -9,91 +10,179 @@ from django.urls import reverse
 from ShopSphere.forms import UserForm
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.http import require_POST
+from django.contrib import messages
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from datetime import datetime
 
-from .models import Product, Cart, CartItem
-from .cart import Cart
+from .models import Product
+from .cart import CartService
+from .inventory import OutOfStock
+from .pagination import paginate_by_key
+from . import search as product_search
+from . import exporter, facets, leaderboards, recommendations
+from .caching import cache_anonymous_page
+from .fanout import gather
+from .metrics import render_metrics
+from .instrumentation import stats as view_stats
+from .counters import counts_hit, incr as incr_counter
 
+@cache_anonymous_page('products', 'stock', 'categories', 'pages')
 def index(request):
-    category_list = Category.objects.order_by('-likes')[:5]
-    page_list = Page.objects.order_by('-views')[:5]
-
-    product_list = Product.objects.all()
+    # The three lists are independent, so they're fetched at the same time.
+    # The top categories and pages usually come straight from the cache;
+    # only one page of products is fetched, keyed on id so deep pages stay cheap.
+    category_list, page_list, product_page = gather(
+        leaderboards.top_categories.top,
+        leaderboards.top_pages.top,
+        lambda: paginate_by_key(Product.objects.all(), request),
+    )
 
     context_dict = {}
     context_dict['boldmessage'] = 'Crunchy, creamy, cookie, candy, cupcake!'
     context_dict['categories'] = category_list
     context_dict['pages'] = page_list
 
-    context_dict['products'] = product_list
+    context_dict['products'] = product_page.object_list
+    context_dict['product_page'] = product_page
     
     response = render(request, 'ShopSphere/index.html', context=context_dict)
     return response
 
 
+@cache_anonymous_page(lambda product_id: f'product:{product_id}', 'products:bulk', 'categories')
 def product_detail(request, product_id):
     product = get_object_or_404(Product, id=product_id)
     return render(request, 'ShopSphere/product_detail.html', {'product': product})
 
 def cart_detail(request):
    """View the cart"""
-   cart = Cart(request)
+   cart = CartService(request).load()
    return render(request, 'ShopSphere/cart_detail.html', {'cart': cart})
 
+@require_POST
 def add_to_cart(request, product_id):
    """Add a product to the cart"""
    product = get_object_or_404(Product, id=product_id)
-   cart = Cart(request)
-   cart.add(product)
+   cart = CartService(request)
+   try:
+       cart.add(product)
+   except OutOfStock:
+       messages.error(request, f'Sorry, {product.name} is out of stock.')
+       return redirect('ShopSphere:product_detail', product_id=product.id)
    return redirect('ShopSphere:cart_detail')
 
 def remove_from_cart(request, product_id):
    """Remove product from the cart"""
    product = get_object_or_404(Product, id=product_id)
-   cart = Cart(request)
+   cart = CartService(request)
    cart.remove(product)
    return redirect('ShopSphere:cart_detail')
 
 def clear_cart(request):
    """Clear all items from the cart"""
-   cart = Cart(request)
+   cart = CartService(request)
    cart.clear()
    return redirect('ShopSphere:cart_detail')
 
+def checkout(request):
+   """Turn the cart's stock reservations into a sale"""
+   if request.method != 'POST':
+       return redirect('ShopSphere:cart_detail')
+   cart = CartService(request)
+   try:
+       lines = cart.checkout()
+   except OutOfStock:
+       messages.error(request, 'Some items in your cart are no longer in stock.')
+       return redirect('ShopSphere:cart_detail')
+   if lines:
+       messages.success(request, 'Thank you for your order!')
+   return redirect('ShopSphere:cart_detail')
+
+def search(request):
+    """Ranked full-text search over product name, category and description"""
+    query = request.GET.get('q', '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+    results = product_search.search_products(query, page=page)
+    return render(request, 'ShopSphere/search.html', {'query': query, 'results': results})
+
+@cache_anonymous_page('products', 'stock', 'categories')
+def browse(request):
+    """The catalog filtered by category, price band and stock, with a count beside each option"""
+    selection = facets.Selection(request.GET)
+    # The counts come from one cached grouped query, so only the page of products costs a query.
+    facet_counts, product_page = gather(
+        selection.facets,
+        lambda: paginate_by_key(selection.filter(Product.objects.all()), request),
+    )
+    return render(request, 'ShopSphere/browse.html', {
+        'facets': facet_counts,
+        'products': product_page.object_list,
+        'product_page': product_page,
+    })
+
+def search_suggest(request):
+    """Autocomplete product names for a partially typed search"""
+    suggestions = product_search.suggest(request.GET.get('q', ''))
+    return JsonResponse({'suggestions': suggestions})
+
+@cache_anonymous_page('categories')
 def about(request):
     return render(request, 'ShopSphere/about.html')
 
+@counts_hit(Category, 'views', kwarg='category_name_slug', lookup='slug')
+@cache_anonymous_page('products', 'categories', 'pages')
 def show_category(request, category_name_slug):
     # Create a context dictionary which we can pass
     # to the template rendering engine.
     context_dict = {}
 
-    try:
-        # Can we find a category name slug with the given name?
-        # If we can't, the .get() method raises a DoesNotExist exception.
-        # The .get() method returns one model instance or raises an exception.
-        category = Category.objects.get(slug=category_name_slug)
-
-        # Retrieve all of the associated pages.
-        # The filter() will return a list of page objects or an empty list.
-        pages = Page.objects.filter(category=category)
+    # The category, its pages and a keyset page of its products are all
+    # looked up by the slug, so the three queries run at the same time.
+    category, pages, product_page = gather(
+        lambda: Category.objects.filter(slug=category_name_slug).first(),
+        lambda: list(Page.objects.filter(category__slug=category_name_slug)),
+        lambda: paginate_by_key(Product.objects.filter(category_ref__slug=category_name_slug), request),
+    )
 
+    if category is not None:
         # Adds our results list to the template context under name pages.
         context_dict['pages'] = pages
+        context_dict['products'] = product_page.object_list
+        context_dict['product_page'] = product_page
         # We also add the category object from
         # the database to the context dictionary.
         # We'll use this in the template to verify that the category exists.
         context_dict['category'] = category
-    except Category.DoesNotExist:
+    else:
         # We get here if we didn't find the specified category.
         # Don't do anything -
         # the template will display the "no category" message for us.
         context_dict['category'] = None
         context_dict['pages'] = None
+        context_dict['products'] = None
 
     # Go render the response and return it to the client.
     return render(request, 'ShopSphere/category.html', context=context_dict)
 
+def goto_url(request, page_id):
+    # Count the click, then send the visitor on to the page itself.
+    page = get_object_or_404(Page, id=page_id)
+    incr_counter(Page, page.id, 'views')
+    return redirect(page.url)
+
+@login_required
+def like_category(request, category_name_slug):
+    if request.method == 'POST':
+        incr_counter(Category, category_name_slug, 'likes', lookup='slug')
+    return redirect(reverse('ShopSphere:show_category',
+                            kwargs={'category_name_slug': category_name_slug}))
+
 @login_required
 def add_category(request):
     form = CategoryForm()
@@ -162,11 +251,9 @@ def register(request):
 
         # If the two forms are valid...
         if user_form.is_valid():
-        # Save the user's form data to the database.
-            user = user_form.save()
-
-            # Now we hash the password with the set_password method.
-            # Once hashed, we can update the user object.
+        # Hash the password before the user is first saved, so the row is
+        # written once and the raw password never reaches the database.
+            user = user_form.save(commit=False)
             user.set_password(user.password)
             user.save()
            
@@ -230,9 +317,40 @@ def user_login(request):
         # blank dictionary object...
         return render(request, 'ShopSphere/login.html')
 
+def metrics(request):
+    """Expose internal counters to staff, or to a Prometheus scraper sending METRICS_TOKEN as a bearer token"""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+    if not (authorized or request.user.is_active and request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4')
+
+@staff_member_required
+def request_stats(request):
+    """Per-view SQL and timing totals of the sampled requests, with any duplicated queries"""
+    return JsonResponse(view_stats.snapshot())
+
+@staff_member_required
+def export_catalog(request, name):
+    """Download products, categories or pages as CSV or JSONL (?format=), gzipped with ?gzip=1"""
+    if name not in exporter.EXPORTS:
+        raise Http404(f'No export named {name}')
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in exporter.FORMATS:
+        return HttpResponseBadRequest(f'format must be one of {", ".join(exporter.FORMATS)}')
+    compress = request.GET.get('gzip') == '1'
+    # Rows are read and encoded as the response is sent, so memory use doesn't grow with the table.
+    response = StreamingHttpResponse(exporter.export(name, fmt, compress),
+                                     content_type='application/gzip' if compress else exporter.CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{exporter.filename(name, fmt, compress)}"'
+    return response
+
 @login_required
 def recommended(request):
-    return render(request, 'ShopSphere/recommended.html')
+    # Products often carted with what's in the user's cart.
+    in_cart = [item.product_id for item in CartService(request)]
+    products = recommendations.recommend(in_cart, limit=10)
+    return render(request, 'ShopSphere/recommended.html', {'products': products})
 
 # Use the login_required() decorator to ensure only those logged in can
 # access the view.
@@ -9,7 +9,7 @@ from ShopSphere.models import Category, Page
 import random
 from decimal import Decimal
 from ShopSphere.models import Product
-from django.core.files import File
+from ShopSphere.importer import clean_row, upsert_products
 
 def populate():
     # First, we will create lists of dictionaries containing the pages
@@ -75,16 +75,6 @@ def add_cat(name, views=10, likes=10):
     c.save()
     return c
     
-def get_image_file(image_name):
-    if not image_name:
-        return None
-    image_path = os.path.join('media', image_name)
-    try:
-        return File(open(image_path, 'rb'))
-    except FileNotFoundError:
-        print(f"Image File {image_name} not found")
-        return None
-
 def create_products():
    """Create some example products in each category."""
    print('adding products')
@@ -105,19 +95,11 @@ def create_products():
         {"category": "Toys & Games", "name": "Board Game", "description": "Fun for the whole family.", "price": 34.99, "stock": 20, "image": "board-game.jpg"},
     ]
    
-   for product_data in products:
-        image_file = get_image_file(product_data["image"])
-        product, created = Product.objects.get_or_create(
-            category=product_data["category"],
-            name=product_data["name"],
-            description=product_data["description"],
-            price=Decimal(product_data["price"]),
-            stock=product_data["stock"],
-               )
-        if created and image_file:
-            product.image = image_file
-            product.save()
-            print(f"Added product: {product.name}")
+   # One bulk upsert instead of a get_or_create and save per product. The
+   # images already live in MEDIA_ROOT, so the rows just point at them.
+   rows = [clean_row(product_data) for product_data in products]
+   created, updated = upsert_products(rows)
+   print(f"Added {created} products, updated {updated}")
 
 # Start execution here!
 if __name__ == '__main__':
@@ -44,6 +44,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'ShopSphere.instrumentation.InstrumentationMiddleware',
+    'ShopSphere.fileserving.FileServingMiddleware',
+    'ShopSphere.routers.PrimaryPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -56,7 +59,9 @@ ROOT_URLCONF = 'shop_sphere_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'NAME': 'django',
+        # DjangoTemplates, timing renders for ShopSphere.instrumentation.
+        'BACKEND': 'ShopSphere.instrumentation.TimedDjangoTemplates',
         'DIRS':  [TEMPLATE_DIR, ],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -85,6 +90,29 @@ DATABASES = {
     }
 }
 
+# Aliases in DATABASES that replicate 'default'. Catalog reads are spread over
+# them; see ShopSphere.routers. Empty means everything uses 'default'.
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['ShopSphere.routers.PrimaryReplicaRouter']
+# Seconds a client's reads stay on the primary after it writes; set it above
+# the replicas' usual lag.
+REPLICA_LAG = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+# Cached database sessions that skip unchanged saves and write changes
+# behind the cache (see ShopSphere.sessions).
+SESSION_ENGINE = 'ShopSphere.sessions'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shopsphere',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -133,8 +161,75 @@ USE_TZ = True
 STATICFILES_DIRS = [STATIC_DIR, ]
 
 STATIC_URL = '/static/'
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+
+if not DEBUG:
+    # Hashed names plus .gz/.br copies, written by collectstatic.
+    STATICFILES_STORAGE = 'ShopSphere.storage.CompressedManifestStaticFilesStorage'
 
 MEDIA_ROOT = MEDIA_DIR
 MEDIA_URL = '/media/'
 
-LOGIN_URL = 'ShopSphere:login'
\ No newline at end of file
+LOGIN_URL = 'ShopSphere:login'
+
+# ShopSphere tuning
+
+# Seconds a cart's stock reservations are held after its last change.
+STOCK_RESERVATION_TTL = 15 * 60
+
+# Seconds between writes of buffered category/page view and like counts.
+# 0 writes every hit straight through.
+COUNTER_FLUSH_INTERVAL = 5
+
+# Seconds between polls for product pairs carted together since the
+# recommendation matrix was built (see the build_recommendations command).
+RECOMMENDATIONS_REFRESH = 60
+RECOMMENDATIONS_FILE = os.path.join(BASE_DIR, 'recommendations.bin')
+
+# Threads for running a view's independent queries concurrently
+# (ShopSphere.fanout). 0 or 1 runs them one after another.
+FANOUT_WORKERS = 4
+
+# Fraction of requests profiled for per-view SQL and timing statistics
+# (/ShopSphere/stats/ and /ShopSphere/metrics/). 0 turns profiling off.
+INSTRUMENTATION_SAMPLE_RATE = 0.05
+# Repeats of one query within a request that are reported as a likely N+1.
+INSTRUMENTATION_DUPLICATE_THRESHOLD = 5
+# /ShopSphere/metrics/ is for staff, or for a scraper sending
+# "Authorization: Bearer <METRICS_TOKEN>"; blank allows staff only.
+METRICS_TOKEN = os.environ.get('SHOPSPHERE_METRICS_TOKEN', '')
+
+# Length of the index page's top categories / top pages lists, and the most
+# seconds a cached list is served before it is re-read from the database.
+LEADERBOARD_SIZE = 5
+LEADERBOARD_MAX_AGE = 60
+
+# Upper bounds of the price bands offered when browsing the catalog; the
+# last band is everything from the final bound up.
+FACET_PRICE_BOUNDS = (10, 25, 50, 100, 250)
+
+# Seconds session changes wait in memory before they are written to the
+# database; 0 writes them straight through. Other processes only see a
+# buffered change through the cache, so keep 0 while CACHES is per-process
+# (locmem) and raise it only with a shared cache. Expired sessions are deleted
+# in the background every SESSION_PURGE_INTERVAL seconds, SESSION_PURGE_BATCH
+# rows at a time.
+SESSION_WRITE_BEHIND = 0
+SESSION_PURGE_INTERVAL = 60 * 60
+SESSION_PURGE_BATCH = 1000
+
+# Dotted paths of cart pricing rules (taxes, discounts), applied in order;
+# see ShopSphere.pricing.
+PRICING_RULES = ['ShopSphere.promotions.apply']
+
+# Background tasks (ShopSphere.tasks), run by `manage.py run_workers`:
+# worker processes, seconds before a running task is presumed dead and
+# retried, attempts before a failing task is given up, seconds before the
+# first retry (doubling each time, up to TASK_MAX_BACKOFF), and seconds
+# finished tasks are kept.
+TASK_WORKERS = 2
+TASK_TIMEOUT = 5 * 60
+TASK_MAX_ATTEMPTS = 5
+TASK_RETRY_BACKOFF = 10
+TASK_MAX_BACKOFF = 60 * 60
+TASK_RETENTION = 7 * 24 * 60 * 60
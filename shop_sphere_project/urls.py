@@ -17,8 +17,6 @@ from django.contrib import admin
 from django.urls import path
 from django.urls import include
 from ShopSphere import views
-from django.conf import settings
-from django.conf.urls.static import static
 
 
 urlpatterns = [
@@ -26,5 +24,6 @@ urlpatterns = [
     path('ShopSphere/', include('ShopSphere.urls')),
     # The above maps any URLs starting with ShopSphere/ to be handled by ShopSphere.
     path('admin/', admin.site.urls),
-]  + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+# Media files are served by ShopSphere.fileserving.FileServingMiddleware.
 